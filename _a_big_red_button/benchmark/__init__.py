@@ -0,0 +1,6 @@
+"""
+Offline benchmarks of the crawling hot paths, run against synthetic
+print lists instead of the live site.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
@@ -0,0 +1,181 @@
+"""
+Benchmarks turning EPZ files, i.e. outputs of the original crawler, into
+edge lists: the streaming reader with each of its backends against
+loading the whole file with json.load and counting edges in nested dicts,
+the way it used to be done. Every run is made in a process of its own, so
+that the peak memory of one does not hide that of the next.
+
+Run with:
+
+    python -m _a_big_red_button.benchmark.epz --target-mb 4096 --output epz.json
+    python -m _a_big_red_button.benchmark.epz --input output.epz --no-load
+
+A synthetic EPZ file is generated unless --input is given, written entry
+by entry so that it may well be larger than memory; loading it as a whole
+is skipped for files beyond --load-limit-mb.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import *
+
+from _a_big_red_button.benchmark.fixtures import _SURNAMES, _GIVEN_NAMES, _WORDS, _JOURNALS
+from _a_big_red_button.crawler.analyser import SNACrawlerOutput, BACKENDS, author_name
+
+# peak memory is only reported where the resource module exists
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def write_epz(path: Path, articles: int = None, target_bytes: int = None, authors: int = 100000,
+              abstract_words: int = 120, seed: int = 0) -> Dict[str, int]:
+    """
+    Write a synthetic EPZ file entry by entry, until either the number of
+    articles or the size is reached. Authors are picked from a pool with a
+    long tail, like the few prolific and many occasional authors of a field.
+    """
+    rng = random.Random(seed)
+    pool = [f'{rng.choice(_SURNAMES)}{number}, {rng.choice(_GIVEN_NAMES)}' for number in range(authors)]
+    written, entries = 0, 0
+    with open(path, mode='w', encoding='utf-8', buffering=1 << 20) as file:
+        written += file.write('{"version": "1.0", "data": [')
+        while (articles is None or entries < articles) and \
+                (target_bytes is None or written < target_bytes):
+            names = [pool[min(int(rng.paretovariate(1.1)) - 1, authors - 1)
+                          if rng.random() < 0.5 else rng.randrange(authors)]
+                     for _ in range(rng.randint(1, 12))]
+            entry = {
+                'title': ' '.join(rng.choice(_WORDS) for _ in range(8)).capitalize(),
+                'author': [f'{name.split(",")[0]}, {name.split(", ")[1][0]} ({name})' for name in names],
+                'journal': rng.choice(_JOURNALS),
+                'year': rng.randint(1990, 2019),
+                'abstract': ' '.join(rng.choice(_WORDS) for _ in range(abstract_words)),
+                'cited': rng.randint(0, 5000)
+            }
+            written += file.write((', ' if entries else '') + json.dumps(entry))
+            entries += 1
+        written += file.write(']}')
+    return {'entries': entries, 'bytes': path.stat().st_size}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure_streaming(path: str, backend: str, export_file: str) -> Dict[str, Any]:
+    # run in a process of its own
+    started = time.perf_counter()
+    output = SNACrawlerOutput(path, backend)
+    graph = output.export_for_gephi(export_file)
+    return {'seconds': time.perf_counter() - started, 'entries': output.entries_read,
+            'nodes': graph.node_count, 'edges': len(graph), 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _measure_load(path: str, export_file: str) -> Dict[str, Any]:
+    # run in a process of its own, as the analyser did before reading entries one at a time
+    started = time.perf_counter()
+    with open(path, mode='r', encoding='utf-8') as file:
+        data = json.load(file)['data']
+    counts: Dict[str, Dict[str, int]] = {}
+    for entry in data:
+        authors = [author_name(author) for author in entry.get('author') or ()]
+        if len(authors) < 2:
+            continue
+        mates = counts.setdefault(authors[0], {})
+        for other_author in authors[1:]:
+            mates[other_author] = mates.get(other_author, 0) + 1
+    with open(export_file, mode='w', encoding='utf-8') as file:
+        file.write('Source; Target; Weight\n')
+        for author, mates in counts.items():
+            for mate, count in mates.items():
+                file.write(f'{author}; {mate}; {count}\n')
+    return {'seconds': time.perf_counter() - started, 'entries': len(data),
+            'nodes': len(set(counts).union(*counts.values())),
+            'edges': sum(len(mates) for mates in counts.values()), 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _in_process(function: Callable, *arguments) -> Dict[str, Any]:
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, arguments)
+
+
+def run_benchmarks(arguments: argparse.Namespace) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        if arguments.input is not None:
+            path, fixture = Path(arguments.input), {'bytes': Path(arguments.input).stat().st_size}
+        else:
+            path = scratch.joinpath('benchmark.epz')
+            started = time.perf_counter()
+            fixture = write_epz(path, arguments.articles,
+                                None if arguments.target_mb is None else arguments.target_mb << 20,
+                                arguments.authors, arguments.abstract_words, arguments.seed)
+            fixture['seconds'] = time.perf_counter() - started
+
+        results = {}
+        for backend in BACKENDS:
+            results[f'stream_{backend}'] = _in_process(
+                _measure_streaming, str(path), backend, str(scratch.joinpath(f'{backend}.csv')))
+        if arguments.load and fixture['bytes'] <= arguments.load_limit_mb << 20:
+            results['json_load'] = _in_process(_measure_load, str(path), str(scratch.joinpath('load.csv')))
+        for result in results.values():
+            result['mb_per_second'] = fixture['bytes'] / (1 << 20) / result['seconds']
+            result['entries_per_second'] = result['entries'] / result['seconds']
+
+    return {
+        'benchmark': 'epz',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'backends': list(BACKENDS)
+        },
+        'parameters': {key: value for key, value in vars(arguments).items() if key != 'output'},
+        'fixture': fixture,
+        'results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark turning EPZ files into edge lists.')
+    parser.add_argument('--input', type=str, default=None,
+                        help='an existing EPZ file, a synthetic one is generated if not given')
+    parser.add_argument('--articles', type=int, default=None,
+                        help='entries of the synthetic file')
+    parser.add_argument('--target-mb', type=int, default=None,
+                        help='size of the synthetic file, 256 MiB if neither this nor --articles is given')
+    parser.add_argument('--authors', type=int, default=100000,
+                        help='distinct authors of the synthetic file')
+    parser.add_argument('--abstract-words', type=int, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-load', dest='load', action='store_false',
+                        help='skip loading the file as a whole')
+    parser.add_argument('--load-limit-mb', type=int, default=1024,
+                        help='size beyond which the file is not loaded as a whole')
+    parser.add_argument('--output', type=str, default=None,
+                        help='file to write the results to, standard output by default')
+    arguments = parser.parse_args()
+    if arguments.articles is None and arguments.target_mb is None:
+        arguments.target_mb = 256
+
+    serialised = json.dumps(run_benchmarks(arguments), indent=2, ensure_ascii=False)
+    if arguments.output is None:
+        print(serialised)
+    else:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(serialised)
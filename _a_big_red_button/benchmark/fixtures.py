@@ -0,0 +1,167 @@
+"""
+Generates synthetic print lists laid out like the ones served by Web of
+Science, with the same Chinese field names, long citation lists and a
+share of malformed entries, so that parsing can be measured offline.
+
+The same article number always yields the same article for a given
+seed, so print lists of overlapping ranges agree with each other.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import random
+from html import escape
+from typing import *
+
+_JOURNALS = ['NATURE', 'SCIENCE', 'CELL', 'PHYS REV LETT', 'J AM CHEM SOC',
+             'LANCET', 'NEW ENGL J MED', 'ADV MATER', 'NANO LETT', 'ACS NANO']
+_SURNAMES = ['Wang', 'Li', 'Zhang', 'Smith', 'Johnson', 'Mueller', 'Garcia',
+             'Kim', 'Tanaka', 'Rossi', 'Ivanov', 'Nguyen', 'Chen', 'Liu']
+_GIVEN_NAMES = ['Wei', 'Jing', 'John', 'Maria', 'Hiroshi', 'Anna', 'Alexei',
+                'Minh', 'Laura', 'Paolo', 'Xiaoming', 'Sarah']
+_WORDS = ['graphene', 'lattice', 'catalysis', 'quantum', 'protein', 'network',
+          'synthesis', 'transport', 'membrane', 'entropy', 'spectroscopy',
+          'topological', 'dynamics', 'interface', 'oxide', 'polymer']
+_CATEGORIES = ['Chemistry, Multidisciplinary', 'Physics, Applied',
+               'Materials Science, Multidisciplinary', 'Nanoscience & Nanotechnology']
+
+# kinds of malformed entries, each of which the parser has to cope with
+MALFORMED_KINDS = ('no_doi', 'no_title', 'seasonal_year', 'single_citation',
+                   'authorless_citations', 'broken_markup')
+
+
+class FixtureOptions:
+    def __init__(self, seed: int = 0, citations: int = 40,
+                 long_citation_ratio: float = 0.1, long_citations: int = 400,
+                 malformed_ratio: float = 0.05):
+        """
+        :param seed: seed of the generated articles
+        :param citations: average number of citations of an article
+        :param long_citation_ratio: share of articles with a long citation list
+        :param long_citations: number of citations of those articles
+        :param malformed_ratio: share of malformed articles
+        """
+        self.seed = seed
+        self.citations = citations
+        self.long_citation_ratio = long_citation_ratio
+        self.long_citations = long_citations
+        self.malformed_ratio = malformed_ratio
+
+    @property
+    def dict(self):
+        return dict(self.__dict__)
+
+
+def _name(rng: random.Random):
+    surname, given = rng.choice(_SURNAMES), rng.choice(_GIVEN_NAMES)
+    return f'{surname}, {given[0]}', f'{surname}, {given}'
+
+
+def _citation(rng: random.Random, authorless: bool = False):
+    year = rng.randint(1950, 2019)
+    fields = [str(year) if authorless else _name(rng)[0].replace(',', '').upper(),
+              str(year), rng.choice(_JOURNALS),
+              f'V{rng.randint(1, 500)}', f'P{rng.randint(1, 9999)}']
+    if rng.random() < 0.9:
+        fields.append(f'DOI 10.{rng.randint(1000, 9999)}/{rng.randint(10 ** 5, 10 ** 6)}')
+    return ', '.join(fields)
+
+
+def _field(name: str, value: str):
+    return f'<tr><td><b>{escape(name)}:</b><value>{escape(value)}</value></td></tr>'
+
+
+def _text_field(name: str, lines: List[str]):
+    # multi-line fields such as citations are laid out as text separated by line breaks
+    return f'<tr><td><b>{escape(name)}:</b>' + \
+           ''.join(f'<br>{escape(line)}' for line in lines) + '</td></tr>'
+
+
+def generate_article(number: int, options: FixtureOptions = None) -> Tuple[str, Optional[str]]:
+    """
+    Generate the table of one article.
+
+    :param number: number of the article in the search result
+    :param options: options of the fixture
+    :return: the html table, and the kind of malformation if any
+    """
+    options = options or FixtureOptions()
+    rng = random.Random(options.seed * 1000003 + number)
+    malformed = rng.choice(MALFORMED_KINDS) if rng.random() < options.malformed_ratio else None
+
+    authors = [_name(rng) for _ in range(rng.randint(1, 12))]
+    keywords = rng.sample(_WORDS, 5)
+    if rng.random() < options.long_citation_ratio:
+        citation_count = options.long_citations
+    else:
+        citation_count = max(2, int(rng.gauss(options.citations, options.citations / 3)))
+    if malformed == 'single_citation':
+        citation_count = 1
+    citations = [_citation(rng, malformed == 'authorless_citations')
+                 for _ in range(citation_count)]
+    year = str(rng.randint(1990, 2019))
+    journal = rng.choice(_JOURNALS)
+
+    rows = []
+    if malformed != 'no_title':
+        rows.append(_field('标题', ' '.join(rng.choice(_WORDS) for _ in range(8)).capitalize()))
+    rows.extend([
+        _field('作者', '; '.join(f'{abbr} ({full})' for abbr, full in authors)),
+        _field('来源出版物', journal),
+        _field('卷', str(rng.randint(1, 500))),
+        _field('期', str(rng.randint(1, 24))),
+        _field('页', str(rng.randint(1, 9999))),
+        _field('出版年', f'SPR {year}' if malformed == 'seasonal_year' else year),
+        _field('摘要', ' '.join(rng.choice(_WORDS) for _ in range(120))),
+        _field('入藏号', f'WOS:{number:015d}'),
+        _field('语言', 'English'),
+        _field('文献类型', 'Article'),
+        _field('作者关键词', '; '.join(keywords)),
+        _field('KeyWords Plus', '; '.join(word.upper() for word in keywords)),
+        _field('地址', f'[{authors[0][1]}] Univ {rng.choice(_SURNAMES)}, Dept Phys'),
+        _field('通讯作者地址', f'{authors[0][1]} (通讯作者)'),
+        _field('电子邮件地址', f'{authors[0][1].split(",")[0].lower()}@example.edu'),
+        _field('出版商', 'ELSEVIER SCIENCE SA'),
+        _field('出版商地址', 'PO BOX 564, 1001 LAUSANNE, SWITZERLAND'),
+        _field('Web of Science 类别', '; '.join(rng.sample(_CATEGORIES, 2))),
+        _field('研究方向', 'Chemistry; Physics'),
+        _field('IDS 号', f'{rng.randint(100, 999)}XY'),
+        _field('ISSN', f'{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}'),
+        _field('eISSN', f'{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}'),
+        _field('29 字符的来源出版物名称缩写', journal[:29]),
+        _field('ISO 来源出版物缩写', journal.title()),
+        _field('Web of Science 核心合集中的 "被引频次"', str(rng.randint(0, 5000))),
+        _field('被引频次合计', str(rng.randint(0, 5000))),
+        _field('使用次数\n    (最近 180 天)', str(rng.randint(0, 100))),
+        _field('使用次数\n    (2013 年至今)', str(rng.randint(0, 1000))),
+        _field('引用的参考文献数', str(citation_count)),
+        _text_field('引用的参考文献', citations),
+    ])
+    if malformed != 'no_doi':
+        rows.append(_field('DOI', f'10.5555/wok.{options.seed}.{number}'))
+
+    table = '<table>' + ''.join(rows) + '</table>'
+    if malformed == 'broken_markup':
+        # leave some tags unclosed and some closed without being opened,
+        # the damage stays within the table like it does on the live site
+        table = table.replace('</value>', '', 3).replace('</b>', '</b></i>', 2)
+    return table, malformed
+
+
+def generate_print_list(start: int, end: int, options: FixtureOptions = None) -> str:
+    """Generate the html of the print list of articles numbered [start -> end]."""
+    tables = [generate_article(number, options)[0] for number in range(start, end + 1)]
+    return '<html><head><meta charset="UTF-8"><title>Web of Science</title></head><body>' \
+           '<form id="printForm" name="printForm">' \
+           '<table cellpadding="0"><tr><td>Web of Science 核心合集</td></tr></table>' + \
+           ''.join(tables) + '</form></body></html>'
+
+
+def malformed_kinds(start: int, end: int, options: FixtureOptions = None) -> Dict[str, int]:
+    """Count the malformed articles among [start -> end] by kind."""
+    counts: Dict[str, int] = {}
+    for number in range(start, end + 1):
+        malformed = generate_article(number, options)[1]
+        if malformed is not None:
+            counts[malformed] = counts.get(malformed, 0) + 1
+    return counts
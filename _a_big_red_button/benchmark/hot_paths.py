@@ -0,0 +1,250 @@
+"""
+Benchmarks the hot paths of crawling, i.e. parsing print lists, validating
+and exporting articles, wrapping them as documents and inserting them into
+a session, against synthetic print lists. Results are written as JSON and
+may be compared against those of an earlier run to catch regressions.
+
+Run with:
+
+    python -m _a_big_red_button.benchmark.hot_paths --output baseline.json
+    python -m _a_big_red_button.benchmark.hot_paths --baseline baseline.json
+
+Inserts go to an in-memory stand-in of a session collection unless --mongo
+is given, in which case a scratch session of the configured database is
+used and dropped afterwards.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+from io import StringIO
+from typing import *
+
+from bson import ObjectId
+from lxml import etree
+from pymongo.errors import BulkWriteError
+from pymongo.results import InsertManyResult
+
+from _a_big_red_button.benchmark.fixtures import FixtureOptions, generate_print_list, malformed_kinds
+from _a_big_red_button.crawler.db import WokPersistentStorage, WokPersistentSession
+from _a_big_red_button.crawler.db_article import WokArticleStub
+from _a_big_red_button.crawler.print_list import WoKPrintList, WoKPrintArticle
+
+# term of the scratch session used with --mongo
+BENCHMARK_TERM = '__hot_path_benchmark__'
+
+
+class InMemoryCollection:
+    """Stands in for a session collection, with the unique index on DOI."""
+
+    def __init__(self):
+        self.documents: Dict[str, dict] = {}
+
+    def insert_many(self, documents: List[dict], ordered: bool = True):
+        inserted_ids, write_errors = [], []
+        for index, document in enumerate(documents):
+            if document.get('doi') in self.documents:
+                write_errors.append({'index': index, 'code': 11000, 'errmsg': 'duplicate key'})
+                if ordered:
+                    break
+                continue
+            document.setdefault('_id', ObjectId())
+            self.documents[document.get('doi')] = document
+            inserted_ids.append(document['_id'])
+        if write_errors:
+            raise BulkWriteError({'writeErrors': write_errors, 'nInserted': len(inserted_ids)})
+        return InsertManyResult(inserted_ids, True)
+
+    def delete_many(self, _filter: dict):
+        self.documents.clear()
+
+
+class InMemorySession:
+    """Runs the insert of a persistent session against an in-memory collection."""
+    insert_many = WokPersistentSession.insert_many
+
+    def __init__(self):
+        self.collection = InMemoryCollection()
+
+
+def measure(function: Callable[[Any], Any], repeat: int, items: int,
+            setup: Callable[[], Any] = None, warmup: int = 1) -> Dict[str, float]:
+    """
+    Time a function a number of times, the setup is called before each run
+    and its result is handed to the function, it is not timed.
+
+    :param items: number of items processed by each run, for throughput
+    """
+    timings = []
+    for run in range(warmup + repeat):
+        argument = None if setup is None else setup()
+        started = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - started
+        if run >= warmup:
+            timings.append(elapsed)
+    median = statistics.median(timings)
+    return {
+        'repeat': repeat,
+        'items': items,
+        'min_seconds': min(timings),
+        'median_seconds': median,
+        'mean_seconds': statistics.mean(timings),
+        'max_seconds': max(timings),
+        'stdev_seconds': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'items_per_second': items / median if median > 0 else None
+    }
+
+
+def run_benchmarks(arguments: argparse.Namespace) -> Dict[str, Any]:
+    options = FixtureOptions(arguments.seed, arguments.citations,
+                             arguments.long_citation_ratio, arguments.long_citations,
+                             arguments.malformed_ratio)
+    ranges = [(i * arguments.articles + 1, (i + 1) * arguments.articles)
+              for i in range(arguments.print_lists)]
+    sources = [(generate_print_list(start, end, options), start, end) for start, end in ranges]
+    year_range = range(arguments.year_start, arguments.year_end + 1)
+
+    # prepare the inputs of every stage from the outputs of the previous one
+    print_lists = [WoKPrintList(StringIO(html), start, end) for html, start, end in sources]
+    articles: List[WoKPrintArticle] = [article for print_list in print_lists
+                                       for article in print_list.find_all_articles(year_range)]
+    documents = [article.as_export_dict() for article in articles]
+    stubs = [WokArticleStub(document) for document in documents]
+    article_count = len(ranges) * arguments.articles
+
+    results = {
+        'print_list_parse': measure(
+            lambda _: [WoKPrintList(StringIO(html), start, end) for html, start, end in sources],
+            arguments.repeat, len(sources)),
+        'find_all_articles': measure(
+            lambda _: [list(WoKPrintList(StringIO(html), start, end).find_all_articles(year_range))
+                       for html, start, end in sources],
+            arguments.repeat, article_count),
+        'validate_attributes': measure(
+            lambda _: [article.validate_attributes() for article in articles],
+            arguments.repeat, len(articles)),
+        'as_export_dict': measure(
+            lambda _: [article.as_export_dict() for article in articles],
+            arguments.repeat, len(articles)),
+        'document_wrap': measure(
+            lambda _: [WokArticleStub(document) for document in documents],
+            arguments.repeat, len(documents)),
+        'document_serialise': measure(
+            lambda _: [stub.dict for stub in stubs],
+            arguments.repeat, len(stubs)),
+    }
+
+    if arguments.mongo:
+        session = WokPersistentStorage()[BENCHMARK_TERM]
+    else:
+        session = InMemorySession()
+    try:
+        def fresh_documents():
+            # inserting adds an _id to every document, so each run gets its own copies
+            session.collection.delete_many({})
+            return copy.deepcopy(documents)
+
+        def inserted_documents():
+            # every document of the run already exists and is rejected as duplicate
+            session.collection.delete_many({})
+            session.insert_many(copy.deepcopy(documents))
+            return copy.deepcopy(documents)
+
+        results['insert_many'] = measure(
+            session.insert_many, arguments.repeat, len(documents), fresh_documents)
+        results['insert_many_duplicates'] = measure(
+            session.insert_many, arguments.repeat, len(documents), inserted_documents)
+    finally:
+        if arguments.mongo:
+            session.drop()
+
+    return {
+        'benchmark': 'hot_paths',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+            'store': 'mongo' if arguments.mongo else 'memory'
+        },
+        'parameters': {
+            'articles_per_print_list': arguments.articles,
+            'print_lists': arguments.print_lists,
+            'repeat': arguments.repeat,
+            'year_range': [year_range.start, year_range.stop - 1],
+            'fixture': options.dict
+        },
+        'fixture': {
+            'bytes': sum(len(html.encode('utf-8')) for html, _, _ in sources),
+            'articles': article_count,
+            'valid_articles': len(articles),
+            'citations': sum(len(document.get('citation') or []) for document in documents),
+            'malformed': malformed_kinds(1, article_count, options)
+        },
+        'results': results
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """List the benchmarks whose median got slower than the baseline by more than the tolerance."""
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline.get('results', {}):
+            continue
+        before = baseline['results'][name]['median_seconds']
+        after = result['median_seconds']
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({'benchmark': name,
+                                'baseline_median_seconds': before,
+                                'median_seconds': after,
+                                'slowdown': after / before})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parsing and persisting print lists.')
+    parser.add_argument('--articles', type=int, default=50,
+                        help='articles per print list, the crawler requests 50 at a time')
+    parser.add_argument('--print-lists', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--citations', type=int, default=40,
+                        help='average number of citations of an article')
+    parser.add_argument('--long-citation-ratio', type=float, default=0.1)
+    parser.add_argument('--long-citations', type=int, default=400)
+    parser.add_argument('--malformed-ratio', type=float, default=0.05)
+    parser.add_argument('--year-start', type=int, default=2000)
+    parser.add_argument('--year-end', type=int, default=2019)
+    parser.add_argument('--mongo', action='store_true',
+                        help='insert into a scratch session of the configured database')
+    parser.add_argument('--output', type=str, default=None,
+                        help='file to write the results to, standard output by default')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown of the median tolerated before reporting a regression')
+    arguments = parser.parse_args()
+
+    report = run_benchmarks(arguments)
+    if arguments.baseline is not None:
+        with open(arguments.baseline, encoding='utf-8') as baseline_file:
+            report['regressions'] = compare(report, json.load(baseline_file), arguments.tolerance)
+
+    serialised = json.dumps(report, indent=2, ensure_ascii=False)
+    if arguments.output is None:
+        print(serialised)
+    else:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(serialised)
+
+    # fail when regressions are found, so that this can be used as a check
+    sys.exit(1 if report.get('regressions') else 0)
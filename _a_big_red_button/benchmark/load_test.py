@@ -0,0 +1,155 @@
+"""
+Drives the crawler end to end against the stub of Web of Science, once
+for every given number of print list workers, and reports throughput
+against worker count as JSON.
+
+Run with:
+
+    python -m _a_big_red_button.benchmark.load_test --workers 1 2 4 8 --latency 0.5
+
+A stub server is started in process unless --url points at one already
+running. Crawled articles go through the write-behind writer into an
+in-memory session, or into a scratch session of the configured database
+with --mongo.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import time
+import urllib.request
+from typing import *
+
+from _a_big_red_button.benchmark.hot_paths import InMemorySession
+from _a_big_red_button.benchmark.wok_stub import start_stub_server, add_stub_arguments, \
+    stub_options_from_arguments, STATS_PATH
+from _a_big_red_button.crawler.core import WokSearch, override_url_base
+from _a_big_red_button.crawler.db import WokPersistentStorage
+from _a_big_red_button.crawler.db_writer import WokPersistentSessionWriter
+
+# term of the scratch session used with --mongo
+LOAD_TEST_TERM = '__load_test__'
+
+
+class InMemoryLoadTestSession(InMemorySession):
+    session_id = LOAD_TEST_TERM
+
+
+def stub_statistics(base_url: str) -> Dict[str, int]:
+    with urllib.request.urlopen(base_url + STATS_PATH) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def crawl_once(term: str, end: int, workers: int, intermission: float,
+               mongo: bool, base_url: str) -> Dict[str, Any]:
+    """Search and crawl [1 -> end] like the crawler of the controller does."""
+    statistics_before = stub_statistics(base_url)
+    started = time.perf_counter()
+    result = WokSearch.make_new_search().search(term)
+    searched = time.perf_counter()
+
+    session = WokPersistentStorage()[LOAD_TEST_TERM] if mongo else InMemoryLoadTestSession()
+    writer = WokPersistentSessionWriter(session)
+    writer.start()
+    print_lists, articles = 0, 0
+    try:
+        for print_list in result.request_all_print_lists(1, end, workers, intermission):
+            print_lists += 1
+            for article in print_list.find_all_articles():
+                articles += 1
+                writer.put(article)
+        writer.close()
+    finally:
+        if mongo:
+            session.drop()
+    finished = time.perf_counter()
+
+    statistics_after = stub_statistics(base_url)
+    crawl_seconds = finished - searched
+    return {
+        'workers': workers,
+        'search_seconds': searched - started,
+        'crawl_seconds': crawl_seconds,
+        'print_lists': print_lists,
+        'articles': articles,
+        'articles_written': writer.stats['documents'],
+        'articles_per_second': articles / crawl_seconds if crawl_seconds > 0 else None,
+        'print_lists_per_second': print_lists / crawl_seconds if crawl_seconds > 0 else None,
+        'writer': writer.stats,
+        'stub': {name: statistics_after.get(name, 0) - statistics_before.get(name, 0)
+                 for name in statistics_after}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the crawler against a stub of Web of Science.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='numbers of print list workers to try')
+    parser.add_argument('--articles', type=int, default=1000,
+                        help='articles crawled by every run')
+    parser.add_argument('--intermission', type=float, default=0,
+                        help='seconds every worker waits between requests')
+    parser.add_argument('--term', type=str, default='TS=(load test)')
+    parser.add_argument('--url', type=str, default=None,
+                        help='base url of a running stub server, one is started otherwise')
+    parser.add_argument('--mongo', action='store_true',
+                        help='write into a scratch session of the configured database')
+    parser.add_argument('--no-warmup', action='store_true',
+                        help='skip the unmeasured first crawl which fills the page cache of the stub')
+    parser.add_argument('--output', type=str, default=None,
+                        help='file to write the results to, standard output by default')
+    add_stub_arguments(parser)
+    arguments = parser.parse_args()
+    if arguments.results is None:
+        arguments.results = arguments.articles
+
+    stub = None
+    base_url = arguments.url
+    if base_url is None:
+        stub = start_stub_server(options=stub_options_from_arguments(arguments))
+        base_url = stub.base_url
+    override_url_base(base_url)
+
+    try:
+        if not arguments.no_warmup:
+            crawl_once(arguments.term, arguments.articles, max(arguments.workers),
+                       arguments.intermission, arguments.mongo, base_url)
+        runs = [crawl_once(arguments.term, arguments.articles, workers, arguments.intermission,
+                           arguments.mongo, base_url)
+                for workers in arguments.workers]
+    finally:
+        if stub is not None:
+            stub.shutdown()
+            stub.server_close()
+
+    report = {
+        'benchmark': 'load_test',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'store': 'mongo' if arguments.mongo else 'memory',
+            'stub': base_url
+        },
+        'parameters': {
+            'articles': arguments.articles,
+            'intermission': arguments.intermission,
+            'latency': arguments.latency,
+            'jitter': arguments.jitter,
+            'error_rate': arguments.error_rate,
+            'max_rps': arguments.max_rps,
+            'max_concurrent': arguments.max_concurrent,
+            'sid_print_lists': arguments.sid_print_lists
+        },
+        'runs': runs
+    }
+
+    serialised = json.dumps(report, indent=2)
+    if arguments.output is None:
+        print(serialised)
+    else:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(serialised)
@@ -0,0 +1,309 @@
+"""
+Implements a stub of Web of Science serving the urls configured in
+crawler.yaml, i.e. the index redirecting to a url with a fresh SID, the
+advanced search answering with a hit count, and print lists of synthetic
+articles, so that the crawler can be driven end to end without the live
+site. Latency, errors and throttling are configurable.
+
+Start it with:
+
+    python -m _a_big_red_button.benchmark.wok_stub --port 8765 --latency 0.2
+
+and point the crawler at it with `url_base_override` in crawler.yaml.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+from urllib.parse import urlsplit, parse_qs
+
+from _a_big_red_button.benchmark.fixtures import FixtureOptions, generate_print_list
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.lru_cache import LRUCache
+
+# get config
+_config = get_config('crawler')
+
+# paths of the configured urls
+INDEX_PATH = urlsplit(_config.url.index).path or '/'
+SEARCH_PATH = urlsplit(_config.url.search).path
+PRINT_LIST_PATH = urlsplit(_config.url.print_list).path
+SEARCH_INPUT_PATH = '/WOS_GeneralSearch_input.do'
+STATS_PATH = '/__stub__/stats'
+
+
+class WokStubOptions:
+    def __init__(self, result_count: int = None, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, max_requests_per_second: float = 0,
+                 max_concurrent_requests: int = 0, sid_print_lists: int = 0,
+                 fixture: FixtureOptions = None):
+        """
+        :param result_count: hits of every search, derived from the term if not given
+        :param latency: seconds every response is delayed by
+        :param jitter: maximum seconds added to or taken from the latency at random
+        :param error_rate: share of requests answered with an internal server error
+        :param max_requests_per_second: requests beyond this rate are answered with 429, 0 for no limit
+        :param max_concurrent_requests: requests beyond this number are answered with 503, 0 for no limit
+        :param sid_print_lists: print lists after which a SID expires, 0 for never
+        :param fixture: options of the generated articles
+        """
+        self.result_count = result_count
+        self.latency, self.jitter = latency, jitter
+        self.error_rate = error_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.max_concurrent_requests = max_concurrent_requests
+        self.sid_print_lists = sid_print_lists
+        self.fixture = fixture or FixtureOptions()
+
+
+class WokStubStatistics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counts: Dict[str, int] = {}
+
+    def count(self, name: str):
+        with self.__lock:
+            self.__counts[name] = self.__counts.get(name, 0) + 1
+
+    @property
+    def dict(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__counts)
+
+
+class WokStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], options: WokStubOptions = None):
+        super().__init__(address, WokStubRequestHandler)
+        self.options = options or WokStubOptions()
+        self.statistics = WokStubStatistics()
+        self.searches: Dict[str, Tuple[str, int]] = {}  # sid -> (term, result count)
+        self.served: Dict[str, int] = {}  # sid -> print lists served
+        self.pages = LRUCache(256)
+        self.__lock = threading.Lock()
+        self.__concurrent = 0
+        self.__window_start = time.monotonic()
+        self.__window_requests = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def enter(self) -> Optional[int]:
+        """
+        Admit a request, returns the status to refuse it with if it is throttled.
+        """
+        with self.__lock:
+            options = self.options
+            if options.max_concurrent_requests and \
+                    self.__concurrent >= options.max_concurrent_requests:
+                return 503
+            if options.max_requests_per_second:
+                now = time.monotonic()
+                if now - self.__window_start >= 1:
+                    self.__window_start, self.__window_requests = now, 0
+                if self.__window_requests >= options.max_requests_per_second:
+                    return 429
+                self.__window_requests += 1
+            self.__concurrent += 1
+            return None
+
+    def leave(self):
+        with self.__lock:
+            self.__concurrent -= 1
+
+    def new_search_id(self) -> str:
+        sid = uuid.uuid4().hex[:20].upper()
+        with self.__lock:
+            self.searches[sid] = ('', 0)
+        return sid
+
+    def search(self, sid: str, term: str) -> Optional[int]:
+        with self.__lock:
+            if sid not in self.searches:
+                return None
+            count = self.options.result_count
+            if count is None:
+                count = 100 + zlib.crc32(term.encode('utf-8')) % 5000
+            self.searches[sid] = (term, count)
+            return count
+
+    def is_alive(self, sid: str) -> bool:
+        with self.__lock:
+            return sid in self.searches
+
+    def print_list(self, sid: str, start: int, end: int) -> Optional[str]:
+        with self.__lock:
+            term, count = self.searches.get(sid, (None, 0))
+            if term and self.options.sid_print_lists:
+                self.served[sid] = self.served.get(sid, 0) + 1
+                if self.served[sid] > self.options.sid_print_lists:
+                    del self.searches[sid], self.served[sid]
+                    self.statistics.count('expired')
+                    term = None
+        if not term:
+            return None
+        end = min(end, count)
+        key = (term, start, end)
+        page = self.pages.get(key)
+        if page is None:
+            # articles of different terms differ, those of the same term never do
+            fixture = self.options.fixture
+            options = FixtureOptions(zlib.crc32(term.encode('utf-8')), fixture.citations,
+                                     fixture.long_citation_ratio, fixture.long_citations,
+                                     fixture.malformed_ratio)
+            page = generate_print_list(start, end, options)
+            self.pages.put(key, page)
+        return page
+
+
+class WokStubRequestHandler(BaseHTTPRequestHandler):
+    server: WokStubServer
+
+    def log_message(self, format, *args):
+        pass  # far too many requests to log each
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method: str):
+        url = urlsplit(self.path)
+        if url.path == STATS_PATH:
+            return self.respond(200, json.dumps(self.server.statistics.dict), 'application/json')
+
+        refusal = self.server.enter()
+        if refusal is not None:
+            self.server.statistics.count(f'throttled_{refusal}')
+            return self.respond(refusal, 'too many requests')
+        try:
+            options = self.server.options
+            delay = options.latency + random.uniform(-options.jitter, options.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if random.random() < options.error_rate:
+                self.server.statistics.count('errors')
+                return self.respond(500, 'internal server error')
+
+            query = parse_qs(url.query)
+            if method == 'GET' and url.path == INDEX_PATH:
+                self.server.statistics.count('index')
+                sid = self.server.new_search_id()
+                return self.redirect(f'{SEARCH_INPUT_PATH}?product=WOS&'
+                                     f'search_mode=GeneralSearch&SID={sid}')
+            if method == 'GET' and url.path == SEARCH_INPUT_PATH:
+                if not self.server.is_alive(query.get('SID', [''])[0]):
+                    return self.respond(200, '<html><body>Session expired</body></html>')
+                return self.respond(200, '<html><body>search</body></html>')
+            if method == 'POST' and url.path == SEARCH_PATH:
+                self.server.statistics.count('search')
+                return self.serve_search()
+            if method == 'GET' and url.path == PRINT_LIST_PATH:
+                self.server.statistics.count('print_list')
+                return self.serve_print_list(query)
+            self.server.statistics.count('not_found')
+            return self.respond(404, 'not found')
+        finally:
+            self.server.leave()
+
+    def serve_search(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        sid = form.get('SID', [''])[0]
+        term = form.get('value(input1)', [''])[0]
+        count = self.server.search(sid, term)
+        if count is None:
+            return self.respond(200, '<html><body><div id="searchErrorMessage">'
+                                     '<div class="errorText">Your session has expired'
+                                     '</div></div></body></html>')
+        return self.respond(200, f'<html><body><a id="hitCount" href="/summary.do?product=WOS&'
+                                 f'qid=1&SID={sid}&search_mode=AdvancedSearch">'
+                                 f'{count:,}</a><div>{escape(term)}</div></body></html>')
+
+    def serve_print_list(self, query: Dict[str, List[str]]):
+        try:
+            sid = query['SID'][0]
+            start, end = int(query['mark_from'][0]), int(query['mark_to'][0])
+        except (KeyError, ValueError):
+            return self.respond(400, 'bad request')
+        page = self.server.print_list(sid, start, end)
+        if page is None:
+            return self.respond(200, '<html><body>Session expired</body></html>')
+        return self.respond(200, page)
+
+    def redirect(self, location: str):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, status: int, body: str, content_type: str = 'text/html; charset=UTF-8'):
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_stub_server(host: str = '127.0.0.1', port: int = 0,
+                      options: WokStubOptions = None) -> WokStubServer:
+    """Start a stub server serving on a daemon thread, port 0 picks a free port."""
+    server = WokStubServer((host, port), options)
+    thread = threading.Thread(target=server.serve_forever, name='wok-stub', daemon=True)
+    thread.start()
+    return server
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--results', type=int, default=None,
+                        help='hits of every search, derived from the term by default')
+    parser.add_argument('--latency', type=float, default=0.0, help='in second')
+    parser.add_argument('--jitter', type=float, default=0.0, help='in second')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help='requests per second beyond which 429 is returned, 0 for no limit')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='concurrent requests beyond which 503 is returned, 0 for no limit')
+    parser.add_argument('--sid-print-lists', type=int, default=0,
+                        help='print lists after which a SID expires, 0 for never')
+    parser.add_argument('--citations', type=int, default=40)
+    parser.add_argument('--malformed-ratio', type=float, default=0.05)
+
+
+def stub_options_from_arguments(arguments: argparse.Namespace) -> WokStubOptions:
+    return WokStubOptions(arguments.results, arguments.latency, arguments.jitter,
+                          arguments.error_rate, arguments.max_rps, arguments.max_concurrent,
+                          arguments.sid_print_lists,
+                          FixtureOptions(citations=arguments.citations,
+                                         malformed_ratio=arguments.malformed_ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a stub of Web of Science.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_stub_arguments(parser)
+    arguments = parser.parse_args()
+
+    stub = WokStubServer((arguments.host, arguments.port), stub_options_from_arguments(arguments))
+    print(f'serving a stub of Web of Science at {stub.base_url}')
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server_close()
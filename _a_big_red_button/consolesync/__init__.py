@@ -9,14 +9,16 @@ Kevin Ni, kevin.ni@nyu.edu.
 from queue import Queue, Empty
 from threading import Lock, Thread
 from typing import List
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from logging import LogRecord
-from _a_big_red_button.support.log import BufferedHandler
+from _a_big_red_button.support.log import RingBufferHandler
+from _a_big_red_button.support.event_stream import EVENT_CHANNEL, Event
 from _a_big_red_button.support.response import *
 
 
-# create the buffered handler
-CONSOLE_SYNC_HANDLER = BufferedHandler(1000)
+# create the ring buffer handler, shared by every client
+# records are also pushed to clients listening to the event stream
+CONSOLE_SYNC_HANDLER = RingBufferHandler(1000, EVENT_CHANNEL)
 
 
 # class LogCollectingThread(Thread):
@@ -43,10 +45,30 @@ CONSOLE_SYNC_HANDLER = BufferedHandler(1000)
 # __COLLECTING_THREAD = LogCollectingThread()
 
 
+def _parse_seq(value) -> int:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
 def extract_logs():
-    return good(new_logs=list(record.getMessage() for record in CONSOLE_SYNC_HANDLER.extract_all()))
+    records, seq = CONSOLE_SYNC_HANDLER.read_since(_parse_seq(request.args.get('since')))
+    return good(new_logs=[record.message for record in records], seq=seq)
+
+
+def stream_events():
+    # a reconnecting client tells us the last log line it has seen
+    replay = []
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id is not None:
+        records, _ = CONSOLE_SYNC_HANDLER.read_since(_parse_seq(last_event_id))
+        replay = [Event('log', {'message': record.message}, record.seq) for record in records]
+    return Response(EVENT_CHANNEL.stream(replay=replay), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 def register_console_sync(app: Flask):
     # __COLLECTING_THREAD.start()
     app.route('/poll/log/')(extract_logs)
+    app.route('/stream/events/')(stream_events)
@@ -7,18 +7,29 @@ Kevin Ni, kevin.ni@nyu.edu.
 import sys
 import threading
 from pathlib import Path
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
 
 from _a_big_red_button.crawler.controller import Wok
+from _a_big_red_button.crawler.scheduler import WokCrawlScheduler, WokCrawlJob
 from _a_big_red_button.crawler.db import WokPersistentStorage, WokPersistentSession
+from _a_big_red_button.crawler.db_job import WokJobHeartbeat
 from _a_big_red_button.crawler.db_meta import WokPersistentSessionMeta
 from _a_big_red_button.support.select_file import select_file
 from _a_big_red_button.crawler.export_script_helper import available_export_scripts, get_export_script
-from _a_big_red_button.crawler.export_worker import WokPersistentSessionExportScriptThreadedRunner
 from _a_big_red_button.support.response import good, bad
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.support.configuration import get_config
 from _a_big_red_button.crawler.db_search import search_in_all_sessions
+from _a_big_red_button.support.mongo_db import POOL_MONITOR, CLIENT_OPTIONS
+from _a_big_red_button.support.metrics import REGISTRY
+from _a_big_red_button.crawler.crawl_metrics import summarise as summarise_metrics
+from _a_big_red_button.crawler.search_cache import WokSearchCache
+from _a_big_red_button.crawler.session_pool import WokSessionPool
+from _a_big_red_button.crawler.author_names import cache_stats as author_name_cache_stats
+from _a_big_red_button.crawler.export_sink import SINKS as EXPORT_SINKS, file_types as export_file_types
+from _a_big_red_button.crawler.export_executor import WokExportExecutor
+from _a_big_red_button.crawler.session_metrics import WokSessionMetrics
+from _a_big_red_button.crawler.session_snapshot import WokSessionSnapshotter
 
 # prepare logger
 logger = get_logger('controller-front')
@@ -47,27 +58,37 @@ def command_search():
     logger.debug("search has been reset and you may search again")
 
     args = request.get_json(force=True)
-    Wok().search(args['term'])
-    return good()
+    job = Wok().search(args['term'])
+    return good(job_id=job.job_id)
 
 
 def poll_crawling_progress():
     if Wok().is_crawling:
         return good(finished=Wok().crawling_progress,
-                    total=Wok().crawling_total_count)
+                    total=Wok().crawling_total_count,
+                    articles_per_second=round(Wok().crawling_rate, 2),
+                    metrics=summarise_metrics())
     if Wok().crawling_done:
         if Wok().crawling_went_wrong:
             return bad("crawling failed, consider reset and crawl again")
         return good(finished=-1,
-                    total=Wok().crawling_total_count)  # all done
+                    total=Wok().crawling_total_count,
+                    metrics=summarise_metrics())  # all done
     return bad("cannot poll crawling progress in this state: "
                "have you started crawling?")
 
 
+def parse_year_range(args: dict):
+    year_start, year_end = int(args.get('year_start', 0)), int(args.get('year_end', 0))
+    if year_start <= 0 or year_end <= 0 or year_end < year_start:
+        return None
+    return range(year_start, year_end + 1)
+
+
 def command_crawl():
     if not Wok().can_crawl:
         return bad("cannot start crawling in this state: "
-                   "either you have not searched or a crawler is working already")
+                   "have you searched?")
 
     # reset crawler
     Wok().reset_crawl()
@@ -76,14 +97,31 @@ def command_crawl():
     # parse arguments
     args = request.get_json(force=True)
     start, end = int(args['start']), int(args['end'])
-    year_start, year_end = int(args['year_start']), int(args['year_end'])
-    if year_start <= 0 or year_end <= 0 or year_end < year_start:
-        year_range = None
-    else:
-        year_range = range(year_start, year_end + 1)
+    job = Wok().crawl(start, end, parse_year_range(args), profile=args.get('profile', None))
+    return good(job_id=job.job_id)
+
+
+def command_submit_crawl_job():
+    args = request.get_json(force=True)
+    if not args.get('term', '').strip():
+        return bad("invalid request: missing field 'term'")
+
+    job = WokCrawlScheduler().submit(WokCrawlJob(
+        args['term'], int(args.get('start', 0)), int(args.get('end', 0)),
+        parse_year_range(args), distributed=args.get('distributed', None),
+        profile=args.get('profile', None)))
+    return good(job_id=job.job_id)
 
-    Wok().crawl(start, end, year_range)
-    return good()
+
+def poll_crawl_jobs():
+    return good(jobs=[job.dict for job in WokCrawlScheduler().jobs])
+
+
+def poll_crawl_job(job_id: str):
+    job = WokCrawlScheduler().job(job_id)
+    if job is None:
+        return bad(f"no such crawl job(id={job_id})")
+    return good(**job.dict)
 
 
 def command_reset():
@@ -140,6 +178,26 @@ def drop_session():
                    f"manually patch the database")
 
 
+def poll_db_pool_stats():
+    return good(pools=POOL_MONITOR.stats, options=CLIENT_OPTIONS)
+
+
+def poll_search_cache_stats():
+    return good(**WokSearchCache().stats)
+
+
+def poll_session_pool_stats():
+    return good(**WokSessionPool().stats)
+
+
+def poll_name_cache_stats():
+    return good(**author_name_cache_stats())
+
+
+def serve_metrics():
+    return Response(REGISTRY.exposition(), mimetype='text/plain; version=0.0.4')
+
+
 def render_sessions_page():
     persistent_manager = WokPersistentStorage()
     available_sessions = persistent_manager.all_sessions
@@ -169,9 +227,14 @@ def export_session():
         return bad(f"invalid request: "
                    f"no export script with name={export_script_name}")
 
+    export_format = parameters.get('format', None)
+    if export_format is not None and export_format not in EXPORT_SINKS:
+        return bad(f"invalid request: "
+                   f"format {export_format} is not one of {', '.join(EXPORT_SINKS)}")
+
     # request user to select the export file
     export_file = select_file('Select the export file',
-                              ('SNA Export File', "*.csv"),
+                              *export_file_types(),
                               ('Any File', "*.*"))
     if export_file is None:
         return bad("cannot run the export because export file could not "
@@ -180,14 +243,145 @@ def export_session():
     # start the export process and respond to the client
     logger.info(f"started exporting session(id={session_id}) "
                 f"with script(name={export_script_name})")
-    export_threaded_runner = WokPersistentSessionExportScriptThreadedRunner(
-        export_script,
-        session,
-        Path(export_file)
-    )
-    export_threaded_runner.daemon = True
-    export_threaded_runner.start()
-    return good(message="exporting now...")
+    # profiled exports are run in this process rather than in the pool
+    job = WokExportExecutor().submit(session, export_script, Path(export_file), export_format,
+                                     profile=parameters.get('profile', None),
+                                     incremental=parameters.get('incremental', None))
+    return good(message="exporting now...", job_id=job.job_id)
+
+
+def poll_export_jobs():
+    return good(jobs=[job.dict for job in WokExportExecutor().jobs])
+
+
+def poll_export_job(job_id: str):
+    job = WokExportExecutor().job(job_id)
+    if job is None:
+        return bad(f"no such export job(id={job_id})")
+    return good(**job.dict)
+
+
+def command_cancel_export():
+    parameters = request.get_json(force=True)
+    if 'job_id' not in parameters:
+        return bad("invalid request: missing field 'job_id'")
+    job = WokExportExecutor().job(parameters['job_id'])
+    if job is None:
+        return bad(f"no such export job(id={parameters['job_id']})")
+    if not job.cancel():
+        return bad(f"export job(id={job.job_id}) has already finished", **job.dict)
+    return good(**job.dict)
+
+
+def _session_and_script(session_id: str, export_script_name: str):
+    session = WokPersistentSession.find_by_session_id(session_id)
+    if session is None:
+        return None, bad(f"invalid request: no session with id={session_id}")
+    export_script = get_export_script(export_script_name)
+    if export_script is None:
+        return None, bad(f"invalid request: no export script with name={export_script_name}")
+    return (session, export_script), None
+
+
+def command_analyse_session():
+    parameters = request.get_json(force=True)
+    if 'session_id' not in parameters or 'export_script' not in parameters:
+        return bad("invalid request: "
+                   "missing field 'session_id' or 'export_script'")
+    found, error = _session_and_script(parameters['session_id'], parameters['export_script'])
+    if error is not None:
+        return error
+    session, export_script = found
+    if not hasattr(export_script.script, 'build'):
+        return bad(f"cannot analyse with export script {export_script.name}: it builds no graph")
+    WokSessionMetrics().submit(session, export_script, bool(parameters.get('refresh', False)))
+    return good(message="analysing now...")
+
+
+def poll_session_metrics(session_id: str, export_script_name: str):
+    found, error = _session_and_script(session_id, export_script_name)
+    if error is not None:
+        return error
+    session, export_script = found
+    analysis = WokSessionMetrics().analysis(session_id, export_script_name)
+    if analysis is not None and not analysis.done():
+        return good(finished=False)
+
+    # more top nodes than summarised are read from the metrics of every node
+    top = request.args.get('top', None, type=int)
+    if top is not None:
+        metrics = WokSessionMetrics().cached(session, export_script)
+        summary = None if metrics is None else dict(
+            metrics.summary, top={metric: metrics.top(metric, top) for metric in metrics.summary['top']})
+    else:
+        summary = WokSessionMetrics().summary(session, export_script)
+    if summary is not None:
+        return good(finished=True, **summary)
+    if analysis is not None and analysis.exception() is not None:
+        return bad(f"analysis failed: {analysis.exception()}")
+    return bad(f"session(id={session_id}) has not been analysed with "
+               f"{export_script_name} since it last changed")
+
+
+def command_snapshot_session():
+    parameters = request.get_json(force=True)
+    if 'session_id' not in parameters:
+        return bad("invalid request: missing field 'session_id'")
+    session = WokPersistentSession.find_by_session_id(parameters['session_id'])
+    if session is None:
+        return bad(f"invalid request: no session with id={parameters['session_id']}")
+    WokSessionSnapshotter().submit(session)
+    return good(message="taking snapshot now...")
+
+
+def poll_session_snapshot(session_id: str):
+    session = WokPersistentSession.find_by_session_id(session_id)
+    if session is None:
+        return bad(f"invalid request: no session with id={session_id}")
+    return good(**WokSessionSnapshotter().status(session))
+
+
+def command_export_batch():
+    parameters = request.get_json(force=True)
+    if not parameters.get('export_scripts'):
+        return bad("invalid request: missing field 'export_scripts'")
+
+    # every session is exported if none is given
+    if parameters.get('session_ids'):
+        sessions = [WokPersistentSession.find_by_session_id(session_id)
+                    for session_id in parameters['session_ids']]
+        if any(session is None for session in sessions):
+            missing = [session_id for session_id, session in zip(parameters['session_ids'], sessions)
+                       if session is None]
+            return bad(f"invalid request: no session with id={', '.join(missing)}")
+    else:
+        sessions = list(WokPersistentStorage().all_sessions)
+
+    export_scripts = [get_export_script(name) for name in parameters['export_scripts']]
+    if any(export_script is None for export_script in export_scripts):
+        return bad(f"invalid request: no export script with name="
+                   f"{', '.join(parameters['export_scripts'])}")
+
+    export_format = parameters.get('format', None)
+    if export_format is not None and export_format not in EXPORT_SINKS:
+        return bad(f"invalid request: "
+                   f"format {export_format} is not one of {', '.join(EXPORT_SINKS)}")
+
+    directory = parameters.get('directory', None)
+    batch_id, jobs = WokExportExecutor().submit_batch(
+        sessions, export_scripts, None if directory is None else Path(directory), export_format)
+    return good(batch_id=batch_id, jobs=[job.dict for job in jobs])
+
+
+def poll_export_batch(batch_id: str):
+    jobs = WokExportExecutor().batch(batch_id)
+    if not jobs:
+        return bad(f"no export batch with id={batch_id}")
+    return good(batch_id=batch_id,
+                finished=all(job.finished for job in jobs),
+                documents=sum(job.documents_total for job in jobs),
+                documents_done=sum(job.documents_done for job in jobs),
+                jobs=[job.dict for job in jobs])
 
 
 def serve_crawler():
@@ -218,14 +412,42 @@ def serve_search_index():
     return render_template('search_index.html')
 
 
+def resume_persistent_jobs():
+    """
+    Pick up crawls and exports left unfinished by a previous run, now and on
+    every heartbeat, as leases of a process restarted quickly have not expired yet.
+    """
+    WokCrawlScheduler().resume_unfinished_jobs()
+    WokExportExecutor().resume_unfinished_jobs()
+    WokJobHeartbeat().add_claimer(WokCrawlScheduler().resume_unfinished_jobs)
+    WokJobHeartbeat().add_claimer(WokExportExecutor().resume_unfinished_jobs)
+
+
 def register_crawler_function(app: Flask):
     app.route('/command/search/', methods=['POST'])(command_search)
     app.route('/command/crawl/', methods=["POST"])(command_crawl)
     app.route('/command/reset/')(command_reset)
     app.route('/poll/crawl/')(poll_crawling_progress)
     app.route('/poll/search/')(poll_search_progress)
+    app.route('/command/submitCrawlJob/', methods=['POST'])(command_submit_crawl_job)
+    app.route('/poll/jobs/')(poll_crawl_jobs)
+    app.route('/poll/job/<string:job_id>/')(poll_crawl_job)
     app.route('/command/export/', methods=['POST'])(export_session)
+    app.route('/command/exportBatch/', methods=['POST'])(command_export_batch)
+    app.route('/poll/export/')(poll_export_jobs)
+    app.route('/poll/export/<string:job_id>/')(poll_export_job)
+    app.route('/command/cancelExport/', methods=['POST'])(command_cancel_export)
+    app.route('/poll/exportBatch/<string:batch_id>/')(poll_export_batch)
+    app.route('/command/analyseSession/', methods=['POST'])(command_analyse_session)
+    app.route('/poll/sessionMetrics/<string:session_id>/<string:export_script_name>/')(poll_session_metrics)
+    app.route('/command/snapshot/', methods=['POST'])(command_snapshot_session)
+    app.route('/poll/snapshot/<string:session_id>/')(poll_session_snapshot)
     app.route('/poll/availablePersistentSessions/')(poll_available_persistent_sessions)
+    app.route('/poll/dbPool/')(poll_db_pool_stats)
+    app.route('/poll/searchCache/')(poll_search_cache_stats)
+    app.route('/poll/sessionPool/')(poll_session_pool_stats)
+    app.route('/poll/nameCache/')(poll_name_cache_stats)
+    app.route('/metrics')(serve_metrics)
     app.route('/sessions/')(render_sessions_page)
     app.route('/command/dropSession/', methods=['POST'])(drop_session)
     app.route('/term/')(serve_term_assembler)
@@ -1,21 +1,48 @@
 """
 Implements analyser functions for Social Network Analysis.
 
+Outputs of the original crawler, i.e. EPZ files, are JSON objects whose
+"data" holds the crawled entries. They are read one entry at a time, with
+ijson if installed and with a reader decoding the file chunk by chunk
+otherwise, and fed into the graph engine of exports, so that files much
+larger than memory can be turned into edge lists.
+
 Kevin Ni, kevin.ni@nyu.edu.
 """
 
 import json
+import re
 from pathlib import Path
 from typing import *
 import subprocess
 import sys
+from _a_big_red_button.crawler.export_graph import WokGraph, WokGraphBuilder
+from _a_big_red_button.crawler.export_sink import make_sink
+from _a_big_red_button.crawler.graph_metrics import WokGraphMetrics
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.support.singleton import Singleton
 from _a_big_red_button.support.directory import DEPLOYMENT_ROOT
 
+# incremental parsing is much faster with ijson, a pure Python reader is used without it
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # prepare the logger
 logger = get_logger('analyser')
 
+# ways of reading EPZ files
+IJSON = 'ijson'
+PYTHON = 'python'
+BACKENDS = (IJSON, PYTHON) if ijson is not None else (PYTHON,)
+
+# characters read at a time by the pure Python reader
+READ_SIZE = 1 << 20
+
+# entries read between progress logs
+LOG_EVERY = 100000
+
 
 class WokAnalyser(metaclass=Singleton):
     def __init__(self):
@@ -46,50 +73,174 @@ class WokAnalyser(metaclass=Singleton):
             logger.error(f"cannot select file: {output[2:]}")
             return False
 
-    def analyse(self):
+    def analyse(self) -> WokGraphMetrics:
         assert self.file is not None
-        binary = json.load(self.file)['data']
-        try:
-            logger.info("read ")
-        except:
-            pass
+        graph = SNACrawlerOutput(self.file).generate_gephi_data()
+        logger.info(f"read {graph} from {self.file}")
+        return WokGraphMetrics.compute(graph)
+
+
+class _JsonStream:
+    """Decodes the values of a JSON document one at a time, reading it chunk by chunk."""
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ',]}: \t\n\r'
+
+    def __init__(self, file: TextIO, read_size: int = READ_SIZE):
+        self.file, self.read_size = file, read_size
+        self.buffer, self.position = '', 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self) -> bool:
+        """Read another chunk, dropping what has been decoded. Returns whether there was one."""
+        if self.exhausted:
+            return False
+        chunk = self.file.read(self.read_size)
+        if not chunk:
+            self.exhausted = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """The next character other than whitespace, '' at the end of the document."""
+        while True:
+            self.position = self.WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+
+    def skip(self, character: str):
+        if self.peek() != character:
+            raise ValueError(f"malformed EPZ file: expected {character!r}, "
+                             f"got {self.buffer[self.position:self.position + 32]!r}")
+        self.position += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # the value is cut off by the end of the chunk, or malformed after all
+                if self.fill():
+                    continue
+                raise
+            # a number at the end of the chunk may go on in the next one, and one cut off
+            # right after its "." or its exponent decodes to its beginning, e.g. "1." to 1
+            if (end == len(self.buffer) or self.truncated_number(value, end)) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def truncated_number(self, value: Any, end: int) -> bool:
+        """Whether a decoded number may have been cut off by the end of the chunk."""
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return False
+        # at most "e+" is left of a number cut off, anything longer is malformed
+        return len(self.buffer) - end <= 2 and self.buffer[end] not in self.DELIMITERS
+
+    def items(self, key: str) -> Iterator[Any]:
+        """Items of the array under a key of the top level object, other values are skipped."""
+        self.skip('{')
+        if self.peek() == '}':
+            return
+        while True:
+            name = self.value()
+            self.skip(':')
+            if name == key:
+                self.skip('[')
+                if self.peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.peek() != ',':
+                            break
+                        self.position += 1
+                    self.skip(']')
+            else:
+                self.value()
+            if self.peek() != ',':
+                break
+            self.position += 1
+        self.skip('}')
+
+
+def author_name(author: str) -> str:
+    """The full name of an author given as "abbreviation (full name)"."""
+    author = author.strip()
+    if author.endswith(')') and '(' in author:
+        return author[:-1].split('(')[-1].strip()
+    return author
 
 
 class SNACrawlerOutput:
-    def __init__(self, file: Union[str, Path]):
+    def __init__(self, file: Union[str, Path], backend: str = None):
+        """
+        :param backend: one of BACKENDS, ijson if installed by default
+        """
         self.file = file if isinstance(file, Path) else Path(file)
-        self.data: Optional[Dict[str, Union[str, int, float, List[str]]]] = None
+        self.backend = backend or BACKENDS[0]
+        if self.backend not in BACKENDS:
+            raise RuntimeError(f"cannot read {self.file} with {self.backend}: "
+                               f"not one of {', '.join(BACKENDS)}")
+        self.entries_read = 0
         self.validate_output()
 
+    def __repr__(self):
+        return f'SNACrawlerOutput(file={self.file}, backend={self.backend})'
+
     def validate_output(self):
         if not self.file.name.lower().endswith('.epz'):
             logger.warning(f"not analysing an EPZ file, "
                            f"unexpected errors may occur")
-        with open(self.file, mode='r', encoding='utf-8') as file:
-            raw_file: dict = json.load(file)
-            self.data = raw_file['data']
-
-    def generate_gephi_data(self, field: str):
-        assert self.data is not None
-        d = {}
-        for entry in self.data:
-            entry: dict
-            if 'cauthor' not in entry:
-                pass
-            processed_authors = list(map(lambda e: e[:-1].split('(')[-1], entry['author']))
-            first_author, other_authors = processed_authors[0], processed_authors[1:]
-            if first_author not in d:
-                d[first_author] = {}
-            for other_author in other_authors:
-                if other_author not in d[first_author]:
-                    d[first_author][other_author] = 0
-                d[first_author][other_author] += 1
-        return d
-
-    def export_for_gephi(self, dest: Union[str, Path]):
+
+    @property
+    def entries(self) -> Iterator[dict]:
+        """The crawled entries, read one at a time."""
+        self.entries_read = 0
+        if self.backend == IJSON:
+            with open(self.file, mode='rb') as file:
+                yield from self.__counted(ijson.items(file, 'data.item'))
+        else:
+            with open(self.file, mode='r', encoding='utf-8') as file:
+                yield from self.__counted(_JsonStream(file).items('data'))
+
+    def __counted(self, entries: Iterable[dict]) -> Iterator[dict]:
+        for entry in entries:
+            self.entries_read += 1
+            if self.entries_read % LOG_EVERY == 0:
+                logger.info(f"read {self.entries_read} entries of {self.file}")
+            yield entry
+
+    def build(self, graph: WokGraphBuilder):
+        """Connect the first author of every entry to each of the other authors."""
+        for entry in self.entries:
+            authors = entry.get('author') or ()
+            if len(authors) < 2:
+                continue
+            first_author = author_name(authors[0])
+            for other_author in authors[1:]:
+                graph.add_edge(first_author, author_name(other_author))
+
+    def generate_gephi_data(self) -> WokGraph:
+        graph = WokGraphBuilder(directed=True)
+        self.build(graph)
+        logger.info(f"built {graph} of {self.entries_read} entries of {self.file}")
+        return graph.finalise()
+
+    def export_for_gephi(self, dest: Union[str, Path], export_format: str = None) -> WokGraph:
+        """
+        :param export_format: one of the formats of export sinks, picked by the extension if not given
+        """
         dest = dest if isinstance(dest, Path) else Path(dest)
-        with open(dest, mode='w', encoding='utf-8') as file:
-            file.write(self.generate_gephi_data('p'))
+        graph = self.generate_gephi_data()
+        with make_sink(dest, export_format, directed=True) as sink:
+            sink.write_graph(graph)
+        return graph
 
 
 def analyse_sna_crawler_output():
@@ -97,11 +248,5 @@ def analyse_sna_crawler_output():
 
 
 if __name__ == '__main__':
-    d = SNACrawlerOutput('Y:/TEST.json').generate_gephi_data('EVE')
-    with open("Y:/TEST.csv", mode='w', encoding='utf-8') as file:
-        file.write('Source; Target; Weight\n')
-        for man, mates in d.items():
-            for mate, count in mates.items():
-                # if mate not in d:
-                #     continue
-                file.write(f'{man}; {mate}; {count}\n')
+    # python -m _a_big_red_button.crawler.analyser <EPZ file> <export file>
+    SNACrawlerOutput(sys.argv[1]).export_for_gephi(sys.argv[2])
@@ -0,0 +1,63 @@
+"""
+Implements the one normal form author names are compared in, shared by
+the print list parser, exports and the search: upper case, without
+commas, periods and surrounding white spaces. Normal forms are memoised
+and interned, so that a name seen again costs a lookup and every copy of
+it is the same string, and every normal form has an id stable across
+processes and runs.
+
+Authors are stored with their normal form and its id when crawled, those
+crawled before are given theirs when their session is upgraded.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import functools
+import hashlib
+import sys
+from typing import *
+
+from _a_big_red_button.support.configuration import get_config
+
+# get config
+config = get_config('crawler')
+
+
+@functools.lru_cache(maxsize=config.names.cache_size)
+def normalise_name(name: str) -> str:
+    return sys.intern(name.strip().replace(',', '').replace('.', '').upper())
+
+
+@functools.lru_cache(maxsize=config.names.cache_size)
+def name_id(normalised_name: str) -> int:
+    """
+    The id of a normalised name, a hash rather than a counter so that no
+    table has to be shared to agree on it. It fits a signed 64 bit integer.
+    """
+    digest = hashlib.blake2b(normalised_name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+def author_document(abbr: str, full: str) -> Dict[str, Any]:
+    """An author as stored in sessions, the abbreviation normalised as well."""
+    normalised = normalise_name(full)
+    return {'abbr': normalise_name(abbr), 'full': full, 'norm': normalised, 'id': name_id(normalised)}
+
+
+def normalise_authors(authors: Optional[List[dict]]) -> Optional[List[dict]]:
+    """Give stored authors lacking them their normal forms and ids."""
+    if authors is None:
+        return None
+    return [author_document(author.get('abbr') or '', author.get('full') or '')
+            if isinstance(author, dict) and 'norm' not in author else author
+            for author in authors]
+
+
+def cache_stats() -> Dict[str, Any]:
+    stats = {}
+    for name, function in (('normalise_name', normalise_name), ('name_id', name_id)):
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+                       'capacity': info.maxsize, 'hit_ratio': info.hits / lookups if lookups else None}
+    return stats
@@ -5,13 +5,17 @@ Kevin Ni, kevin.ni@nyu.edu.
 """
 
 import threading
+import time
+from functools import partial
+from pathlib import Path
 from threading import Lock
-from unicodedata import category as ucat
 
 # from _a_big_red_button.crawler import WokPersistentSessionMeta
 from _a_big_red_button.crawler.db import *
-from _a_big_red_button.crawler.core import WokSearchResult, WokSearch
-from _a_big_red_button.crawler.print_list import WoKPrintArticle
+from _a_big_red_button.crawler.core import WokSearchResult
+from _a_big_red_button.crawler.db_writer import WokPersistentSessionWriter
+from _a_big_red_button.crawler.crawl_metrics import ARTICLES_CRAWLED
+from _a_big_red_button.support.profiling import profiled
 from _a_big_red_button.support.singleton import Singleton
 
 # prepare logger
@@ -19,91 +23,100 @@ logger = get_logger('controller')
 
 
 class Wok(metaclass=Singleton):
+    """
+    Tracks the search and the crawl started from the crawler page. Both
+    are submitted as jobs to the crawl scheduler, which also runs jobs
+    submitted elsewhere, so starting a crawl here no longer has to wait
+    for another crawl to finish.
+    """
+
     def __init__(self):
-        self._searcher: Optional[Wok.AsyncSearch] = None
-        self._crawler: Optional[Wok.AsyncCrawler] = None
+        self._search_job: Optional['WokCrawlJob'] = None
+        self._crawl_job: Optional['WokCrawlJob'] = None
         self._persistent = WokPersistentStorage()
 
     # reset options
+    # jobs that are still running carry on in the scheduler
 
     def reset_all(self):
         # reset the manager
-        assert not self.is_searching
-        assert not self.is_crawling
-        self._searcher = None
-        self._crawler = None
+        self._search_job = None
+        self._crawl_job = None
 
     def reset_crawl(self):
-        assert not self.is_crawling
-        self._crawler = None
+        self._crawl_job = None
 
     def reset_search(self):
-        assert not self.is_searching and not self.is_crawling
-        self._searcher = None
+        assert not self.is_searching
+        self._search_job = None
 
     # search commands and states
 
     def search(self, term: str):
-        term = term.strip()
-        term_sanitised = ''.join(char for char in term if ucat(char) != 'Cc')
-        self._searcher = self.AsyncSearch(term_sanitised)
-        self._searcher.start()
+        from _a_big_red_button.crawler.scheduler import WokCrawlScheduler, WokCrawlJob
+        self._search_job = WokCrawlScheduler().submit(
+            WokCrawlJob(term, search_only=True))
+        return self._search_job
 
     @property
     def can_search(self):
-        return self._searcher is None or not self.is_searching
+        return self._search_job is None or not self.is_searching
 
     @property
     def is_searching(self):
-        return self._searcher is not None and self._searcher.searching
+        return self._search_job is not None and not self._search_job.finished
 
     @property
     def search_done(self):
-        return self._searcher is not None and self._searcher.done
+        return self._search_job is not None and self._search_job.finished
 
     @property
     def search_went_wrong(self):
-        return self._searcher is not None and self._searcher.in_error
+        return self._search_job is not None and self._search_job.failed
 
     @property
     def search_result_count(self):
         assert self.search_done and not self.search_went_wrong
-        return self._searcher.result.result_count
+        return self._search_job.result_count
 
     @property
     def search_what_went_wrong(self):
         assert self.search_went_wrong
-        return self._searcher.error_explanation
+        return self._search_job.error
 
     # crawl command and states
 
     @property
     def can_crawl(self):
-        return self.search_done and not self.search_went_wrong \
-               and not self.is_crawling
+        return self.search_done and not self.search_went_wrong
 
     @property
     def is_crawling(self):
-        return self._crawler is not None and self._crawler.crawling
+        return self._crawl_job is not None and not self._crawl_job.finished
 
     @property
     def crawling_done(self):
-        return self._crawler is not None and self._crawler.done
+        return self._crawl_job is not None and self._crawl_job.finished
 
     @property
     def crawling_went_wrong(self):
-        return self.crawling_done and self._crawler.in_error
+        return self.crawling_done and self._crawl_job.failed
 
     @property
     def crawling_total_count(self):
-        assert self._crawler is not None
-        return self._crawler.end - self._crawler.start_ + 1
+        assert self._crawl_job is not None
+        return self._crawl_job.total or 0
+
+    @property
+    def crawling_rate(self):
+        assert self._crawl_job is not None
+        return self._crawl_job.articles_per_second
 
     class AsyncSearch(threading.Thread):
-        def __init__(self, term: str):
+        def __init__(self, term: str, refresh: bool = False):
             super(Wok.AsyncSearch, self).__init__()
-            self.search: Optional[WokSearch] = None
             self.result: Optional[WokSearchResult] = None
+            self.refresh = refresh
             self.term = term
             self.__started = False
             self.__done = False
@@ -135,8 +148,8 @@ class Wok(metaclass=Singleton):
         def run(self) -> None:
             self.__started = True
             try:
-                self.search = WokSearch.make_new_search()
-                self.result = self.search.search(self.term)
+                from _a_big_red_button.crawler.search_cache import WokSearchCache
+                self.result = WokSearchCache().search(self.term, self.refresh)
                 self.__done = True
                 if self.result is None:
                     self.__error = True
@@ -149,10 +162,16 @@ class Wok(metaclass=Singleton):
     class AsyncCrawler(threading.Thread):
         def __init__(self, wok_result: WokSearchResult,
                      start: int, end: int, year_range: range = None,
-                     session: WokPersistentSession = None):
+                     session: WokPersistentSession = None,
+                     on_checkpoint: Callable[[int], None] = None,
+                     profile: bool = None):
             super().__init__()
             self.result = wok_result
+            # whether to run under the profiler, None to follow the configuration
+            self.profile = profile
+            self.profile_directory: Optional[Path] = None
             self.finished_count = 0
+            self.started_at: Optional[float] = None
             self.start_, self.end, self.year_range = start, end, year_range
             # use the entire range if start and end are all provided as 0
             if self.start_ <= 0:
@@ -161,9 +180,15 @@ class Wok(metaclass=Singleton):
                 self.end = self.result.result_count
             logger.debug(f'using default range for crawler: '
                          f'[{self.start_} -> {self.end}]')
+
+            # every result up to the checkpoint has been written to the session,
+            # print lists written out of order wait here until the gap is filled
+            self.checkpoint = self.start_ - 1
+            self.on_checkpoint = on_checkpoint
+            self.__completed: Dict[int, int] = {}
+
             self.__mutex = Lock()
-            self.pool: List[WoKPrintArticle] = []
-            self.capacity = 50
+            self.writer: Optional[WokPersistentSessionWriter] = None
             self.session, self.export = session, session is not None
             if not self.export:
                 logger.warning(f"not exporting crawler result, "
@@ -174,13 +199,6 @@ class Wok(metaclass=Singleton):
             self.__done = False
             self.__error = False
 
-            # process meta
-            from _a_big_red_button.crawler.db_meta import WokPersistentSessionMeta
-            meta = WokPersistentSessionMeta.find_by_session(self.session)
-            if meta is None:
-                meta = WokPersistentSessionMeta.make_new_for_session(self.session)
-            self.meta = meta
-
         @property
         def not_stared(self):
             with self.__mutex:
@@ -201,52 +219,98 @@ class Wok(metaclass=Singleton):
             with self.__mutex:
                 return self.__done and self.__error
 
+        @property
+        def articles_per_second(self):
+            if self.started_at is None:
+                return 0.0
+            elapsed = time.monotonic() - self.started_at
+            return self.finished_count / elapsed if elapsed > 0 else 0.0
+
         def run(self) -> None:
+            try:
+                with profiled(f'crawl-{self.result.search_term}', self.profile) as profiler:
+                    if profiler is not None:
+                        self.profile_directory = profiler.directory
+                    self.crawl()
+            except Exception as e:
+                # the scheduler would otherwise take the crawl for done
+                logger.error(f"crawl failed unexpectedly: {e}")
+                with self.__mutex:
+                    self.__done = True
+                    self.__error = True
+
+        def crawl(self):
             # update states
             with self.__mutex:
                 self.__started = True
+            self.started_at = time.monotonic()
+
+            # articles are persisted on the writer thread
+            # while this thread carries on parsing print lists
+            if self.export:
+                self.writer = WokPersistentSessionWriter(self.session)
+                self.writer.start()
 
             # do the following
             try:
                 for print_list in self.result.request_all_print_lists(self.start_, self.end):
+                    crawled = 0
                     for article in print_list.find_all_articles(self.year_range):
                         self.finished_count += 1
+                        crawled += 1
 
                         if self.export:
-                            self.pool.append(article)
-
-                            if len(self.pool) >= self.capacity:
-                                self.session.insert_many(
-                                    [a.as_export_dict() for a in self.pool])
-                                self.pool.clear()
+                            self.writer.put(article)
+                    ARTICLES_CRAWLED.inc(crawled)
+
+                    if self.export:
+                        if self.writer.failed:
+                            raise RuntimeError(self.writer.error)
+                        self.writer.checkpoint(partial(
+                            self.complete_print_list, print_list.start, print_list.end))
             except Exception as e:
                 logger.error(f"crawled failed: {e}")
                 with self.__mutex:
                     self.__done = True
                     self.__error = True
 
-            if self.pool:
-                self.session.insert_many(
-                    [a.as_export_dict() for a in self.pool])
-                self.pool.clear()
+            # flush whatever is left
+            if self.writer is not None:
+                self.writer.close()
+                if self.writer.failed:
+                    logger.error(f"crawl failed: {self.writer.error}")
+                    with self.__mutex:
+                        self.__error = True
 
-            # update meta
-            self.meta.add_range(range(self.start_, self.end + 1))
-            self.meta.update_last_searched()
-            self.meta.save()
+            # update meta, only results written up to the checkpoint count as crawled
+            if self.export:
+                from _a_big_red_button.crawler.db_meta import WokPersistentSessionMeta
+                WokPersistentSessionMeta.record_crawl(
+                    self.session, range(self.start_, self.checkpoint + 1))
 
             with self.__mutex:
                 logger.info("crawling done")
                 self.__done = True
 
-    def crawl(self, start: int, end: int, year_range=None):
-        self._crawler = self.AsyncCrawler(self._searcher.result,
-                                          start, end, year_range,
-                                          self._persistent[self._searcher.term])
-        self._crawler.start()
+        def complete_print_list(self, start: int, end: int):
+            # called on the writer thread once the print list has been written
+            self.__completed[start] = end
+            advanced = False
+            while self.checkpoint + 1 in self.__completed:
+                self.checkpoint = self.__completed.pop(self.checkpoint + 1)
+                advanced = True
+            if advanced and self.on_checkpoint is not None:
+                self.on_checkpoint(self.checkpoint)
+
+    def crawl(self, start: int, end: int, year_range=None, profile: bool = None):
+        from _a_big_red_button.crawler.scheduler import WokCrawlScheduler, WokCrawlJob
+        self._crawl_job = WokCrawlScheduler().submit(
+            WokCrawlJob(self._search_job.term, start, end, year_range,
+                        searcher=self._search_job.searcher, profile=profile))
+        return self._crawl_job
 
     @property
     def crawling_progress(self):
         assert self.is_crawling or \
                (self.crawling_done and not self.crawling_went_wrong)
-        return self._crawler.finished_count
+        return self._crawl_job.progress
@@ -10,14 +10,19 @@ from typing import *
 import re
 import csv
 import requests
+import requests.adapters
 import time
 from io import StringIO
+from urllib.parse import urlsplit, urlunsplit
+from unicodedata import category as ucat
 from lxml import etree
 from queue import Queue, Empty, Full
 import threading
 from _a_big_red_button.support.configuration import get_config
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.crawler.print_list import WoKPrintList
+from _a_big_red_button.crawler.crawl_metrics import REQUEST_SECONDS, REQUESTS, \
+    STAGE_SECONDS, QUEUE_DEPTH, FETCH
 from _a_big_red_button.consolesync import CONSOLE_SYNC_HANDLER
 
 # get logger
@@ -27,29 +32,218 @@ logger = get_logger('crawler', CONSOLE_SYNC_HANDLER, force_add_additional=True)
 _config = get_config('crawler')
 
 
+# scheme and host that urls of Web of Science are redirected to, e.g. a local stub server
+_url_base: Optional[str] = _config.url_base_override
+
+
+def override_url_base(base: Optional[str]):
+    """Redirect every request to Web of Science to another host, None to undo."""
+    global _url_base
+    _url_base = base
+    logger.warning(f"requests to Web of Science now go to [{base}]")
+
+
+def wok_url(url: str) -> str:
+    """Rewrite a configured url of Web of Science to the overriding base if any."""
+    if _url_base is None:
+        return url
+    return urlunsplit(urlsplit(_url_base)[:2] + urlsplit(url)[2:])
+
+
+# markers of the login page or the expired session page Web of Science answers with,
+# never matched against queries or whole pages, which carry terms and abstracts
+_expired_url_pattern = re.compile(
+    '|'.join(map(re.escape, _config.session_pool.expired_markers.url)), re.IGNORECASE)
+_expired_search_error_pattern = re.compile(
+    '|'.join(map(re.escape, _config.session_pool.expired_markers.search_error)), re.IGNORECASE)
+_LOGIN_FORM_XPATH = _config.session_pool.expired_markers.login_form
+
+
+class WokSessionExpired(RuntimeError):
+    """Raised when Web of Science answers with a login or session expired page."""
+
+
+def is_session_expired(response: requests.Response, root: etree = None) -> bool:
+    """
+    Whether a response is a login or session expired page rather than the
+    requested one, judging by the host and path of its url, and by a login
+    form on the page if it has been parsed.
+    """
+    url = urlsplit(response.url)
+    if _expired_url_pattern.search(url.netloc + url.path) is not None:
+        return True
+    return root is not None and bool(root.xpath(_LOGIN_FORM_XPATH))
+
+
+def make_http_session(connections: int = None) -> requests.Session:
+    """
+    Make a session keeping alive as many connections to Web of Science as
+    the workers sharing it may use at once. Failed requests are not retried
+    here, callers decide what to do with them.
+    """
+    if connections is None:
+        connections = max(_config.core.worker_num, 1)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections,
+                                            max_retries=0)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def sanitise_term(term: str):
+    """Strip a search term and remove control characters from it."""
+    term = term.strip()
+    return ''.join(char for char in term if ucat(char) != 'Cc')
+
+
+class WokRequestBudget:
+    """
+    A token bucket shared by every request made to Web of Science, so that
+    concurrent searches and crawls together stay within a global budget.
+    A budget of zero requests per minute means no limit at all.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60 if requests_per_minute > 0 else None
+        self.capacity = max(burst, 1)
+        self.__tokens = float(self.capacity)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the budget allows one more request."""
+        if self.rate is None:
+            return
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity,
+                                    self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+# the budget of all requests made by this process
+REQUEST_BUDGET = WokRequestBudget(_config.core.request_budget.requests_per_minute,
+                                  _config.core.request_budget.burst)
+
+
+def send_request(kind: str, send: Callable[[], requests.Response]) -> requests.Response:
+    """
+    Send a request within the request budget, recording its latency and status.
+
+    :param kind: kind of the request, i.e. index, search or print_list
+    :param send: function actually sending the request
+    """
+    REQUEST_BUDGET.acquire()
+    started = time.perf_counter()
+    try:
+        response = send()
+    except Exception:
+        REQUESTS.inc(kind=kind, status='error')
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, kind=kind)
+    REQUESTS.inc(kind=kind, status=response.status_code)
+    return response
+
+
 class WokSearchResult:
+    # put into the result queue by every print list worker once it concludes
+    WORKER_CONCLUDED = object()
+
     def __init__(self, result_url: str, result_count: int,
                  search_id: str, search_term: str,
-                 session: requests.Session, headers: Dict[str, str]):
+                 session: requests.Session, headers: Dict[str, str],
+                 searched_at: float = None):
         self.result_url, self.result_count = result_url, result_count
         self.search_id, self.search_term = search_id, search_term
         self.session, self.headers = session, headers
+        # monotonic time of the search, results change over time
+        self.searched_at = time.monotonic() if searched_at is None else searched_at
 
         # threading primitives
         self.task_queue = Queue()
         self.result_queue = Queue()
 
+    def copy(self) -> 'WokSearchResult':
+        """The same search with queues of its own, every crawl of a search needs one."""
+        return WokSearchResult(self.result_url, self.result_count,
+                               self.search_id, self.search_term,
+                               self.session, self.headers, self.searched_at)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.searched_at
+
     @staticmethod
     def assemble_print_list_url(start: int, end: int, search_id: str, search_term: str):
-        return _config.url.print_list.format(
-            from_=start, to=end, sid=search_id, term=search_term)
+        return wok_url(_config.url.print_list.format(
+            from_=start, to=end, sid=search_id, term=search_term))
+
+    @staticmethod
+    def request_print_list(session: requests.Session, headers: Dict[str, str],
+                           start: int, end: int, search_id: str, search_term: str,
+                           raise_expired: bool = False) \
+            -> Optional[WoKPrintList]:
+        """
+        Request and parse one print list, returns None if it could not be requested.
+
+        :param raise_expired: whether to raise WokSessionExpired rather than
+            return None if the session of the search has expired
+        """
+        url = WokSearchResult.assemble_print_list_url(
+            start, end, search_id, search_term)
+        logger.info(f"requesting print list [{start} -> {end}]...")
+        started = time.perf_counter()
+        req = send_request('print_list', lambda: session.get(url, headers=headers))
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=FETCH)
+
+        # validate response
+        if req.status_code != 200:
+            logger.error(f"cannot request print list [{start} -> {end}]: "
+                         f"status code = [{req.status_code}], "
+                         f"response = [{req.content}]")
+            logger.critical(f"PRINT LIST [{start} -> {end}] "
+                            f"HAS BEEN SKIPPED")
+            return None
+
+        # parse response
+        req.encoding = 'utf-8'  # force UTF-8
+        print_list = None if is_session_expired(req) else \
+            WoKPrintList(StringIO(req.text), start, end)
+        # expired sessions are answered with a login or error page rather than a print list
+        if print_list is None or not print_list.has_print_form or \
+                is_session_expired(req, print_list.root):
+            if raise_expired:
+                raise WokSessionExpired(f'session [{search_id}] has expired')
+            logger.error(f"cannot request print list [{start} -> {end}]: "
+                         f"session [{search_id}] has expired")
+            logger.critical(f"PRINT LIST [{start} -> {end}] "
+                            f"HAS BEEN SKIPPED")
+            return None
+        return print_list
+
+    def fetch_print_list(self, start: int, end: int) -> Optional[WoKPrintList]:
+        if _config.session_pool.enabled:
+            from _a_big_red_button.crawler.session_pool import WokSessionPool
+            return WokSessionPool().request_print_list(self.search_term, start, end, seed=self)
+        return self.request_print_list(
+            self.session, self.PrintListRequestWorker.assemble_headers(self.search_id),
+            start, end, self.search_id, self.search_term)
 
     class PrintListRequestWorker(threading.Thread):
         def __init__(self, task_queue: Queue, result_queue: Queue,
                      search_id: str, search_term: str,
                      result_count: int, step: int,
                      session: requests.Session,
-                     intermission: int, worker_number: int):
+                     intermission: int, worker_number: int,
+                     pool: 'WokSessionPool' = None, seed: 'WokSearchResult' = None):
             super().__init__()
             self.task_queue, self.result_queue = task_queue, result_queue
             self.search_id, self.search_term = search_id, search_term
@@ -57,6 +251,7 @@ class WokSearchResult:
             self.session, self.headers = session, self.assemble_headers(search_id)
             self.intermission = intermission
             self.worker_number = worker_number
+            self.pool, self.seed = pool, seed
 
         def __repr__(self):
             return f"PrintListRequestWorker(number={self.worker_number})"
@@ -69,6 +264,14 @@ class WokSearchResult:
             return headers
 
         def run(self) -> None:
+            try:
+                self.work()
+            finally:
+                # tells the consumer right away rather than after it times out
+                self.result_queue.put(WokSearchResult.WORKER_CONCLUDED)
+            logger.info(f"{self}: concluded")
+
+        def work(self):
             while True:
                 time.sleep(self.intermission)
                 try:
@@ -89,35 +292,27 @@ class WokSearchResult:
                     # end = min(end, self.result_count)
                     (start, end) = start
 
-                    # request the print list
-                    url = WokSearchResult.assemble_print_list_url(
-                        start, end, self.search_id, self.search_term)
-                    logger.info(f"requesting print list [{start} -> {end}]...")
-                    req = self.session.get(url, headers=self.headers)
-
-                    # validate response
-                    if req.status_code != 200:
-                        logger.error(f"cannot request print list [{start} -> {end}]: "
-                                     f"status code = [{req.status_code}], "
-                                     f"response = [{req.content}]")
-                        logger.critical(f"PRINT LIST [{start} -> {end}] "
-                                        f"HAS BEEN SKIPPED")
+                    # request the print list, through the session pool if any
+                    if self.pool is None:
+                        print_list = WokSearchResult.request_print_list(
+                            self.session, self.headers, start, end,
+                            self.search_id, self.search_term)
+                    else:
+                        print_list = self.pool.request_print_list(
+                            self.search_term, start, end, seed=self.seed)
+                    if print_list is None:
                         continue
 
-                    # parse response
-                    req.encoding = 'utf-8'  # force UTF-8
                     try:
-                        self.result_queue.put(
-                            WoKPrintList(StringIO(req.text), start, end), timeout=5)
+                        self.result_queue.put(print_list, timeout=5)
                     except Full:
                         logger.error(f"cannot put print list [{start} -> {end}] "
                                      f"back in queue: timed out")
                         logger.critical(f"PRINT LIST [{start} -> {end}] "
                                         f"HAS BEEN SKIPPED")
 
-            logger.info(f"{self}: concluded")
-
-    def request_all_print_lists(self, start_from, stop_by: int) -> \
+    def request_all_print_lists(self, start_from, stop_by: int,
+                                worker_number: int = None, intermission: float = None) -> \
             Generator[WoKPrintList, Any, Any]:
         # validate range and step
         # or so called sanitising the parameters
@@ -140,28 +335,47 @@ class WokSearchResult:
             self.task_queue.put((current_start, min(current_start + step - 1, stop_by)))
             current_start += step
 
-        # start worker threads
+        # start worker threads, which spread their requests over the session pool if enabled
         threads = []
-        worker_number = _config.core.worker_num
+        if worker_number is None:
+            worker_number = _config.core.worker_num
+
+        # every worker stops at the first end of tasks it takes, rather than once idle for a while
+        for _ in range(worker_number):
+            self.task_queue.put(None)
+        if intermission is None:
+            intermission = _config.core.worker_intermission
+        pool = None
+        if _config.session_pool.enabled:
+            from _a_big_red_button.crawler.session_pool import WokSessionPool
+            pool = WokSessionPool()
         for i in range(worker_number):
             threads.append(self.PrintListRequestWorker(
                 self.task_queue, self.result_queue,
                 self.search_id, self.search_term, self.result_count,
                 step, self.session,
-                _config.core.worker_intermission, i
+                intermission, i, pool, self
             ))
             threads[-1].start()
         logger.info(f"started {worker_number} worker threads")
 
-        while True:
+        concluded = 0
+        while concluded < len(threads):
             try:
-                yield self.result_queue.get(timeout=3)
+                print_list = self.result_queue.get(timeout=3)
             except Empty:
                 if not self.result_queue.empty():
                     logger.error("this should not happen: result pipe not drained yet")
                 if not any(filter(lambda thread: thread.is_alive(), threads)):
                     logger.info("all workers has finished")
                     break
+                continue
+            if print_list is self.WORKER_CONCLUDED:
+                concluded += 1
+                continue
+            QUEUE_DEPTH.set(self.task_queue.qsize(), queue='print_list_tasks')
+            QUEUE_DEPTH.set(self.result_queue.qsize(), queue='print_lists')
+            yield print_list
 
         # join worker threads
         for thread in threads:
@@ -177,10 +391,11 @@ class WokSearch:
         return match.groups()[-1]
 
     @staticmethod
-    def make_new_search():
+    def make_new_search(connections: int = None):
         logger.info("making a new search...")
-        session = requests.Session()
-        req = session.get(_config.url.index, headers=_config.headers.base.dict)
+        session = make_http_session(connections)
+        req = send_request('index', lambda: session.get(
+            wok_url(_config.url.index), headers=_config.headers.base.dict))
         if req.status_code != 200:
             raise RuntimeError(f'failed making a new search: status code [{req.status_code}]')
         sid = WokSearch.extract_search_id_from_url(req.url)
@@ -215,9 +430,9 @@ class WokSearch:
 
     def search(self, term: str):
         logger.info(f"searching for [{term}]...")
-        req = self.session.post(_config.url.search,
-                                data=self.assemble_search_form(term),
-                                headers=self.search_headers)
+        req = send_request('search', lambda: self.session.post(
+            wok_url(_config.url.search), data=self.assemble_search_form(term),
+            headers=self.search_headers))
         req.encoding = req.apparent_encoding
 
         # try to parse the response text
@@ -225,8 +440,12 @@ class WokSearch:
                            parser=etree.HTMLParser(recover=True, encoding=req.encoding))
         result_url = root.xpath('//a[@id="hitCount"]/@href')
         result_count = root.xpath('//a[@id="hitCount"]//text()')
+        error_message = self.parse_error_message(root)
+        if is_session_expired(req, root) or (error_message is not None and
+                                             _expired_search_error_pattern.search(error_message)):
+            logger.error(f"search failed: session [{self.search_id}] has expired")
+            raise WokSessionExpired(f'session [{self.search_id}] has expired')
         if len(result_url) != 1 or len(result_count) != 1:
-            error_message = self.parse_error_message(root)
             if error_message is None:
                 # logger.error(f"invalid search response: {req.content}")
                 logger.critical("PROGRAM TERMINATED")
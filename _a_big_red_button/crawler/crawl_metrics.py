@@ -0,0 +1,89 @@
+"""
+Declares the metrics of crawling, updated by the crawler, the print
+list parser and the database, and served at /metrics.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+from typing import *
+
+from _a_big_red_button.support.metrics import Counter, Gauge, Histogram
+
+# stages every crawled article goes through
+FETCH = 'fetch'
+PARSE = 'parse'
+VALIDATE = 'validate'
+SERIALISE = 'serialise'
+INSERT = 'insert'
+STAGES = (FETCH, PARSE, VALIDATE, SERIALISE, INSERT)
+
+STAGE_SECONDS = Histogram(
+    'wok_stage_seconds',
+    'Seconds spent in each stage of crawling, per print list or per written batch.',
+    ['stage'])
+
+REQUEST_SECONDS = Histogram(
+    'wok_request_seconds',
+    'Latency of requests made to Web of Science.',
+    ['kind'])
+
+REQUESTS = Counter(
+    'wok_requests_total',
+    'Requests made to Web of Science by response status.',
+    ['kind', 'status'])
+
+ARTICLES_CRAWLED = Counter(
+    'wok_articles_crawled_total',
+    'Articles parsed, validated and handed over for writing.')
+
+ARTICLES_WRITTEN = Counter(
+    'wok_articles_written_total',
+    'Articles actually inserted into sessions, duplicates excluded.')
+
+DISCARDED = Counter(
+    'wok_discarded_total',
+    'Articles and citations discarded while parsing, by reason.',
+    ['kind', 'reason'])
+
+QUEUE_DEPTH = Gauge(
+    'wok_queue_depth',
+    'Items waiting in the queues of the crawling pipeline.',
+    ['queue'])
+
+SEARCH_CACHE = Counter(
+    'wok_search_cache_total',
+    'Lookups of the search cache by outcome, i.e. hit, miss, expired or invalidated.',
+    ['outcome'])
+
+SESSION_REFRESHES = Counter(
+    'wok_session_refreshes_total',
+    'Sessions of the session pool given a new SID, by reason.',
+    ['reason'])
+
+MONGO_WRITE_SECONDS = Histogram(
+    'wok_mongo_write_seconds',
+    'Latency of writes to session collections.',
+    ['operation'])
+
+
+def summarise() -> Dict[str, Any]:
+    """A compact summary of the metrics, to be sent along with crawl progress."""
+    stages = {stage: STAGE_SECONDS.summary(stage=stage) for stage in STAGES}
+    requests = {kind: REQUEST_SECONDS.summary(kind=kind)
+                for (kind,) in REQUEST_SECONDS.label_values}
+    return {
+        'stage_seconds': {stage: round(summary['sum'], 3) for stage, summary in stages.items()},
+        'stage_mean_ms': {stage: round(summary['mean'] * 1000, 3)
+                          for stage, summary in stages.items()},
+        'requests': {kind: {'count': summary['count'],
+                            'mean_ms': round(summary['mean'] * 1000, 3)}
+                     for kind, summary in requests.items()},
+        'articles_crawled': ARTICLES_CRAWLED.value(),
+        'articles_written': ARTICLES_WRITTEN.value(),
+        'discarded': {f'{kind}: {reason}': count
+                      for (kind, reason), count in DISCARDED.values.items()},
+        'queue_depth': {queue: depth for (queue,), depth in QUEUE_DEPTH.values.items()},
+        'mongo_write_mean_ms': {
+            operation: round(MONGO_WRITE_SECONDS.summary(operation=operation)['mean'] * 1000, 3)
+            for (operation,) in MONGO_WRITE_SECONDS.label_values}
+    }
@@ -5,13 +5,19 @@ Kevin Ni, kevin.ni@nyu.edu.
 """
 
 from typing import *
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
 import hashlib
+import threading
 
 from _a_big_red_button.crawler.db_article import WokArticleStub
+from _a_big_red_button.crawler.crawl_metrics import MONGO_WRITE_SECONDS
 from _a_big_red_button.support.singleton import Singleton
 from _a_big_red_button.support.mongo_db import *
 from _a_big_red_button.support.lazy_property import lazy_property
-from pymongo.errors import DuplicateKeyError
+from _a_big_red_button.support.lru_cache import LRUCache
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 # prepare logger
 logger = get_logger('db')
@@ -22,6 +28,12 @@ config = get_config('db')
 # check sql alchemy version
 logger.info(f"using mongodb as backend")
 
+# handles of recently used persistent sessions, keyed by session id
+_SESSION_HANDLES = LRUCache(config.session_cache.capacity)
+
+# ids of sessions whose index and term meta have been verified by this process
+_VERIFIED_SESSIONS: Set[str] = set()
+
 
 class WokPersistentStorage(metaclass=Singleton):
     def __init__(self):
@@ -33,7 +45,10 @@ class WokPersistentStorage(metaclass=Singleton):
         for collection in self.database.list_collections():
             if collection['name'].startswith('Session'):
                 continue
-            yield WokPersistentSession.find_by_session_id(collection['name'])
+            # the collection is known to exist at this point so
+            # there is no need to list all collections once again
+            yield WokPersistentSession.find_by_collection(
+                self.database.get_collection(collection['name']))
 
     @staticmethod
     def sanitise_metadata():
@@ -61,9 +76,34 @@ class WokPersistentStorage(metaclass=Singleton):
         return f'WokPersistentStorage(session_count={len(list(self.all_sessions))})'
 
 
-class WokPersistentSession:
+class _WokPersistentSessionHandleCache(type):
+    """
+    Works much like the singleton meta class, except that handles are
+    cached per session id in a bounded LRU cache, so that looking up a
+    session does not need to verify its index and term meta every time.
+    """
+
+    def __call__(cls, term: str):
+        session_id = cls.encode_term(term)
+        handle = _SESSION_HANDLES.get(session_id)
+        if handle is None:
+            handle = super().__call__(term)
+            _SESSION_HANDLES.put(session_id, handle)
+        return handle
+
+    @staticmethod
+    def invalidate(session_id: str):
+        _SESSION_HANDLES.pop(session_id)
+        _VERIFIED_SESSIONS.discard(session_id)
+
+
+class WokPersistentSession(metaclass=_WokPersistentSessionHandleCache):
     _database = WokPersistentStorage().database
 
+    # bump this whenever the indexes, the term meta or the layout of the documents
+    # of a session change, so that existing sessions are verified once again
+    SCHEMA_VERSION = 2
+
     # for compatibility reason we do not use MD5 but rather
     # a zip then base64 approach
     # okay this did not work so we actually switch to md5
@@ -95,6 +135,9 @@ class WokPersistentSession:
     def find_by_collection(collection: Collection):
         from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
         session_id = collection.name
+        handle = _SESSION_HANDLES.get(session_id)
+        if handle is not None:
+            return handle
         term_meta = WokPersistentSessionTermMeta.find_by_session_id(session_id)
         if term_meta is None:
             return None
@@ -120,18 +163,96 @@ class WokPersistentSession:
         return f'WokPersistentSession(term="{self.term}", count={len(self)})'
 
     def __init__(self, term: str):
-        from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
         self.term = term
-        self.ensure_doi_index()
-        if WokPersistentSessionTermMeta.find_by_session_id(self.session_id) is None:
+        if self.session_id not in _VERIFIED_SESSIONS:
+            self.verify()
+
+    def verify(self):
+        """
+        Make sure the index and the term meta of this session are in place.
+        This is done once per process, and only touches the indexes if the
+        schema version recorded in the term meta is outdated, in which case
+        the documents are upgraded in the background.
+        """
+        from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
+        term_meta = WokPersistentSessionTermMeta.find_by_session_id(self.session_id)
+        if term_meta is None:
             # then this is the first time this session is being created
             # we save its term meta information into the database
+            self.ensure_doi_index()
+            self.ensure_author_index()
             term_meta = WokPersistentSessionTermMeta.make_new_for_session(self)
             term_meta.save()
             logger.info(f"created new persistent session (id-={self.session_id}, term={self.term})")
+        elif getattr(term_meta, 'schema_version', 0) < self.SCHEMA_VERSION:
+            self.ensure_doi_index()
+            self.ensure_author_index()
+            # documents are rewritten in the background rather than holding up
+            # whoever looks the session up, the schema version is recorded after
+            WokSessionUpgrader().submit(self)
+        _VERIFIED_SESSIONS.add(self.session_id)
+
+    @property
+    def upgrading(self) -> bool:
+        """Whether the documents of this session are being upgraded by any process."""
+        from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
+        term_meta = WokPersistentSessionTermMeta.find_by_session_id(self.session_id)
+        upgrading_until = None if term_meta is None else getattr(term_meta, 'upgrading_until', None)
+        return upgrading_until is not None and upgrading_until >= datetime.datetime.utcnow()
+
+    def upgrade(self) -> bool:
+        """
+        Upgrade the documents of this session to the current schema version,
+        unless it is up to date or being upgraded already. The upgrade is
+        leased in the term meta and the lease renewed batch after batch, so
+        that only one process runs it, and an upgrade left behind by a dead
+        process is taken over once its lease expires. Returns whether this
+        session has been upgraded.
+        """
+        from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
+        terms = WokPersistentSessionTermMeta._collection
+        query = {'session_id': self.session_id}
+
+        def lease():
+            return datetime.datetime.utcnow() + datetime.timedelta(seconds=config.upgrade.lease_seconds)
+
+        term_meta = terms.find_one_and_update(
+            dict(query, schema_version={'$not': {'$gte': self.SCHEMA_VERSION}},
+                 upgrading_until={'$not': {'$gte': datetime.datetime.utcnow()}}),
+            {'$set': {'upgrading_until': lease()}})
+        if term_meta is None:
+            return False
+        try:
+            if term_meta.get('schema_version', 0) < 2:
+                self.normalise_author_names(
+                    renew=lambda: terms.update_one(query, {'$set': {'upgrading_until': lease()}}))
+        except Exception:
+            terms.update_one(query, {'$unset': {'upgrading_until': ''}})
+            raise
+        terms.update_one(query, {'$set': {'schema_version': self.SCHEMA_VERSION},
+                                 '$unset': {'upgrading_until': ''}})
+        logger.info(f"upgraded persistent session (id={self.session_id}) "
+                    f"to schema version {self.SCHEMA_VERSION}")
+        return True
 
     def drop(self):
+        from _a_big_red_button.crawler.db_meta import WokPersistentSessionTermMeta
+        from _a_big_red_button.crawler.export_state import WokExportState
+        from _a_big_red_button.crawler.session_metrics import WokSessionMetrics
+        from _a_big_red_button.crawler.session_snapshot import WokSessionSnapshot
         self.collection.drop()
+        type(self).invalidate(self.session_id)
+
+        # the term meta goes with the collection, otherwise a session
+        # created again under the same term would skip its index
+        term_meta = WokPersistentSessionTermMeta.find_by_session_id(self.session_id)
+        if term_meta is not None:
+            term_meta.drop()
+
+        # so are the saved states of its exports, its metrics and its snapshot
+        WokExportState.drop(self.session_id)
+        WokSessionMetrics.drop(self.session_id)
+        WokSessionSnapshot.drop(self.session_id)
         return self.find_by_session_id(self.session_id) is None
 
     def ensure_doi_index(self):
@@ -143,6 +264,32 @@ class WokPersistentSession:
             if length <= 1:
                 self.collection.create_index("doi", unique=True)
 
+    def ensure_author_index(self):
+        # articles are searched by the ids of the normal forms of their authors
+        self.collection.create_index("author.id")
+
+    def normalise_author_names(self, renew: Callable[[], Any] = None):
+        """
+        Give authors stored before normal forms were their normal forms and ids.
+
+        :param renew: called after every batch of documents rewritten
+        """
+        from _a_big_red_button.crawler.author_names import normalise_authors
+        updated, requests = 0, []
+        query = {'author.norm': {'$exists': False}, 'author.0': {'$exists': True}}
+        for document in self.collection.find(query, {'author': 1}):
+            requests.append(UpdateOne({'_id': document['_id']},
+                                      {'$set': {'author': normalise_authors(document['author'])}}))
+            if len(requests) >= config.upgrade.batch_size:
+                updated += self.collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+                if renew is not None:
+                    renew()
+        if requests:
+            updated += self.collection.bulk_write(requests, ordered=False).modified_count
+        logger.info(f"normalised author names of {updated} documents "
+                    f"of persistent session (id={self.session_id})")
+
     @lazy_property
     def session_id(self):
         return self.encode_term(self.term)
@@ -157,19 +304,65 @@ class WokPersistentSession:
         # the target collection will be created the first time
         # something is inserted into the document
         try:
-            self.collection.insert_one(document)
+            with MONGO_WRITE_SECONDS.time(operation='insert'):
+                self.collection.insert_one(document)
         except DuplicateKeyError:
-            logger.debug(f"document exists and has been ignored: "
-                         f"{document}")
+            # formatted lazily, documents are big and this is usually not logged
+            logger.debug("document exists and has been ignored: %s", document)
 
     def insert_many(self, documents: List[MongoDocumentAsPyObject]):
-        for document in documents:
-            self.insert(document)
+        # unordered so that one duplicate does not hold back the rest,
+        # returns the number of documents actually inserted
+        if not documents:
+            return 0
+        try:
+            with MONGO_WRITE_SECONDS.time(operation='insert_many'):
+                result = self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            duplicates = sum(1 for error in write_errors if error.get('code') == 11000)
+            if duplicates != len(write_errors):
+                raise
+            logger.debug(f"{duplicates} documents exist and have been ignored")
+            return e.details.get('nInserted', 0)
+        return len(result.inserted_ids)
 
     def __len__(self):
         return self.collection.count()
 
+    @property
+    def signature(self) -> Dict[str, Any]:
+        """What changes whenever documents are inserted into or removed from this session."""
+        latest = list(self.collection.find({}, {'_id': 1}).sort('_id', DESCENDING).limit(1))
+        return {'documents': len(self), 'last_id': latest[0]['_id'] if latest else None}
+
     @property
     def articles(self):
         for document in self.collection.find():
             yield WokArticleStub(document)
+
+
+class WokSessionUpgrader(metaclass=Singleton):
+    """Upgrades sessions in the background, one at a time."""
+
+    def __init__(self):
+        self.upgraders = ThreadPoolExecutor(1, thread_name_prefix='upgrade')
+        self.__lock = threading.Lock()
+        self.__upgrades: Dict[str, Future] = {}
+
+    def submit(self, session: WokPersistentSession) -> Future:
+        """Upgrade a session, unless it is being upgraded by this process already."""
+        with self.__lock:
+            running = self.__upgrades.get(session.session_id)
+            if running is not None and not running.done():
+                return running
+            future = self.__upgrades[session.session_id] = self.upgraders.submit(self.__upgrade, session)
+        return future
+
+    @staticmethod
+    def __upgrade(session: WokPersistentSession) -> bool:
+        try:
+            return session.upgrade()
+        except Exception as e:
+            logger.error(f"cannot upgrade persistent session (id={session.session_id}): {e}")
+            raise
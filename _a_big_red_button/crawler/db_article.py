@@ -15,6 +15,8 @@ class WokAuthorStub(MongoDocumentAsPyObject):
     # this class is not used at run time
     abbr: str
     full: str
+    norm: str  # normal form of the full name
+    id: int  # of the normal form
 
 
 class WokCitationStub(MongoDocumentAsPyObject):
@@ -0,0 +1,188 @@
+"""
+Implements persistent records of crawl and export jobs, so that jobs
+left unfinished by a process that got killed are picked up again by
+the next one.
+
+Every job is leased by the process running it. The lease is renewed by
+a heartbeat, and a job whose lease has expired is up for grabs.
+Unfinished jobs are claimed at startup and again on every heartbeat, so
+that jobs of a process restarted before their leases expired are picked
+up as soon as they do.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import uuid
+from typing import *
+
+from pymongo import ReturnDocument
+
+from _a_big_red_button.crawler.db import config, logger, WokPersistentStorage
+from _a_big_red_button.support.mongo_db import MongoDocumentAsPyObject
+from _a_big_red_button.support.mongo_db.searching import MongoSearchMixin
+from _a_big_red_button.support.singleton import Singleton
+
+# identifies this process as the owner of leases
+PROCESS_OWNER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def _lease_expiry():
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=config.jobs.lease_seconds)
+
+
+class WokPersistentJob(MongoDocumentAsPyObject, MongoSearchMixin):
+    _collection = WokPersistentStorage().database.get_collection(
+        config.collections.jobs)
+
+    # kinds of jobs
+    CRAWL = 'crawl'
+    EXPORT = 'export'
+
+    # states of jobs that are over and will never be picked up again
+    FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+    # typed field notation
+    job_id: str
+    kind: str
+    state: str
+    parameters: Any
+    checkpoint: Optional[int]
+    owner: Optional[str]
+    lease_expires: datetime.datetime
+    heartbeat: datetime.datetime
+    error: Optional[str]
+
+    def __init__(self, src: dict):
+        super().__init__(src)
+
+    def __repr__(self):
+        return f'WokPersistentJob(id={self.job_id}, kind={self.kind}, state={self.state})'
+
+    def save(self, target_collection=None):
+        return super().save(self._collection if target_collection is None else target_collection)
+
+    @staticmethod
+    def make_new(job_id: str, kind: str, parameters: dict):
+        now = datetime.datetime.utcnow()
+        job = WokPersistentJob({
+            'job_id': job_id,
+            'kind': kind,
+            'state': 'queued',
+            'parameters': parameters,
+            'checkpoint': None,
+            'owner': PROCESS_OWNER,
+            'lease_expires': _lease_expiry(),
+            'heartbeat': now,
+            'submitted': now,
+            'error': None
+        })
+        job.save()
+        WokJobHeartbeat().ensure_started()
+        return job
+
+    @staticmethod
+    def find_by_job_id(job_id: str):
+        return WokPersistentJob.find_one(job_id=job_id)
+
+    @staticmethod
+    def claim_unfinished(kind: str) -> Optional['WokPersistentJob']:
+        """
+        Atomically claim one unfinished job of the given kind whose lease
+        has expired, making this process its owner.
+
+        :param kind: kind of the job
+        :return: the claimed job, or None if there is nothing to claim
+        """
+        now = datetime.datetime.utcnow()
+        # owners are not told dead by their process ids, which neither work on
+        # every platform nor tell apart hosts of the same name, only by their leases
+        document = WokPersistentJob._collection.find_one_and_update(
+            {'kind': kind,
+             'state': {'$nin': list(WokPersistentJob.FINISHED_STATES)},
+             'lease_expires': {'$lt': now}},
+            {'$set': {'owner': PROCESS_OWNER,
+                      'lease_expires': _lease_expiry(),
+                      'heartbeat': now}},
+            return_document=ReturnDocument.AFTER)
+        if document is None:
+            return None
+        WokJobHeartbeat().ensure_started()
+        job = WokPersistentJob(document)
+        logger.info(f"claimed unfinished {job} left by a previous process")
+        return job
+
+    def __update(self, **fields):
+        # only the owner may touch a job, a job lost to another process stays untouched
+        result = self._collection.update_one(
+            {'job_id': self.job_id, 'owner': PROCESS_OWNER}, {'$set': fields})
+        if result.matched_count == 0:
+            logger.warning(f"{self} is no longer owned by this process, update ignored")
+            return
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def update_state(self, state: str, error: str = None):
+        self.__update(state=state, error=error)
+
+    def update_checkpoint(self, checkpoint: int):
+        self.__update(checkpoint=checkpoint)
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED_STATES
+
+
+class WokJobHeartbeat(threading.Thread, metaclass=Singleton):
+    """
+    Renews the leases of all unfinished jobs owned by this process, and
+    calls the claimers of unfinished jobs left by other processes.
+    """
+
+    def __init__(self):
+        super().__init__(name='job-heartbeat')
+        self.daemon = True
+        self.__lock = threading.Lock()
+        self.__started = False
+        self.__claimers: List[Callable[[], None]] = []
+        self.__stopped = threading.Event()
+
+    def ensure_started(self):
+        with self.__lock:
+            if not self.__started:
+                self.__started = True
+                self.start()
+
+    def add_claimer(self, claimer: Callable[[], None]):
+        """Call a function claiming unfinished jobs on every heartbeat from now on."""
+        with self.__lock:
+            self.__claimers.append(claimer)
+        self.ensure_started()
+
+    def stop(self):
+        """Stop renewing leases, the jobs of this process are then claimed by others."""
+        self.__stopped.set()
+
+    def claim(self):
+        with self.__lock:
+            claimers = list(self.__claimers)
+        for claimer in claimers:
+            try:
+                claimer()
+            except Exception as e:
+                logger.error(f"cannot claim unfinished jobs: {e}")
+
+    def run(self) -> None:
+        while not self.__stopped.wait(config.jobs.heartbeat_interval):
+            now = datetime.datetime.utcnow()
+            try:
+                WokPersistentJob._collection.update_many(
+                    {'owner': PROCESS_OWNER,
+                     'state': {'$nin': list(WokPersistentJob.FINISHED_STATES)}},
+                    {'$set': {'lease_expires': _lease_expiry(), 'heartbeat': now}})
+            except Exception as e:
+                logger.error(f"cannot renew job leases: {e}")
+            self.claim()
@@ -8,11 +8,11 @@ Kevin NI, kevin.ni@nyu.edu.
 import base64
 import datetime
 from threading import Lock
-from typing import Dict, Union
+from typing import Dict, List, Union
 
 from pymongo.collection import Collection
 
-from _a_big_red_button.crawler.db import config, WokPersistentSession, WokPersistentStorage
+from _a_big_red_button.crawler.db import config, logger, WokPersistentSession, WokPersistentStorage
 from _a_big_red_button.support.mongo_db import MongoDocumentAsPyObject
 from _a_big_red_button.support.mongo_db.searching import MongoSearchMixin
 from _a_big_red_button.support.python_object_bridge import PyObjectLike
@@ -133,8 +133,11 @@ class WokPersistentSessionMeta(MongoDocumentAsPyObject,
         with self._lock:
             if when is None:
                 when = datetime.datetime.now()
+            # only the field itself is set, saving the whole document would
+            # overwrite ranges recorded meanwhile by other crawls
+            self._collection.update_one({'collection_name': self.collection_name},
+                                        {'$set': {'last_searched': when}})
             self.last_searched = when
-            self.save(self._collection)
 
     @property
     def crawled_ranges(self):
@@ -142,56 +145,84 @@ class WokPersistentSessionMeta(MongoDocumentAsPyObject,
             for raw_range in self.crawled_ranges_raw:
                 yield range(raw_range.start, raw_range.stop + 1)
 
-    def merge_adjacent_ranges(self):
-        if len(self.crawled_ranges_raw) <= 1:
-            return
-        new_ranges = []
-        i = 0
-        merge_happened = False
-        while i < len(self.crawled_ranges_raw) - 1:
-            merge_happened = False
-            this_range = RangeExt.from_dict(self.crawled_ranges_raw[i])
-            next_range = RangeExt.from_dict(self.crawled_ranges_raw[i + 1])
-            while this_range.intersect(next_range):
-                merge_happened = True
-                this_range += next_range
-                i += 1
-                if i + 1 >= len(self.crawled_ranges_raw):
-                    break
-                next_range = RangeExt.from_dict(self.crawled_ranges_raw[i + 1])
-            new_ranges.append(this_range)
-            i += 1
-        if not merge_happened:
-            # this means the last range is valid
-            new_ranges.append(RangeExt.from_dict(self.crawled_ranges_raw[-1]))
+    @staticmethod
+    def merge_ranges(raw_ranges: List[dict]) -> List[dict]:
+        """Sort ranges and merge those overlapping or adjacent to each other."""
+        merged: List[RangeExt] = []
+        for new_range in sorted(map(RangeExt.from_dict, raw_ranges), key=lambda r: r.start):
+            if merged and new_range.start <= merged[-1].stop + 1:
+                merged[-1].stop = max(merged[-1].stop, new_range.stop)
+            else:
+                merged.append(new_range)
+        return [{'start': r.start, 'stop': r.stop} for r in merged]
+
+    @staticmethod
+    def record_crawl(session: 'WokPersistentSession', crawled_range: range = None,
+                     searched: bool = True):
+        """
+        Record a range of results of a session as crawled and the session as
+        searched just now. Crawls of the same session may finish at once, so
+        the range is pushed atomically rather than saved with the document,
+        and ranges are merged afterwards only if no other crawl changed them.
+
+        :param crawled_range: None or an empty range to only record the search
+        :param searched: whether to record the search
+        """
+        update, on_insert = {}, {}
+        if searched:
+            update['$set'] = {'last_searched': datetime.datetime.now()}
+        else:
+            on_insert['last_searched'] = datetime.datetime.utcfromtimestamp(0)
+        if crawled_range is not None and len(crawled_range) > 0:
+            update['$push'] = {'crawled_ranges_raw': {'start': crawled_range.start,
+                                                      'stop': crawled_range.stop - 1}}
+        else:
+            on_insert['crawled_ranges_raw'] = []
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        WokPersistentSessionMeta._collection.update_one(
+            {'collection_name': session.session_id}, update, upsert=True)
+        WokPersistentSessionMeta.merge_crawled_ranges(session.session_id)
+
+    @staticmethod
+    def merge_crawled_ranges(session_id: str, attempts: int = 5):
+        collection = WokPersistentSessionMeta._collection
+        for _ in range(attempts):
+            document = collection.find_one({'collection_name': session_id},
+                                            {'crawled_ranges_raw': 1})
+            if document is None:
+                return
+            raw_ranges = document.get('crawled_ranges_raw', [])
+            merged = WokPersistentSessionMeta.merge_ranges(raw_ranges)
+            if merged == raw_ranges:
+                return
+            # compare and swap, ranges pushed meanwhile make this match nothing
+            result = collection.update_one({'_id': document['_id'], 'crawled_ranges_raw': raw_ranges},
+                                           {'$set': {'crawled_ranges_raw': merged}})
+            if result.matched_count:
+                return
+        # left as they are, the next crawl recorded merges them
+        logger.warning(f"cannot merge crawled ranges of session(id={session_id}): "
+                       f"changed {attempts} times while merging")
+
+    def reload_crawled_ranges(self):
+        document = self._collection.find_one({'collection_name': self.collection_name},
+                                             {'crawled_ranges_raw': 1})
+        self.crawled_ranges_raw = [] if document is None else \
+            WokPersistentSessionMeta(document).crawled_ranges_raw
 
-        self.crawled_ranges_raw = \
-            [{'start': r.start, 'stop': r.stop} for r in new_ranges]
-        self.save(self._collection)
+    def merge_adjacent_ranges(self):
+        with self._lock:
+            self.merge_crawled_ranges(self.collection_name)
+            self.reload_crawled_ranges()
 
     def add_range(self, new_range: Union[range, RangeExt]):
         with self._lock:
             # parse new range
-            if isinstance(new_range, range):
-                new_range = RangeExt.from_python_range(new_range)
-
-            for raw_range in self.crawled_ranges_raw:
-                old_range = RangeExt.from_dict(raw_range)
-
-                if old_range.intersect(new_range):
-                    old_range += new_range
-                    raw_range.start, raw_range.stop = \
-                        old_range.start, old_range.stop
-                    break
-            else:
-                # make sure new range is inserted at the right place
-                # such that the entire list is sorted
-                self.crawled_ranges_raw.append({'start': new_range.start,
-                                                'stop': new_range.stop})
-                self.crawled_ranges_raw.sort(key=lambda r: r['start'])
-            self.save(self._collection)
-            self.merge_adjacent_ranges()
-            self.save(self._collection)
+            if isinstance(new_range, RangeExt):
+                new_range = new_range.as_python_range
+            self.record_crawl(self, new_range, searched=False)
+            self.reload_crawled_ranges()
 
 
 class WokPersistentSessionTermMeta(MongoDocumentAsPyObject, MongoSearchMixin):
@@ -203,6 +234,9 @@ class WokPersistentSessionTermMeta(MongoDocumentAsPyObject, MongoSearchMixin):
     def save(self, alternate_collection: Collection = None):
         super().save(self._collection if alternate_collection is None else alternate_collection)
 
+    def drop(self, alternate_collection: Collection = None):
+        return super().drop(self._collection if alternate_collection is None else alternate_collection)
+
     @staticmethod
     def find_by_session_id(session_id: str):
         return WokPersistentSessionTermMeta.find_one(session_id=session_id)
@@ -211,5 +245,6 @@ class WokPersistentSessionTermMeta(MongoDocumentAsPyObject, MongoSearchMixin):
     def make_new_for_session(session: 'WokPersistentSession'):
         return WokPersistentSessionTermMeta({
             'term': session.term,
-            'session_id': session.session_id
+            'session_id': session.session_id,
+            'schema_version': session.SCHEMA_VERSION
         })
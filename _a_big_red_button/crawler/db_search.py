@@ -5,8 +5,11 @@ concerning a given name (abbreviation).
 Kevin Ni, kevin.ni@nyu.edu.
 """
 
+import re
+
 from _a_big_red_button.crawler.db import *
-from _a_big_red_button.crawler.db_article import WokAuthorStub, WokCitationStub
+from _a_big_red_button.crawler.db_article import WokArticleStub, WokAuthorStub, WokCitationStub
+from _a_big_red_button.crawler.author_names import normalise_name
 
 
 class WokLocalSessionSearchResult(PyObjectLike):
@@ -34,42 +37,64 @@ def search_in_all_sessions(author: str) -> WokLocalSessionSearchResult:
     return join_search_result(*(search_in_session(session, author) for session in WokPersistentStorage().all_sessions))
 
 
+def _name_pattern(needle: str) -> str:
+    """
+    A pattern finding a normalised name in names as stored, which are not all
+    normalised: they may have commas and periods anywhere, and any case.
+    """
+    return '[,.]*'.join(map(re.escape, needle))
+
+
 def search_in_session(session: WokPersistentSession, author: str) -> WokLocalSessionSearchResult:
     # step by step progress
     # first we search for all the articles where the given author is listed as AUTHORS
     result = WokLocalSessionSearchResult()
 
-    # TODO search with MongoDB
-    # session.collection.find({"author": author})
-
-    for article in session.articles:
+    # names are matched by the database rather than listed to be matched here, there
+    # may be more distinct names in a session than a single document can hold
+    needle = normalise_name(author)
+    pattern = {'$regex': _name_pattern(needle), '$options': 'i'}
+    fields = ['author.abbr', 'author.norm']
+    # authors not yet given their normal forms are found by their full names meanwhile
+    upgrading = session.upgrading
+    if upgrading:
+        fields.append('author.full')
+
+    def matches(author_: WokAuthorStub) -> bool:
+        names = [getattr(author_, 'abbr', None), getattr(author_, 'norm', None)]
+        if upgrading:
+            names.append(getattr(author_, 'full', None))
+        return any(isinstance(name, str) and needle in normalise_name(name) for name in names)
+
+    query = {'$or': [{field: pattern} for field in fields]}
+    for document in session.collection.find(query):
+        article = WokArticleStub(document)
+
+        # add information from this article into the result
+        # first we go with the author
         for author_ in article.author:
-            if author.upper() in author_.abbr.upper() or author in author_.full.upper():
-                # add information from this article into the result
-                # first we go with the author
-                for author__ in article.author:
-                    if author.upper() in author__.abbr.upper() or author in author__.full.upper():
-                        continue
-                    result.coauthors.add(author__.clone())
-
-                # then we go with the emails
-                for email in article.email:
-                    result.emails.add(email)
-
-                # then we go with publisher
-                result.publisher.add(article.pub)
-
-                # then we go with keywords
-                if article.keywordplus is not None:
-                    for keyword in article.keywordplus:
-                        result.keywords.add(keyword)
-
-                # then citation
-                for citation in article.citation:
-                    result.citation.add(citation.clone())
-
-                # then DOI
-                result.doi.add(article.doi)
+            if matches(author_):
+                continue
+            result.coauthors.add(author_.clone())
+
+        # then we go with the emails
+        for email in article.email:
+            result.emails.add(email)
+
+        # then we go with publisher
+        result.publisher.add(article.pub)
+
+        # then we go with keywords
+        if article.keywordplus is not None:
+            for keyword in article.keywordplus:
+                result.keywords.add(keyword)
+
+        # then citation
+        for citation in article.citation:
+            result.citation.add(citation.clone())
+
+        # then DOI
+        result.doi.add(article.doi)
     return result
 
 
@@ -0,0 +1,192 @@
+"""
+Implements a write-behind writer that persists crawled articles on its
+own thread, so that parsing print lists and writing to the database
+overlap instead of running in series.
+
+A batch that cannot be written is tried again a few times. If it still
+fails, the writer gives up: it reports the error, discards everything
+queued after the batch and never reaches a later checkpoint. Progress is
+then never recorded past articles that were not written.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import time
+import threading
+from queue import Queue, Empty
+from typing import *
+
+from _a_big_red_button.crawler.db import WokPersistentSession
+from _a_big_red_button.crawler.crawl_metrics import STAGE_SECONDS, ARTICLES_WRITTEN, \
+    QUEUE_DEPTH, SERIALISE, INSERT
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+
+# prepare logger
+logger = get_logger('db')
+
+# get config
+_config = get_config('crawler')
+
+
+class WokPersistentSessionWriter(threading.Thread):
+    # marks the end of the stream of articles
+    _SENTINEL = object()
+
+    class Checkpoint:
+        """Marks a point in the stream, reached once all articles before it are written."""
+
+        def __init__(self, callback: Callable[[], None]):
+            self.callback = callback
+
+    def __init__(self, session: WokPersistentSession,
+                 batch_size: int = None, flush_interval: float = None,
+                 capacity: int = None):
+        super().__init__()
+        self.daemon = True
+        self.session = session
+        self.batch_size = batch_size or _config.writer.batch_size
+        self.flush_interval = flush_interval or _config.writer.flush_interval
+        self.queue = Queue(maxsize=capacity or _config.writer.queue_capacity)
+
+        # set once a batch could not be written even after retries
+        self.error: Optional[str] = None
+
+        # statistics
+        self.__lock = threading.Lock()
+        self.__batches = 0
+        self.__documents = 0
+        self.__failed_batches = 0
+        self.__total_latency = 0.0
+        self.__max_latency = 0.0
+        self.__last_latency = 0.0
+
+    def __repr__(self):
+        return f'WokPersistentSessionWriter(session_id={self.session.session_id})'
+
+    def put(self, article: Any):
+        """
+        Enqueue an article for writing. Blocks if the writer falls too
+        far behind, which keeps the memory of a long crawl bounded.
+
+        :param article: either a parsed article or its export dict
+        """
+        self.queue.put(article)
+
+    def checkpoint(self, callback: Callable[[], None]):
+        """
+        Call back on the writer thread once every article enqueued so far
+        has been written, e.g. to record the progress of a crawl.
+
+        :param callback: the function to call
+        """
+        self.queue.put(self.Checkpoint(callback))
+
+    def close(self, timeout: float = None):
+        """Flush whatever is left in the queue and stop the writer."""
+        self.queue.put(self._SENTINEL)
+        self.join(timeout)
+        if self.is_alive():
+            logger.error(f'{self} did not finish flushing in {timeout} seconds')
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self.__lock:
+            return {
+                'batches': self.__batches,
+                'documents': self.__documents,
+                'failed_batches': self.__failed_batches,
+                'queued': self.queue.qsize(),
+                'last_batch_latency': self.__last_latency,
+                'max_batch_latency': self.__max_latency,
+                'average_batch_latency':
+                    self.__total_latency / self.__batches if self.__batches else 0.0
+            }
+
+    def run(self) -> None:
+        batch, deadline, closing = [], None, False
+        while not closing:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            else:
+                if item is self._SENTINEL:
+                    closing = True
+                elif isinstance(item, self.Checkpoint):
+                    if batch:
+                        self.flush(batch)
+                        batch, deadline = [], None
+                    # articles before the checkpoint are lost once the writer has failed
+                    if not self.failed:
+                        self.reach(item)
+                    continue
+                elif self.failed:
+                    # keep draining the queue so that the crawler is never blocked
+                    continue
+                else:
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append(item)
+
+            if batch and (closing or len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch, deadline = [], None
+
+        logger.info(f'{self} concluded: {self.stats}')
+
+    def reach(self, checkpoint: 'WokPersistentSessionWriter.Checkpoint'):
+        try:
+            checkpoint.callback()
+        except Exception as e:
+            logger.error(f'{self} failed calling back a checkpoint: {e}')
+
+    def flush(self, batch: List[Any]):
+        QUEUE_DEPTH.set(self.queue.qsize(), queue='writer')
+        started = time.perf_counter()
+        try:
+            documents = [item if isinstance(item, dict) else item.as_export_dict()
+                         for item in batch]
+        except Exception as e:
+            self.give_up(batch, e)
+            return
+        serialised = time.perf_counter()
+        STAGE_SECONDS.observe(serialised - started, stage=SERIALISE)
+
+        # duplicates are ignored, so a batch written in part may be written again
+        for attempt in range(_config.writer.max_retries + 1):
+            try:
+                inserted = self.session.insert_many(documents)
+            except Exception as e:
+                if attempt == _config.writer.max_retries:
+                    self.give_up(batch, e)
+                    return
+                logger.warning(f'{self} failed writing a batch of {len(batch)} articles, '
+                               f'trying again: {e}')
+                time.sleep(_config.writer.retry_delay)
+            else:
+                break
+        STAGE_SECONDS.observe(time.perf_counter() - serialised, stage=INSERT)
+        latency = time.perf_counter() - started
+        ARTICLES_WRITTEN.inc(inserted)
+
+        with self.__lock:
+            self.__batches += 1
+            self.__documents += inserted
+            self.__total_latency += latency
+            self.__max_latency = max(self.__max_latency, latency)
+            self.__last_latency = latency
+        logger.debug(f'{self} wrote {inserted}/{len(batch)} articles '
+                     f'in {latency * 1000:.1f} ms')
+
+    def give_up(self, batch: List[Any], error: Exception):
+        with self.__lock:
+            self.__failed_batches += 1
+        self.error = f'cannot write a batch of {len(batch)} articles: {error}'
+        logger.error(f'{self} {self.error}, articles after it are discarded')
@@ -0,0 +1,315 @@
+"""
+Implements distributed crawling. A crawl job is split into print list
+ranges recorded as tasks in a shared collection, which crawl workers,
+running as separate processes on this or other machines, claim with
+leases, fetch, parse and write to the shared session collection.
+
+Start workers with:
+
+    python -m _a_big_red_button.crawler.distributed --processes 4
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import argparse
+import datetime
+import multiprocessing
+import threading
+import time
+from typing import *
+
+from pymongo import ReturnDocument, ASCENDING
+
+from _a_big_red_button.crawler.core import WokSearchResult
+from _a_big_red_button.crawler.search_cache import WokSearchCache
+from _a_big_red_button.crawler.crawl_metrics import ARTICLES_CRAWLED, ARTICLES_WRITTEN
+from _a_big_red_button.crawler.db import WokPersistentStorage, WokPersistentSession
+from _a_big_red_button.crawler.db_job import PROCESS_OWNER
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.mongo_db import MongoDocumentAsPyObject
+from _a_big_red_button.support.mongo_db.searching import MongoSearchMixin
+
+# prepare logger
+logger = get_logger('crawler')
+
+# get config
+_config = get_config('crawler')
+_db_config = get_config('db')
+
+
+class WokCrawlTask(MongoDocumentAsPyObject, MongoSearchMixin):
+    _collection = WokPersistentStorage().database.get_collection(
+        _db_config.collections.crawl_tasks)
+
+    # states of a task
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # typed field notation
+    job_id: str
+    term: str
+    start: int
+    end: int
+    year_range: Optional[List[int]]
+    state: str
+    owner: Optional[str]
+    lease_expires: datetime.datetime
+    attempts: int
+    articles: int
+    error: Optional[str]
+
+    def __init__(self, src: dict):
+        super().__init__(src)
+
+    def __repr__(self):
+        return f'WokCrawlTask(job_id={self.job_id}, range=[{self.start} -> {self.end}], ' \
+               f'state={self.state})'
+
+    @staticmethod
+    def ensure_index():
+        WokCrawlTask._collection.create_index(
+            [('job_id', ASCENDING), ('start', ASCENDING)], unique=True)
+        WokCrawlTask._collection.create_index(
+            [('state', ASCENDING), ('lease_expires', ASCENDING)])
+
+    @staticmethod
+    def split_job(job_id: str, term: str, start: int, end: int,
+                  year_range: Optional[range]) -> int:
+        """
+        Split a crawl into print list ranges. Splitting the same job again
+        is harmless, ranges already recorded are left as they are.
+
+        :return: number of tasks of the job
+        """
+        WokCrawlTask.ensure_index()
+        step = _config.core.result_iter_step
+        count = 0
+        for task_start in range(start, end + 1, step):
+            WokCrawlTask._collection.update_one(
+                {'job_id': job_id, 'start': task_start},
+                {'$setOnInsert': {
+                    'term': term,
+                    'end': min(task_start + step - 1, end),
+                    'year_range': None if year_range is None else
+                    [year_range.start, year_range.stop - 1],
+                    'state': WokCrawlTask.PENDING,
+                    'owner': None,
+                    'lease_expires': datetime.datetime.utcfromtimestamp(0),
+                    'attempts': 0,
+                    'articles': 0,
+                    'error': None}},
+                upsert=True)
+            count += 1
+        return count
+
+    @staticmethod
+    def claim(owner: str) -> Optional['WokCrawlTask']:
+        """Atomically claim a pending task, or a claimed one whose lease has expired."""
+        now = datetime.datetime.utcnow()
+        document = WokCrawlTask._collection.find_one_and_update(
+            {'state': {'$in': [WokCrawlTask.PENDING, WokCrawlTask.CLAIMED]},
+             'lease_expires': {'$lt': now}},
+            {'$set': {'state': WokCrawlTask.CLAIMED,
+                      'owner': owner,
+                      'lease_expires': now + datetime.timedelta(
+                          seconds=_config.distributed.lease_seconds)},
+             '$inc': {'attempts': 1}},
+            sort=[('lease_expires', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        return None if document is None else WokCrawlTask(document)
+
+    def __conclude(self, owner: str, fields: dict):
+        self._collection.update_one(
+            {'_id': self.object_id, 'owner': owner}, {'$set': fields})
+
+    def complete(self, owner: str, articles: int):
+        self.__conclude(owner, {'state': self.DONE, 'articles': articles, 'error': None})
+
+    def fail(self, owner: str, error: str):
+        # give the task back unless it has been tried too many times
+        state = self.FAILED if self.attempts >= _config.distributed.max_attempts else self.PENDING
+        self.__conclude(owner, {'state': state, 'error': error,
+                                'lease_expires': datetime.datetime.utcfromtimestamp(0)})
+
+    @staticmethod
+    def done_ranges(job_id: str) -> List[Tuple[int, int]]:
+        """Ranges of the tasks of a job that are done, inclusive on both ends."""
+        return [(task['start'], task['end']) for task in WokCrawlTask._collection.find(
+            {'job_id': job_id, 'state': WokCrawlTask.DONE}, {'start': 1, 'end': 1})]
+
+    @staticmethod
+    def progress(job_id: str) -> Dict[str, int]:
+        """Count tasks of a job by state, together with the articles written."""
+        progress = {state: 0 for state in (WokCrawlTask.PENDING, WokCrawlTask.CLAIMED,
+                                           WokCrawlTask.DONE, WokCrawlTask.FAILED)}
+        progress['articles'] = 0
+        for group in WokCrawlTask._collection.aggregate([
+            {'$match': {'job_id': job_id}},
+            {'$group': {'_id': '$state', 'count': {'$sum': 1},
+                        'articles': {'$sum': '$articles'}}}]):
+            progress[group['_id']] = group['count']
+            progress['articles'] += group['articles']
+        return progress
+
+
+class WokDistributedCrawlWorker:
+    """
+    Claims tasks one at a time and crawls them. Searches are made on demand
+    and reused through the search cache for every task of the same term.
+    """
+
+    def __init__(self, name: str = None):
+        self.owner = f'{PROCESS_OWNER}:{name or threading.current_thread().name}'
+
+    def __repr__(self):
+        return f'WokDistributedCrawlWorker(owner={self.owner})'
+
+    @staticmethod
+    def search(term: str, refresh: bool = False) -> WokSearchResult:
+        return WokSearchCache().search(term, refresh)
+
+    def run_task(self, task: WokCrawlTask):
+        try:
+            search_result = self.search(task.term)
+            print_list = search_result.fetch_print_list(task.start, task.end)
+            if print_list is None:
+                # the search may have expired, search again next time
+                WokSearchCache().invalidate(task.term)
+                task.fail(self.owner, 'cannot request print list')
+                return
+
+            year_range = None if task.year_range is None else \
+                range(task.year_range[0], task.year_range[1] + 1)
+            documents = [article.as_export_dict()
+                         for article in print_list.find_all_articles(year_range)]
+            ARTICLES_CRAWLED.inc(len(documents))
+            ARTICLES_WRITTEN.inc(WokPersistentStorage()[task.term].insert_many(documents))
+        except Exception as e:
+            logger.error(f'{self} failed {task}: {e}')
+            task.fail(self.owner, f'{e}')
+        else:
+            task.complete(self.owner, len(documents))
+            logger.info(f'{self} finished {task} with {len(documents)} articles')
+
+    def run(self, idle_timeout: float = None):
+        """
+        Claim and crawl tasks until interrupted, or until no task has been
+        available for the given number of seconds.
+        """
+        logger.info(f'{self} started')
+        idle_since = time.monotonic()
+        while True:
+            task = WokCrawlTask.claim(self.owner)
+            if task is None:
+                if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                    break
+                time.sleep(_config.distributed.poll_interval)
+                continue
+
+            self.run_task(task)
+            idle_since = time.monotonic()
+            time.sleep(_config.core.worker_intermission)
+        logger.info(f'{self} concluded')
+
+
+class WokDistributedCrawl(threading.Thread):
+    """
+    Coordinates a crawl carried out by distributed workers. It offers the
+    same progress interface as the crawler of the controller so that the
+    scheduler can run either.
+    """
+
+    def __init__(self, job_id: str, wok_result: WokSearchResult,
+                 start: int, end: int, year_range: range = None,
+                 session: WokPersistentSession = None):
+        super().__init__()
+        self.job_id = job_id
+        self.result = wok_result
+        self.start_, self.end, self.year_range = start, end, year_range
+        if self.start_ <= 0:
+            self.start_ = 1
+        if self.end <= 0 or self.end > self.result.result_count:
+            self.end = self.result.result_count
+        self.session = session
+        self.finished_count = 0
+        self.started_at: Optional[float] = None
+        self.__mutex = threading.Lock()
+        self.__done = False
+        self.__error = False
+
+    @property
+    def done(self):
+        with self.__mutex:
+            return self.__done
+
+    @property
+    def in_error(self):
+        with self.__mutex:
+            return self.__done and self.__error
+
+    @property
+    def articles_per_second(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started_at
+        return self.finished_count / elapsed if elapsed > 0 else 0.0
+
+    def run(self) -> None:
+        from _a_big_red_button.crawler.db_meta import WokPersistentSessionMeta
+        self.started_at = time.monotonic()
+        try:
+            # workers write into the session named by the term of the task, which
+            # must be that of the session of the job rather than the searched term
+            total = WokCrawlTask.split_job(self.job_id, self.session.term,
+                                           self.start_, self.end, self.year_range)
+            logger.info(f'split crawl job(id={self.job_id}) into {total} tasks, '
+                        f'waiting for crawl workers...')
+            while True:
+                progress = WokCrawlTask.progress(self.job_id)
+                self.finished_count = progress['articles']
+                if progress[WokCrawlTask.DONE] + progress[WokCrawlTask.FAILED] >= total:
+                    break
+                time.sleep(_config.distributed.poll_interval)
+        except Exception as e:
+            logger.error(f'distributed crawl job(id={self.job_id}) failed: {e}')
+            with self.__mutex:
+                self.__done, self.__error = True, True
+            return
+
+        if progress[WokCrawlTask.FAILED]:
+            logger.warning(f'{progress[WokCrawlTask.FAILED]} tasks of crawl '
+                           f'job(id={self.job_id}) failed and have been skipped')
+
+        # update meta, ranges of failed tasks have not been crawled
+        for task_start, task_end in WokCrawlTask.done_ranges(self.job_id):
+            WokPersistentSessionMeta.record_crawl(self.session, range(task_start, task_end + 1))
+        WokPersistentSessionMeta.record_crawl(self.session)
+
+        with self.__mutex:
+            self.__done = True
+
+
+def _run_worker_process(number: int, idle_timeout: Optional[float]):
+    WokDistributedCrawlWorker(f'worker-{number}').run(idle_timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run distributed crawl workers.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of worker processes on this machine')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='stop after no task has been available for this many seconds')
+    arguments = parser.parse_args()
+
+    # every process opens its own database connection
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_run_worker_process,
+                                 args=(i, arguments.idle_timeout))
+                 for i in range(arguments.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -11,23 +11,25 @@ Kevin Ni, kevin.ni@nyu.edu.
 
 from _a_big_red_button.crawler.db import WokPersistentSession
 from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportHelper
+from _a_big_red_button.crawler.export_graph import WokGraph, WokGraphBuilder, export_graph
 from _a_big_red_button.crawler.export.tools import *
 
+# first authors cite other authors
+DIRECTED = True
 
-def export(session: WokPersistentSessionExportHelper):
-    data = dict()
-    for article in session.articles:
-        data[article.first_author_abbr] = {}
 
+def build(session: WokPersistentSessionExportHelper, graph: WokGraphBuilder):
     for article in session.articles:
         first_author = article.first_author_abbr
+        graph.add_node(first_author)
         for citation in article['citation']:
-            cited_author = normalize_name(citation.first_author)
-            if cited_author in data:
-                if cited_author not in data[first_author]:
-                    data[first_author][cited_author] = 0
-                data[first_author][cited_author] += 1
-
-    for a, a_val in data.items():
-        for b, b_val in a_val.items():
-            session.write_edge(a, b, b_val)
+            graph.add_edge(first_author, normalize_name(citation.first_author))
+
+
+def finalise(graph: WokGraphBuilder) -> WokGraph:
+    # only cited authors who are first authors in the session are kept
+    return graph.finalise().where(lambda source, target: target in graph.nodes)
+
+
+def export(session: WokPersistentSessionExportHelper):
+    export_graph(session, build, finalise, directed=DIRECTED)
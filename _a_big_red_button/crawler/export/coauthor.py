@@ -11,30 +11,23 @@ Kevin Ni, kevin.ni@nyu.edu.
 # also please do not touch the default import lines
 
 from pathlib import Path
-from itertools import combinations
 from _a_big_red_button.crawler.db import WokPersistentSession
 from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportHelper
+from _a_big_red_button.crawler.export_graph import WokGraphBuilder, export_graph
 from _a_big_red_button.crawler.export.tools import *
 
+# co-authorship does not constitute direction
+DIRECTED = False
 
-def export(session: WokPersistentSessionExportHelper):
-    # first construct a dict from authors to count of co-authors
-    data = dict()
 
-    # then scan through the articles and count co-authors for every user
+def build(session: WokPersistentSessionExportHelper, graph: WokGraphBuilder):
+    # scan through the articles and connect every single pair of co-authors
     for article in session.articles:
-        # generate enumeration for every single pair of co-authorship
-        # this has to be permutation aka. unordered since co-authorship
-        # does not constitute direction
-        for (author_a, author_b) in combinations(article.all_authors_full, 2):
-            identifier = frozenset([author_a, author_b])
-            if identifier not in data:
-                data[identifier] = 0
-            data[identifier] += 1
-
-    # then glue together authors that have publish that shares keywords
-    for (a, b), count in data.items():
-        session.write_edge(str(a), str(b), count)
+        graph.add_clique(article.all_authors_full)
+
+
+def export(session: WokPersistentSessionExportHelper):
+    export_graph(session, build, directed=DIRECTED)
 
 
 if __name__ == '__main__':
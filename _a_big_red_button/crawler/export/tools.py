@@ -5,13 +5,80 @@ process easier.
 Kevin Ni, kevin.ni@nyu.edu.
 """
 
+from itertools import combinations
+from typing import *
+
+from _a_big_red_button.crawler.author_names import normalise_name
+
+# sparse matrices are optional, keywords are paired through an inverted index without them
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy, scipy = None, None
+
 
 def is_same_author(a: str, b: str):
-    a, b = a.upper(), b.upper()
-    a, b = a.strip(), b.strip()
-    a, b = a.replace('.', ''), b.replace('.', '')
-    return a == b
+    return normalise_name(a) == normalise_name(b)
 
 
 def normalize_name(a: str):
-    return a.upper().strip().replace('.', '').replace(',', '')
+    return normalise_name(a)
+
+
+def keyword_cooccurrence(counts: Dict[str, Dict[str, int]], sparse: bool = None) \
+        -> Dict[Tuple[str, str], int]:
+    """
+    Weigh every pair of authors sharing keywords by the sum of how many
+    times either of them used every keyword they share. Only authors that
+    actually share a keyword are ever paired.
+
+    :param counts: author -> keyword -> times the author used the keyword
+    :param sparse: whether to multiply sparse author by keyword matrices
+        rather than walk an inverted index, None to do so if SciPy is available
+    :return: (author, another author) -> weight, every pair of authors once
+    """
+    if sparse is None:
+        sparse = scipy is not None
+    if sparse:
+        return _keyword_cooccurrence_sparse(counts)
+
+    # keyword -> authors who used it and how many times, authors in the order of counts
+    authors = list(counts)
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for author_id, keywords in enumerate(counts.values()):
+        for keyword, count in keywords.items():
+            if count > 0:
+                postings.setdefault(keyword, []).append((author_id, count))
+
+    weights: Dict[Tuple[int, int], int] = {}
+    for posting in postings.values():
+        for (author_a, count_a), (author_b, count_b) in combinations(posting, 2):
+            pair = (author_a, author_b)
+            weights[pair] = weights.get(pair, 0) + count_a + count_b
+    return {(authors[a], authors[b]): weight for (a, b), weight in weights.items()}
+
+
+def _keyword_cooccurrence_sparse(counts: Dict[str, Dict[str, int]]) -> Dict[Tuple[str, str], int]:
+    # with M the author by keyword counts and B its incidence, M Bt + B Mt
+    # sums the counts of both authors over the keywords they share
+    authors = list(counts)
+    keyword_ids: Dict[str, int] = {}
+    rows, columns, values = [], [], []
+    for author_id, keywords in enumerate(counts.values()):
+        for keyword, count in keywords.items():
+            if count > 0:
+                rows.append(author_id)
+                columns.append(keyword_ids.setdefault(keyword, len(keyword_ids)))
+                values.append(count)
+
+    shape = (len(authors), len(keyword_ids))
+    counted = scipy.sparse.csr_matrix((numpy.array(values, dtype=numpy.int64), (rows, columns)),
+                                      shape=shape)
+    incidence = scipy.sparse.csr_matrix((numpy.ones(len(values), dtype=numpy.int64), (rows, columns)),
+                                        shape=shape)
+    shared = counted @ incidence.T
+    weights = scipy.sparse.triu(shared + shared.T, k=1).tocoo()
+    return {(authors[a], authors[b]): int(weight)
+            for a, b, weight in zip(weights.row.tolist(), weights.col.tolist(), weights.data.tolist())
+            if weight > 0}
@@ -0,0 +1,464 @@
+"""
+Implements an executor running exports in a pool of processes, so that
+export scripts no longer fight over the GIL of the web app and of each
+other. Sessions of scripts declaring their edges in a build function are
+split into shards of consecutive _id, built in parallel and merged into
+one graph, other scripts are run as a whole in a single process. A batch
+exports many sessions with many scripts at once.
+
+Sharded exports are incremental by default: the merged builder of every
+shard but the most recent is saved as the state of the export, see
+export_state, and the next export of the session only builds documents
+inserted since.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import datetime
+import multiprocessing
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+
+from pymongo import ASCENDING
+
+from _a_big_red_button.crawler.db import WokPersistentSession
+from _a_big_red_button.crawler.db_job import WokPersistentJob
+from _a_big_red_button.crawler.export_graph import WokGraphBuilder
+from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportHelper, \
+    WokPersistentSessionExportShard, WokExportProgress, WokExportCancelled
+from _a_big_red_button.crawler.export_script_helper import WokPersistentSessionExportScript
+from _a_big_red_button.crawler.export_state import WokExportState, checkpoint_now
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.directory import DEPLOYMENT_ROOT
+from _a_big_red_button.support.event_stream import EVENT_CHANNEL
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.singleton import Singleton
+
+# prepare logger
+logger = get_logger('export')
+
+# get config
+config = get_config('export')
+
+
+def plan_shards(session: WokPersistentSession, shard_size: int,
+                lower: Any = None, upper: Any = None) \
+        -> List[Tuple[Optional[Any], Optional[Any], int]]:
+    """
+    Split a range of _id of a session into ranges holding at most the given
+    number of documents each, as (lowest _id, _id after the highest,
+    documents), None meaning unbounded. A range without documents has no shards.
+    """
+    query = WokPersistentSessionExportShard(session, lower, upper).filter
+    total = session.collection.count_documents(query)
+    if total == 0:
+        return []
+    bounds = [lower]
+    for offset in range(shard_size, total, shard_size):
+        for document in session.collection.find(query, {'_id': 1}) \
+                .sort('_id', ASCENDING).skip(offset).limit(1):
+            bounds.append(document['_id'])
+    bounds.append(upper)
+    return [(lower, upper, min(shard_size, total - number * shard_size))
+            for number, (lower, upper) in enumerate(zip(bounds, bounds[1:]))]
+
+
+def _build_shard(session_id: str, script_name: str, lower: Optional[Any], upper: Optional[Any],
+                 progress: WokExportProgress) -> WokGraphBuilder:
+    # run in a process of the pool
+    script = WokPersistentSessionExportScript(script_name).script
+    shard = WokPersistentSessionExportShard(
+        WokPersistentSession.find_by_session_id(session_id), lower, upper, progress)
+    graph = WokGraphBuilder(getattr(script, 'DIRECTED', False))
+    script.build(shard, graph)
+    # reduced here in parallel, so that less is pickled and merged by the coordinator
+    graph.compact()
+    return graph
+
+
+def _export_whole(session_id: str, script_name: str, export_file: str,
+                  export_format: Optional[str], progress: WokExportProgress,
+                  profile: bool = None) -> bool:
+    # run in a process of the pool, or in this one
+    helper = WokPersistentSessionExportHelper(
+        WokPersistentSession.find_by_session_id(session_id), Path(export_file), export_format, progress)
+    try:
+        return WokPersistentSessionExportScript(script_name).run(helper, profile)
+    finally:
+        helper.close()
+
+
+class WokExportJob:
+    # states of a job
+    QUEUED = 'queued'
+    EXPORTING = 'exporting'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, session: WokPersistentSession, script: WokPersistentSessionExportScript,
+                 export_file: Path, export_format: str = None, batch_id: str = None,
+                 in_process: bool = False, profile: bool = None, incremental: bool = None,
+                 persistent: WokPersistentJob = None):
+        """
+        :param in_process: whether to run the export in this process rather than in the pool
+        :param profile: whether to profile the export, which is then run in this process
+        :param incremental: whether to build on the saved state of the export, as configured if not given
+        :param persistent: record of the job claimed from the database, made anew if not given
+        """
+        self.job_id = uuid.uuid4().hex if persistent is None else persistent.job_id
+        self.batch_id = batch_id
+        self.session, self.script = session, script
+        self.export_file, self.export_format = export_file, export_format
+        self.profile = profile
+        self.in_process = in_process or bool(profile)
+        self.incremental = config.incremental.enabled if incremental is None else incremental
+        self.state = self.QUEUED
+        self.error: Optional[str] = None
+        self.shards_total, self.shards_done = 0, 0
+        self.documents_total = 0
+        self.documents_reused = 0  # built into the saved state rather than read again
+        self.submitted = datetime.datetime.now()
+        self.started_at: Optional[datetime.datetime] = None
+        self.finished_at: Optional[datetime.datetime] = None
+
+        # documents read per shard, and the event cancelling the export,
+        # shared with the processes of the pool if run there
+        self.counts: MutableMapping[int, int] = {}
+        self.cancelled = threading.Event()
+
+        # exports are run again from scratch should this process go down
+        self.persistent = persistent
+        if self.persistent is None:
+            try:
+                self.persistent = WokPersistentJob.make_new(self.job_id, WokPersistentJob.EXPORT, {
+                    'session_id': session.session_id,
+                    'export_script': script.name,
+                    'export_file': str(export_file),
+                    'export_format': export_format,
+                    'profile': profile,
+                    'incremental': incremental
+                })
+            except Exception as e:
+                logger.error(f'cannot persist {self}, it will not survive a restart: {e}')
+
+    @staticmethod
+    def from_persistent(persistent: WokPersistentJob) -> Optional['WokExportJob']:
+        """Restore an export claimed from the database, None if it can no longer be run."""
+        from _a_big_red_button.crawler.export_script_helper import get_export_script
+        parameters = persistent.parameters
+        session = WokPersistentSession.find_by_session_id(parameters.session_id)
+        script = get_export_script(parameters.export_script)
+        if session is None or script is None:
+            return None
+        return WokExportJob(session, script, Path(parameters.export_file),
+                            getattr(parameters, 'export_format', None),
+                            in_process=not config.executor.enabled,
+                            profile=getattr(parameters, 'profile', None),
+                            incremental=getattr(parameters, 'incremental', None),
+                            persistent=persistent)
+
+    def __repr__(self):
+        return f'WokExportJob(id={self.job_id}, session_id={self.session.session_id}, ' \
+               f'script={self.script.name}, state={self.state})'
+
+    @property
+    def finished(self):
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def progress(self, key: int) -> WokExportProgress:
+        """Progress of a shard of this export, to be handed to where it is run."""
+        return WokExportProgress(self.counts, key, self.cancelled)
+
+    def cancel(self) -> bool:
+        """
+        Ask the export to stop, which it does within a few documents.
+        Returns whether the export was still running.
+        """
+        if self.finished:
+            return False
+        self.cancelled.set()
+        logger.info(f'cancelling {self}')
+        return True
+
+    def publish(self):
+        """Push the status of this job to clients listening to the event stream."""
+        EVENT_CHANNEL.publish('export', **self.dict)
+
+    def transit(self, state: str, error: str = None):
+        self.state, self.error = state, error
+        if state == self.EXPORTING:
+            self.started_at = datetime.datetime.now()
+        elif self.finished:
+            self.finished_at = datetime.datetime.now()
+        self.publish()
+        if self.persistent is None:
+            return
+        try:
+            self.persistent.update_state(state, error)
+        except Exception as e:
+            logger.error(f'cannot persist the state of {self}: {e}')
+
+    def shard_done(self, key: int, documents: int):
+        self.counts[key] = documents
+        self.shards_done += 1
+        self.publish()
+
+    @property
+    def documents_done(self) -> int:
+        try:
+            return sum(self.counts.values())
+        except Exception:
+            # the shared mapping is gone with the pool
+            return 0
+
+    @property
+    def elapsed_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return ((self.finished_at or datetime.datetime.now()) - self.started_at).total_seconds()
+
+    @property
+    def documents_per_second(self) -> float:
+        elapsed = self.elapsed_seconds
+        return self.documents_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        rate = self.documents_per_second
+        if self.finished or rate <= 0:
+            return None
+        return max(self.documents_total - self.documents_done, 0) / rate
+
+    @property
+    def dict(self):
+        eta_seconds = self.eta_seconds
+        return {
+            'job_id': self.job_id,
+            'batch_id': self.batch_id,
+            'session_id': self.session.session_id,
+            'term': self.session.term,
+            'export_script': self.script.name,
+            'export_file': str(self.export_file),
+            'export_format': self.export_format,
+            'in_process': self.in_process,
+            'incremental': self.incremental,
+            'state': self.state,
+            'error': self.error,
+            'shards': self.shards_total,
+            'shards_done': self.shards_done,
+            'documents': self.documents_total,
+            'documents_done': self.documents_done,
+            'documents_reused': self.documents_reused,
+            'documents_per_second': round(self.documents_per_second, 2),
+            'eta_seconds': None if eta_seconds is None else round(eta_seconds, 1),
+            'cancel_requested': self.cancelled.is_set(),
+            'submitted': self.submitted.isoformat(),
+            'started_at': None if self.started_at is None else self.started_at.isoformat(),
+            'finished_at': None if self.finished_at is None else self.finished_at.isoformat()
+        }
+
+
+class WokExportExecutor(metaclass=Singleton):
+    def __init__(self):
+        # every process opens its own database connection
+        context = multiprocessing.get_context('spawn')
+        self.processes = ProcessPoolExecutor(config.executor.processes or None, mp_context=context)
+        # jobs are coordinated, i.e. sharded, merged and written, by a few threads
+        self.coordinators = ThreadPoolExecutor(config.executor.concurrent_jobs,
+                                               thread_name_prefix='export')
+        self.__context = context
+        self.__manager = None
+        self.__lock = threading.Lock()
+        self.__jobs: 'OrderedDict[str, WokExportJob]' = OrderedDict()
+        logger.info(f'export executor started with {config.executor.processes or "all"} processes')
+
+    @property
+    def manager(self):
+        """Serves the progress and cancellation shared with the processes of the pool."""
+        with self.__lock:
+            if self.__manager is None:
+                self.__manager = self.__context.Manager()
+            return self.__manager
+
+    def submit(self, session: WokPersistentSession, script: WokPersistentSessionExportScript,
+               export_file: Path, export_format: str = None, batch_id: str = None,
+               profile: bool = None, incremental: bool = None) -> WokExportJob:
+        return self.submit_job(WokExportJob(session, script, export_file, export_format, batch_id,
+                                            not config.executor.enabled, profile, incremental))
+
+    def submit_job(self, job: WokExportJob) -> WokExportJob:
+        if not job.in_process:
+            job.counts, job.cancelled = self.manager.dict(), self.manager.Event()
+        with self.__lock:
+            self.__jobs[job.job_id] = job
+            self.forget_finished_jobs()
+        self.coordinators.submit(self.run, job)
+        logger.info(f'submitted {job}')
+        return job
+
+    def submit_batch(self, sessions: Iterable[WokPersistentSession],
+                     scripts: Iterable[WokPersistentSessionExportScript],
+                     directory: Path = None, export_format: str = None) -> Tuple[str, List[WokExportJob]]:
+        """
+        Export every session with every script into a directory, files named
+        after the script and the session.
+
+        :param directory: the directory, the configured one if not given
+        :param export_format: format of all files, the default format if not given
+        """
+        batch_id = uuid.uuid4().hex
+        directory = directory or DEPLOYMENT_ROOT.joinpath(config.executor.directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        extension = export_format or config.sink.default_format
+        scripts = list(scripts)
+        jobs = [self.submit(session, script,
+                            directory.joinpath(f'{script.name}-{session.session_id}.{extension}'),
+                            export_format, batch_id)
+                for session in sessions for script in scripts]
+        logger.info(f'submitted batch {batch_id} of {len(jobs)} exports into {directory}')
+        return batch_id, jobs
+
+    def resume_unfinished_jobs(self):
+        """Claim exports left unfinished by previous processes and run them again."""
+        while True:
+            persistent = WokPersistentJob.claim_unfinished(WokPersistentJob.EXPORT)
+            if persistent is None:
+                break
+            job = WokExportJob.from_persistent(persistent)
+            if job is None:
+                logger.warning(f'cannot resume {persistent}: its session or '
+                               f'export script no longer exists')
+                persistent.update_state('failed', 'session or export script no longer exists')
+                continue
+            self.submit_job(job)
+            logger.info(f'resumed {job}')
+
+    def forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.__jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - config.executor.finished_job_retention, 0)]:
+            del self.__jobs[job_id]
+
+    def job(self, job_id: str) -> Optional[WokExportJob]:
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def batch(self, batch_id: str) -> List[WokExportJob]:
+        with self.__lock:
+            return [job for job in self.__jobs.values() if job.batch_id == batch_id]
+
+    @property
+    def jobs(self) -> List[WokExportJob]:
+        with self.__lock:
+            return list(self.__jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[WokExportJob]:
+        job = self.job(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def run(self, job: WokExportJob):
+        if job.cancelled.is_set():
+            job.transit(WokExportJob.CANCELLED)
+            return
+        job.transit(WokExportJob.EXPORTING)
+        try:
+            if job.in_process:
+                self.run_in_process(job)
+            elif hasattr(job.script.script, 'build'):
+                self.run_sharded(job)
+            else:
+                self.run_whole(job)
+        except WokExportCancelled:
+            job.transit(WokExportJob.CANCELLED)
+            logger.info(f'cancelled {job}')
+        except Exception as e:
+            logger.error(f'{job} failed: {e}')
+            job.transit(WokExportJob.FAILED, f'{e}')
+        else:
+            job.transit(WokExportJob.DONE)
+            logger.info(f'finished {job}')
+
+    def run_sharded(self, job: WokExportJob):
+        script = job.script.script
+        graph = WokGraphBuilder(getattr(script, 'DIRECTED', False))
+
+        # documents up to the checkpoint of the saved state are built into it already,
+        # those from there on are split into shards to be saved along with it and the
+        # recent ones, which may still be on their way into the session
+        state, saved_shards, dumped = None, [], None
+        if job.incremental:
+            state = WokExportState.load(job.session, job.script)
+            checkpoint = None if state is None else state.checkpoint
+            bound = checkpoint_now() if checkpoint is None else max(checkpoint, checkpoint_now())
+            saved_shards = plan_shards(job.session, config.executor.shard_size, checkpoint, bound)
+            shards = saved_shards + plan_shards(job.session, config.executor.shard_size, bound)
+            if state is not None:
+                graph, job.documents_reused = state.builder, state.documents
+                logger.info(f'{job} builds on {state}')
+        else:
+            shards = plan_shards(job.session, config.executor.shard_size)
+        job.shards_total = len(shards)
+        job.documents_total = sum(documents for _, _, documents in shards)
+        futures = [self.processes.submit(_build_shard, job.session.session_id, job.script.name,
+                                         lower, upper, job.progress(key))
+                   for key, (lower, upper, _) in enumerate(shards)]
+
+        # merged in the order of shards, so that the same session is always written the same way
+        try:
+            for key, future in enumerate(futures):
+                if job.incremental and key == len(saved_shards):
+                    # finalising may reduce the builder in place, it is saved as of now
+                    dumped = WokExportState.dump(graph)
+                graph.merge(future.result())
+                job.shard_done(key, shards[key][2])
+                if job.cancelled.is_set():
+                    raise WokExportCancelled('export cancelled')
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        if job.incremental and dumped is None:
+            dumped = WokExportState.dump(graph)
+
+        finalise = getattr(script, 'finalise', None)
+        result = graph.finalise() if finalise is None else finalise(graph)
+        helper = WokPersistentSessionExportHelper(job.session, job.export_file, job.export_format)
+        try:
+            helper.write_graph(result)
+        finally:
+            helper.close()
+
+        if job.incremental:
+            try:
+                documents = job.documents_reused + sum(documents for _, _, documents in saved_shards)
+                WokExportState.save(job.session.session_id, job.script, bound, documents, dumped)
+            except Exception as e:
+                # the export is written all the same, the next one starts over
+                logger.error(f'cannot save the state of {job}: {e}')
+
+    def run_whole(self, job: WokExportJob):
+        job.shards_total, job.documents_total = 1, len(job.session)
+        succeeded = self.processes.submit(
+            _export_whole, job.session.session_id, job.script.name,
+            str(job.export_file), job.export_format, job.progress(0)).result()
+        if not succeeded:
+            raise RuntimeError('export script failed, see the export log')
+        job.shard_done(0, job.documents_total)
+
+    def run_in_process(self, job: WokExportJob):
+        job.shards_total, job.documents_total = 1, len(job.session)
+        progress = job.progress(0)
+        # counted as it goes rather than every few documents
+        progress.report_every = 1
+        succeeded = _export_whole(job.session.session_id, job.script.name,
+                                  str(job.export_file), job.export_format, progress, job.profile)
+        if not succeeded:
+            raise RuntimeError('export script failed, see the export log')
+        job.shard_done(0, progress.documents)
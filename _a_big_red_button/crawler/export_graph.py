@@ -0,0 +1,272 @@
+"""
+Implements the engine export scripts build their graphs with. Names of
+authors, keywords and so on are interned to integer ids, edges are
+accumulated in array backed COO buffers, i.e. parallel arrays of sources,
+targets and weights, and reduced into one weight per pair of nodes, with
+SciPy sparse matrices if available. Builders can be pickled and merged,
+so that parts of a session can be built apart and put together.
+
+An export script declares its edges in a build function and lets the
+engine aggregate them:
+
+    def build(session: WokPersistentSessionExportHelper, graph: WokGraphBuilder):
+        for article in session.articles:
+            graph.add_clique(article.all_authors_full)
+
+    def export(session: WokPersistentSessionExportHelper):
+        export_graph(session, build)
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+from array import array
+from itertools import combinations
+from typing import *
+
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+
+# sparse matrices are optional, edges are reduced through a dict without them
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy, scipy = None, None
+
+# prepare logger
+logger = get_logger('export')
+
+# get config
+config = get_config('export')
+
+# type codes of the buffers, node ids fit in 32 bits while weights may not
+ID_TYPE = 'i'
+WEIGHT_TYPE = 'q'
+
+
+class NameInterner:
+    """Maps names to consecutive integer ids and back."""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name: str):
+        return name in self.ids
+
+    def intern(self, name: str) -> int:
+        node_id = self.ids.get(name)
+        if node_id is None:
+            node_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return node_id
+
+    def name(self, node_id: int) -> str:
+        return self.names[node_id]
+
+
+def _reduce(sources: array, targets: array, weights: array, node_count: int) \
+        -> Tuple[array, array, array]:
+    """Sum the weights of duplicated edges, returning new buffers."""
+    if scipy is not None and len(sources) > 0:
+        matrix = scipy.sparse.coo_matrix(
+            (numpy.frombuffer(weights, dtype=numpy.int64),
+             (numpy.frombuffer(sources, dtype=numpy.int32),
+              numpy.frombuffer(targets, dtype=numpy.int32))),
+            shape=(node_count, node_count)).tocsr().tocoo()
+        reduced = array(ID_TYPE), array(ID_TYPE), array(WEIGHT_TYPE)
+        reduced[0].frombytes(matrix.row.astype(numpy.int32).tobytes())
+        reduced[1].frombytes(matrix.col.astype(numpy.int32).tobytes())
+        reduced[2].frombytes(matrix.data.astype(numpy.int64).tobytes())
+        return reduced
+
+    totals: Dict[int, int] = {}
+    for source, target, weight in zip(sources, targets, weights):
+        pair = source << 32 | target
+        totals[pair] = totals.get(pair, 0) + weight
+    return (array(ID_TYPE, (pair >> 32 for pair in totals)),
+            array(ID_TYPE, (pair & 0xFFFFFFFF for pair in totals)),
+            array(WEIGHT_TYPE, totals.values()))
+
+
+class WokGraph:
+    """A reduced graph, i.e. one weight per pair of nodes."""
+
+    def __init__(self, names: List[str], sources: array, targets: array, weights: array,
+                 directed: bool):
+        self.names = names
+        self.sources, self.targets, self.weights = sources, targets, weights
+        self.directed = directed
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __repr__(self):
+        return f'WokGraph(nodes={self.node_count}, edges={len(self)}, directed={self.directed})'
+
+    @property
+    def node_count(self):
+        return len(self.names)
+
+    def edges(self) -> Iterator[Tuple[str, str, int]]:
+        names = self.names
+        for source, target, weight in zip(self.sources, self.targets, self.weights):
+            yield names[source], names[target], weight
+
+    def where(self, keep: Callable[[int, int], bool]) -> 'WokGraph':
+        """Keep the edges for whose source and target ids the given function is true."""
+        sources, targets, weights = array(ID_TYPE), array(ID_TYPE), array(WEIGHT_TYPE)
+        for source, target, weight in zip(self.sources, self.targets, self.weights):
+            if keep(source, target):
+                sources.append(source)
+                targets.append(target)
+                weights.append(weight)
+        return WokGraph(self.names, sources, targets, weights, self.directed)
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        """source -> target -> weight"""
+        data: Dict[str, Dict[str, int]] = {}
+        for source, target, weight in self.edges():
+            data.setdefault(source, {})[target] = weight
+        return data
+
+    def adjacency(self):
+        """The weighted adjacency matrix, symmetric for undirected graphs, requires SciPy."""
+        if scipy is None:
+            raise RuntimeError('cannot make adjacency matrix: SciPy is not available')
+        sources = numpy.frombuffer(self.sources, dtype=numpy.int32)
+        targets = numpy.frombuffer(self.targets, dtype=numpy.int32)
+        weights = numpy.frombuffer(self.weights, dtype=numpy.int64)
+        if not self.directed:
+            sources, targets = numpy.concatenate((sources, targets)), numpy.concatenate((targets, sources))
+            weights = numpy.concatenate((weights, weights))
+        return scipy.sparse.csr_matrix((weights, (sources, targets)),
+                                       shape=(self.node_count, self.node_count))
+
+
+class WokGraphBuilder:
+    """
+    Accumulates the edges of a graph. Edges of undirected graphs are stored
+    with the smaller id first, so that a pair of nodes is one edge either way.
+    """
+
+    def __init__(self, directed: bool = False, compact_threshold: int = None):
+        """
+        :param directed: whether edges have directions
+        :param compact_threshold: buffered edges beyond which duplicates are reduced
+        """
+        self.directed = directed
+        self.compact_threshold = config.graph.compact_threshold \
+            if compact_threshold is None else compact_threshold
+        self.names = NameInterner()
+        self.nodes: Set[int] = set()  # nodes added explicitly, with or without edges
+        self.sources, self.targets = array(ID_TYPE), array(ID_TYPE)
+        self.weights = array(WEIGHT_TYPE)
+        self.__compacted_size = 0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __repr__(self):
+        return f'WokGraphBuilder(nodes={len(self.names)}, buffered_edges={len(self)}, ' \
+               f'directed={self.directed})'
+
+    def add_node(self, name: str) -> int:
+        node_id = self.names.intern(name)
+        self.nodes.add(node_id)
+        return node_id
+
+    def __append(self, source: int, target: int, weight: int):
+        if not self.directed and source > target:
+            source, target = target, source
+        self.sources.append(source)
+        self.targets.append(target)
+        self.weights.append(weight)
+
+    def add_edge(self, source: str, target: str, weight: int = 1):
+        self.__append(self.names.intern(source), self.names.intern(target), weight)
+        self.__maybe_compact()
+
+    def add_clique(self, names: Iterable[str], weight: int = 1):
+        """Connect every pair of the given names, names repeated are connected only once."""
+        node_ids = list(dict.fromkeys(self.names.intern(name) for name in names))
+        for source, target in combinations(node_ids, 2):
+            self.__append(source, target, weight)
+        self.__maybe_compact()
+
+    def __maybe_compact(self):
+        # compacting is only worth it once enough edges have been added since last time
+        if len(self.sources) - self.__compacted_size >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """Reduce duplicated edges in place, bounding memory by the number of distinct edges."""
+        self.sources, self.targets, self.weights = _reduce(
+            self.sources, self.targets, self.weights, len(self.names))
+        self.__compacted_size = len(self.sources)
+        logger.debug(f'compacted {self}')
+
+    def merge(self, other: 'WokGraphBuilder'):
+        """Add the nodes and edges of another builder of the same kind of graph."""
+        if other.directed != self.directed:
+            raise RuntimeError(f'cannot merge {other} into {self}: directions differ')
+        remap = array(ID_TYPE, (self.names.intern(name) for name in other.names.names))
+        self.nodes.update(remap[node_id] for node_id in other.nodes)
+        if numpy is None:
+            for source, target, weight in zip(other.sources, other.targets, other.weights):
+                self.__append(remap[source], remap[target], weight)
+        elif len(other.sources) > 0:
+            # ids are remapped and appended as whole arrays rather than edge by edge
+            remap = numpy.frombuffer(remap, dtype=numpy.int32)
+            sources = remap[numpy.frombuffer(other.sources, dtype=numpy.int32)]
+            targets = remap[numpy.frombuffer(other.targets, dtype=numpy.int32)]
+            if not self.directed:
+                sources, targets = numpy.minimum(sources, targets), numpy.maximum(sources, targets)
+            self.sources.frombytes(sources.tobytes())
+            self.targets.frombytes(targets.tobytes())
+            self.weights.frombytes(other.weights.tobytes())
+        self.__maybe_compact()
+
+    def finalise(self) -> WokGraph:
+        self.compact()
+        return WokGraph(list(self.names.names), self.sources, self.targets, self.weights,
+                        self.directed)
+
+    def __getstate__(self):
+        return {'directed': self.directed, 'compact_threshold': self.compact_threshold,
+                'names': self.names.names, 'nodes': self.nodes,
+                'sources': self.sources, 'targets': self.targets, 'weights': self.weights}
+
+    def __setstate__(self, state):
+        self.directed = state['directed']
+        self.compact_threshold = state['compact_threshold']
+        self.names = NameInterner()
+        for name in state['names']:
+            self.names.intern(name)
+        self.nodes = state['nodes']
+        self.sources, self.targets = state['sources'], state['targets']
+        self.weights = state['weights']
+        self.__compacted_size = len(self.sources)
+
+
+def export_graph(session, build: Callable[[Any, WokGraphBuilder], None],
+                 finalise: Callable[[WokGraphBuilder], WokGraph] = None,
+                 directed: bool = False) -> WokGraph:
+    """
+    Build a graph of a session with the build function of an export script,
+    reduce it with its finalise function if any, and write it.
+
+    :param session: the export helper of the session
+    :param build: function declaring the edges of the session
+    :param finalise: function turning the builder into the exported graph
+    :param directed: whether edges have directions
+    """
+    graph = WokGraphBuilder(directed)
+    build(session, graph)
+    logger.info(f'built {graph} for {session}')
+    result = graph.finalise() if finalise is None else finalise(graph)
+    session.write_graph(result)
+    return result
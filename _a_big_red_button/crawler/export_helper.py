@@ -5,40 +5,84 @@ code for exporting to Gephi is easier.
 Kevin NI, kevin.ni@nyu.edu.
 """
 
-from typing import List, Any
+from typing import List, Any, Optional, MutableMapping
 from pathlib import Path
 import shutil
+import threading
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.support.configuration import get_config
 from _a_big_red_button.crawler.db import WokPersistentSession, MongoDocumentAsPyObject
 from _a_big_red_button.crawler.db_article import WokArticleStub
 from _a_big_red_button.crawler import WokPersistentSessionMeta
+from _a_big_red_button.crawler.export_sink import WokEdgeSink, make_sink
+from _a_big_red_button.crawler.session_snapshot import session_documents
 from _a_big_red_button.crawler.export.tools import *
 
 # prepare logger
 logger = get_logger('export')
 
 
+class WokExportCancelled(RuntimeError):
+    """Raised to export scripts reading the articles of a cancelled export."""
+
+
+class WokExportProgress:
+    """
+    Counts the documents an export has read, and stops it once cancelled.
+    Exports run in other processes report into a shared mapping and are
+    cancelled through a shared event, both checked every few documents.
+    """
+    report_every = 1000
+
+    def __init__(self, counts: MutableMapping[int, int] = None, key: int = 0, cancelled=None):
+        """
+        :param counts: shared mapping to report the documents read into, if any
+        :param key: key of this export, or part of it, in the mapping
+        :param cancelled: event set to cancel the export
+        """
+        self.documents = 0
+        self.counts, self.key = counts, key
+        self.cancelled = cancelled or threading.Event()
+
+    def advance(self):
+        self.documents += 1
+        if self.documents % self.report_every == 0:
+            self.report()
+            if self.cancelled.is_set():
+                raise WokExportCancelled('export cancelled')
+
+    def report(self):
+        if self.counts is not None:
+            self.counts[self.key] = self.documents
+
+
 class WokPersistentSessionExportHelper:
     @staticmethod
-    def from_session_id(session_id: str, file_name: Path):
+    def from_session_id(session_id: str, file_name: Path, export_format: str = None):
         return WokPersistentSessionExportHelper(
             WokPersistentSession.find_by_session_id(session_id),
-            file_name
+            file_name, export_format
         )
 
     @staticmethod
-    def from_term(term: str, file_name: Path):
+    def from_term(term: str, file_name: Path, export_format: str = None):
         return WokPersistentSessionExportHelper(
             WokPersistentSession.find_by_term(term),
-            file_name
+            file_name, export_format
         )
 
-    def __init__(self, session: WokPersistentSession, file_name: Path):
+    def __init__(self, session: WokPersistentSession, file_name: Path, export_format: str = None,
+                 progress: WokExportProgress = None):
+        """
+        :param export_format: format of the export file, None to pick by its extension
+        :param progress: progress to count the articles read in
+        """
         self.session = session
+        self.progress = progress or WokExportProgress()
         self.meta = WokPersistentSessionMeta.find_by_session(self.session)
         self.file_name = file_name
         self.data = dict()
+        self.sink: Optional[WokEdgeSink] = None
 
         if self.meta is None:
             raise RuntimeError(f'cannot create export helper for '
@@ -52,25 +96,29 @@ class WokPersistentSessionExportHelper:
                 logger.warning(f'the export file {self.file_name} already exists '
                                f'and has been backed up to {backup_file_name}')
 
-            self.file = open(str(self.file_name), mode='w', encoding='utf-8')
+            self.sink = make_sink(self.file_name, export_format)
         except Exception as e:
             logger.error(f'cannot create export helper for '
                          f'session(id={self.session.session_id}): '
                          f'cannot open export file "{self.file_name}": '
                          f'{e}')
-        else:
-            self.write_title_line()
-
-    def write_title_line(self):
-        self.file.write(f'Source; Target; Weight\n')
 
     @property
     def articles(self):
-        for document in self.session.collection.find():
+        for document in session_documents(self.session, {}):
+            self.progress.advance()
             yield WokArticleStubForExporting(document)
 
     def write_edge(self, from_: str, to: str, weight: int):
-        self.file.write(f'{from_}; {to}; {weight}\n')
+        self.sink.write_edge(from_, to, weight)
+
+    def write_graph(self, graph):
+        self.sink.write_graph(graph)
+
+    def close(self):
+        """Flush the export file to disk and close it, nothing is written afterwards."""
+        if self.sink is not None:
+            self.sink.close()
 
     def __str__(self):
         return f'WokPersistentSessionExportHelper' \
@@ -78,6 +126,44 @@ class WokPersistentSessionExportHelper:
                f'export_file={self.file_name})'
 
 
+class WokPersistentSessionExportShard:
+    """
+    A range of _id of a session, whose articles export scripts build
+    graphs of apart from the rest of the session.
+    """
+
+    def __init__(self, session: WokPersistentSession, lower: Any = None, upper: Any = None,
+                 progress: WokExportProgress = None):
+        """
+        :param lower: the lowest _id of the range, None for unbounded
+        :param upper: the _id right after the range, None for unbounded
+        :param progress: progress to count the articles read in
+        """
+        self.session = session
+        self.lower, self.upper = lower, upper
+        self.progress = progress or WokExportProgress()
+
+    @property
+    def filter(self) -> dict:
+        bounds = {}
+        if self.lower is not None:
+            bounds['$gte'] = self.lower
+        if self.upper is not None:
+            bounds['$lt'] = self.upper
+        return {'_id': bounds} if bounds else {}
+
+    @property
+    def articles(self):
+        for document in session_documents(self.session, self.filter, self.lower, self.upper):
+            self.progress.advance()
+            yield WokArticleStubForExporting(document)
+
+    def __str__(self):
+        return f'WokPersistentSessionExportShard' \
+               f'(session_id={self.session.session_id}, ' \
+               f'from={self.lower}, to={self.upper})'
+
+
 class WokArticleStubForExporting(WokArticleStub):
     def __init__(self, document: dict):
         super().__init__(document)
@@ -88,13 +174,19 @@ class WokArticleStubForExporting(WokArticleStub):
         # export_article_fields = export_fields.article
         # export_citation_fields = export_fields.citation
 
+    @staticmethod
+    def _full_name(author) -> str:
+        # authors crawled before normal forms were stored have theirs made now
+        normalised = getattr(author, 'norm', None)
+        return normalize_name(author.full) if normalised is None else normalised
+
     @property
     def first_author_abbr(self):
         return normalize_name(self.author[0].abbr)
 
     @property
     def first_author_full(self):
-        return normalize_name(self.author[0].full)
+        return self._full_name(self.author[0])
 
     @property
     def all_authors_abbr(self):
@@ -104,4 +196,4 @@ class WokArticleStubForExporting(WokArticleStub):
     @property
     def all_authors_full(self):
         for author in self.author:
-            yield normalize_name(author.full)
+            yield self._full_name(author)
@@ -11,8 +11,9 @@ from pathlib import Path
 import importlib
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.support.configuration import get_config
-from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportHelper
+from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportHelper, WokExportCancelled
 from _a_big_red_button.crawler.db import WokPersistentSession
+from _a_big_red_button.support.profiling import profiled
 
 # prepare the logger
 logger = get_logger('export')
@@ -47,15 +48,24 @@ class WokPersistentSessionExportScript:
 
         # we leave the inspect of the function signature to run time
 
-    def run(self, session: WokPersistentSessionExportHelper):
+    def run(self, session: WokPersistentSessionExportHelper, profile: bool = None):
+        """
+        :param profile: whether to run the script under the profiler, None to follow the configuration
+        """
         logger.info(f'running export script [{self.name}] for {session}...')
         try:
-            self.script.export(session)
+            with profiled(f'export-{self.name}', profile):
+                self.script.export(session)
+        except WokExportCancelled:
+            logger.info(f'cancelled running export script [{self.name}] for {session}')
+            raise
         except Exception as e:
             logger.warning(f'failed running export script [{self.name}] for {session}, error detailed as follow:')
             logger.warning(f'{e}')
+            return False
         else:
             logger.info(f'finished running export script [{self.name}] for {session}')
+            return True
 
     def __str__(self):
         return f'WokPersistentSessionExportScript(name={self.name})'
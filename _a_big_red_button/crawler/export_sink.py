@@ -0,0 +1,330 @@
+"""
+Implements sinks that exports write their edges into, one per format:
+
+- csv, the "Source; Target; Weight" text Gephi imports
+- csv.gz, the same compressed with gzip
+- gexf, Gephi's own XML format
+- graphml, the XML format most graph libraries read
+- npy, source and target ids and weights as a NumPy structured array,
+  with node labels in a "<name>.nodes.csv" file next to it, needs NumPy
+- parquet, source and target labels dictionary encoded and weights, needs PyArrow
+
+The format is picked by the extension of the export file. Every sink
+writes through a large buffer, and is flushed and synced to disk when
+closed.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import gzip
+import io
+import os
+from array import array
+from pathlib import Path
+from typing import *
+from xml.sax.saxutils import escape, quoteattr
+
+from _a_big_red_button.crawler.export_graph import NameInterner, WokGraph, ID_TYPE, WEIGHT_TYPE
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+
+# binary formats are optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# prepare logger
+logger = get_logger('export')
+
+# get config
+config = get_config('export')
+
+
+def _sync(file: IO):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+class WokEdgeSink:
+    """Writes edges into a file of some format, closed explicitly or as a context manager."""
+    format: str = None
+    description: str = None
+
+    def __init__(self, path: Path, directed: bool = False):
+        self.path = path
+        self.directed = directed
+        self.edges_written = 0
+        self.closed = False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(path={self.path}, edges_written={self.edges_written})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def open_binary(self, path: Path = None) -> BinaryIO:
+        return open(str(path or self.path), mode='wb', buffering=config.sink.buffer_size)
+
+    def write_edge(self, source: str, target: str, weight: int):
+        raise NotImplementedError
+
+    def write_graph(self, graph: WokGraph):
+        if self.edges_written == 0:
+            self.directed = graph.directed
+        for source, target, weight in graph.edges():
+            self.write_edge(source, target, weight)
+
+    def finish(self):
+        """Write whatever is left and close the underlying files, syncing them."""
+        raise NotImplementedError
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.finish()
+        logger.info(f'closed {self}')
+
+
+class WokCsvEdgeSink(WokEdgeSink):
+    format = 'csv'
+    description = 'SNA Export File'
+
+    def __init__(self, path: Path, directed: bool = False):
+        super().__init__(path, directed)
+        self.raw = self.open_binary()
+        self.file = io.TextIOWrapper(self.wrap(self.raw), encoding='utf-8', newline='\n')
+        self.file.write('Source; Target; Weight\n')
+
+    def wrap(self, raw: BinaryIO) -> BinaryIO:
+        return raw
+
+    def write_edge(self, source: str, target: str, weight: int):
+        self.file.write(f'{source}; {target}; {weight}\n')
+        self.edges_written += 1
+
+    def write_graph(self, graph: WokGraph):
+        if self.edges_written == 0:
+            self.directed = graph.directed
+        self.file.writelines(f'{source}; {target}; {weight}\n'
+                             for source, target, weight in graph.edges())
+        self.edges_written += len(graph)
+
+    def finish(self):
+        self.file.flush()
+        if self.raw is not self.file.buffer:
+            # closing gzip writes its trailer, leaving the raw file open to be synced
+            self.file.close()
+        _sync(self.raw)
+        self.raw.close()
+
+
+class WokGzipCsvEdgeSink(WokCsvEdgeSink):
+    format = 'csv.gz'
+    description = 'Compressed SNA Export File'
+
+    def wrap(self, raw: BinaryIO) -> BinaryIO:
+        return gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+                             compresslevel=config.sink.compression_level)
+
+
+class WokGraphMLEdgeSink(WokEdgeSink):
+    """Writes nodes as they are first seen, GraphML allows nodes and edges in any order."""
+    format = 'graphml'
+    description = 'GraphML'
+
+    def __init__(self, path: Path, directed: bool = False):
+        super().__init__(path, directed)
+        self.names = NameInterner()
+        self.file = io.TextIOWrapper(self.open_binary(), encoding='utf-8', newline='\n')
+        self.__started = False
+
+    def __start(self):
+        self.__started = True
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                        '  <key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+                        '  <key id="weight" for="edge" attr.name="weight" attr.type="long"/>\n'
+                        f'  <graph edgedefault="{"directed" if self.directed else "undirected"}">\n')
+
+    def __node(self, name: str) -> int:
+        if name in self.names:
+            return self.names.intern(name)
+        node_id = self.names.intern(name)
+        self.file.write(f'    <node id="n{node_id}"><data key="label">{escape(name)}</data></node>\n')
+        return node_id
+
+    def write_edge(self, source: str, target: str, weight: int):
+        if not self.__started:
+            self.__start()
+        source_id, target_id = self.__node(source), self.__node(target)
+        self.file.write(f'    <edge source="n{source_id}" target="n{target_id}">'
+                        f'<data key="weight">{weight}</data></edge>\n')
+        self.edges_written += 1
+
+    def finish(self):
+        if not self.__started:
+            self.__start()
+        self.file.write('  </graph>\n</graphml>\n')
+        self.file.flush()
+        _sync(self.file)
+        self.file.close()
+
+
+class WokBufferedEdgeSink(WokEdgeSink):
+    """Keeps edges in buffers and writes them when closed, for formats listing nodes first."""
+
+    def __init__(self, path: Path, directed: bool = False):
+        super().__init__(path, directed)
+        self.names = NameInterner()
+        self.sources, self.targets = array(ID_TYPE), array(ID_TYPE)
+        self.weights = array(WEIGHT_TYPE)
+        self.graph: Optional[WokGraph] = None  # a graph written as a whole is not copied
+
+    def __buffer_graph(self):
+        graph, self.graph = self.graph, None
+        for source, target, weight in graph.edges():
+            self.__append(source, target, weight)
+
+    def __append(self, source: str, target: str, weight: int):
+        self.sources.append(self.names.intern(source))
+        self.targets.append(self.names.intern(target))
+        self.weights.append(weight)
+
+    def write_edge(self, source: str, target: str, weight: int):
+        if self.graph is not None:
+            self.__buffer_graph()
+        self.__append(source, target, weight)
+        self.edges_written += 1
+
+    def write_graph(self, graph: WokGraph):
+        if self.edges_written == 0:
+            self.directed = graph.directed
+            self.graph = graph
+            self.edges_written = len(graph)
+            return
+        super().write_graph(graph)
+
+    def finish(self):
+        graph = self.graph or WokGraph(self.names.names, self.sources, self.targets,
+                                       self.weights, self.directed)
+        self.write(graph)
+
+    def write(self, graph: WokGraph):
+        raise NotImplementedError
+
+
+class WokGexfEdgeSink(WokBufferedEdgeSink):
+    format = 'gexf'
+    description = 'Gephi GEXF'
+
+    def write(self, graph: WokGraph):
+        with io.TextIOWrapper(self.open_binary(), encoding='utf-8', newline='\n') as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<gexf xmlns="http://gexf.net/1.2" version="1.2">\n'
+                       f'  <graph defaultedgetype="{"directed" if graph.directed else "undirected"}">\n'
+                       '    <nodes>\n')
+            file.writelines(f'      <node id="{node_id}" label={quoteattr(name)}/>\n'
+                            for node_id, name in enumerate(graph.names))
+            file.write('    </nodes>\n'
+                       '    <edges>\n')
+            file.writelines(f'      <edge id="{edge_id}" source="{source}" target="{target}" '
+                            f'weight="{weight}"/>\n'
+                            for edge_id, (source, target, weight)
+                            in enumerate(zip(graph.sources, graph.targets, graph.weights)))
+            file.write('    </edges>\n'
+                       '  </graph>\n'
+                       '</gexf>\n')
+            file.flush()
+            _sync(file)
+
+
+class WokNpyEdgeSink(WokBufferedEdgeSink):
+    format = 'npy'
+    description = 'NumPy Edge List'
+
+    @property
+    def nodes_path(self) -> Path:
+        return self.path.with_suffix('.nodes.csv')
+
+    def write(self, graph: WokGraph):
+        edges = numpy.empty(len(graph), dtype=[('source', '<i4'), ('target', '<i4'), ('weight', '<i8')])
+        edges['source'] = numpy.frombuffer(graph.sources, dtype=numpy.int32)
+        edges['target'] = numpy.frombuffer(graph.targets, dtype=numpy.int32)
+        edges['weight'] = numpy.frombuffer(graph.weights, dtype=numpy.int64)
+        with self.open_binary() as file:
+            numpy.save(file, edges)
+            _sync(file)
+        with io.TextIOWrapper(self.open_binary(self.nodes_path), encoding='utf-8', newline='\n') as file:
+            file.write('Id; Label\n')
+            file.writelines(f'{node_id}; {name}\n' for node_id, name in enumerate(graph.names))
+            file.flush()
+            _sync(file)
+
+
+class WokParquetEdgeSink(WokBufferedEdgeSink):
+    format = 'parquet'
+    description = 'Parquet Edge List'
+
+    def write(self, graph: WokGraph):
+        names = pyarrow.array(graph.names, type=pyarrow.string())
+
+        def labels(ids: array):
+            indices = pyarrow.Array.from_buffers(pyarrow.int32(), len(ids), [None, pyarrow.py_buffer(ids)])
+            return pyarrow.DictionaryArray.from_arrays(indices, names)
+
+        weights = pyarrow.Array.from_buffers(pyarrow.int64(), len(graph.weights),
+                                             [None, pyarrow.py_buffer(graph.weights)])
+        table = pyarrow.table({'source': labels(graph.sources), 'target': labels(graph.targets),
+                               'weight': weights})
+        with self.open_binary() as file:
+            pyarrow.parquet.write_table(table, file)
+            _sync(file)
+
+
+# all sinks by format, those whose libraries are missing are left out
+SINKS: Dict[str, Type[WokEdgeSink]] = {
+    sink.format: sink for sink in
+    (WokCsvEdgeSink, WokGzipCsvEdgeSink, WokGexfEdgeSink, WokGraphMLEdgeSink,
+     *((WokNpyEdgeSink,) if numpy is not None else ()),
+     *((WokParquetEdgeSink,) if pyarrow is not None else ()))
+}
+
+
+def format_of(path: Path) -> str:
+    """The format of an export file by its extension, the default format if not known."""
+    name = path.name.lower()
+    for export_format in sorted(SINKS, key=len, reverse=True):
+        if name.endswith(f'.{export_format}'):
+            return export_format
+    return config.sink.default_format
+
+
+def make_sink(path: Path, export_format: str = None, directed: bool = False) -> WokEdgeSink:
+    """
+    Open a sink writing into a file.
+
+    :param path: the export file
+    :param export_format: one of SINKS, or None to pick by the extension of the file
+    :param directed: whether edges have directions, taken from graphs written as a whole
+    """
+    if export_format is None:
+        export_format = format_of(path)
+    if export_format not in SINKS:
+        raise RuntimeError(f'cannot export to "{path}": format {export_format} is not available')
+    return SINKS[export_format](path, directed)
+
+
+def file_types() -> List[Tuple[str, str]]:
+    """File types of the available formats, for file selection dialogues."""
+    return [(sink.description, f'*.{export_format}') for export_format, sink in SINKS.items()]
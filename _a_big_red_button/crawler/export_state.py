@@ -0,0 +1,125 @@
+"""
+Implements the saved states of incremental exports. The graph builder of
+an export script over a session is kept in GridFS along with the _id the
+documents built into it end at, so that the next export of the session
+with the script only builds documents inserted since, and merges them in.
+
+A state is thrown away, and the session built from scratch again, once
+the export script has changed or the session has fewer documents than
+the state was built of, e.g. after being dropped and crawled again.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import datetime
+import hashlib
+import pickle
+from pathlib import Path
+from typing import *
+
+from bson import ObjectId
+from gridfs import GridFSBucket
+from pymongo import DESCENDING
+
+from _a_big_red_button.crawler.db import WokPersistentStorage, WokPersistentSession, config as db_config
+from _a_big_red_button.crawler.export_graph import WokGraphBuilder
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+
+# prepare logger
+logger = get_logger('export')
+
+# get config
+config = get_config('export')
+
+
+def _bucket() -> GridFSBucket:
+    return GridFSBucket(WokPersistentStorage().database, bucket_name=db_config.collections.export_states)
+
+
+def script_digest(script) -> str:
+    """Digest of the source of an export script, a state only holds for the same source."""
+    return hashlib.sha1(Path(script.script.__file__).read_bytes()).hexdigest()
+
+
+def checkpoint_now() -> ObjectId:
+    """
+    The _id documents built into a state saved now must be below. Documents
+    get their _id when made rather than when inserted, so those made within
+    the grace period may still be on their way and are left for next time.
+    """
+    grace = datetime.timedelta(seconds=config.incremental.grace_seconds)
+    return ObjectId.from_datetime(datetime.datetime.utcnow() - grace)
+
+
+class WokExportState:
+    def __init__(self, session_id: str, script_name: str, digest: str,
+                 checkpoint: Optional[ObjectId], documents: int, builder: WokGraphBuilder):
+        """
+        :param digest: digest of the export script the builder was built with
+        :param checkpoint: the _id right after the documents built into the builder
+        :param documents: the number of documents built into the builder
+        """
+        self.session_id, self.script_name, self.digest = session_id, script_name, digest
+        self.checkpoint, self.documents = checkpoint, documents
+        self.builder = builder
+
+    def __repr__(self):
+        return f'WokExportState(session_id={self.session_id}, script={self.script_name}, ' \
+               f'documents={self.documents}, checkpoint={self.checkpoint})'
+
+    @staticmethod
+    def file_name(session_id: str, script_name: str) -> str:
+        return f'{session_id}/{script_name}'
+
+    @staticmethod
+    def load(session: WokPersistentSession, script) -> Optional['WokExportState']:
+        """The state of an export script over a session, None if there is none still valid."""
+        name = WokExportState.file_name(session.session_id, script.name)
+        files = list(_bucket().find({'filename': name}).sort('uploadDate', DESCENDING).limit(1))
+        if not files:
+            return None
+        metadata = files[0].metadata
+        if metadata['digest'] != script_digest(script):
+            logger.info(f'state of {script} over {session} is outdated: the script has changed')
+            return None
+        if metadata['documents'] > len(session):
+            logger.info(f'state of {script} over {session} is outdated: documents have gone')
+            return None
+        try:
+            builder = pickle.loads(_bucket().open_download_stream(files[0]._id).read())
+        except Exception as e:
+            logger.error(f'cannot load state of {script} over {session}: {e}')
+            return None
+        return WokExportState(session.session_id, script.name, metadata['digest'],
+                              metadata['checkpoint'], metadata['documents'], builder)
+
+    @staticmethod
+    def dump(builder: WokGraphBuilder) -> bytes:
+        builder.compact()
+        return pickle.dumps(builder, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def save(session_id: str, script, checkpoint: ObjectId, documents: int, dumped: bytes):
+        """Save a dumped builder as the state of an export script over a session, replacing the last."""
+        bucket = _bucket()
+        name = WokExportState.file_name(session_id, script.name)
+        previous = [file._id for file in bucket.find({'filename': name})]
+        bucket.upload_from_stream(name, dumped, metadata={
+            'session_id': session_id,
+            'script': script.name,
+            'digest': script_digest(script),
+            'checkpoint': checkpoint,
+            'documents': documents
+        })
+        for file_id in previous:
+            bucket.delete(file_id)
+        logger.info(f'saved state of {script} over session(id={session_id}): '
+                    f'{documents} documents, {len(dumped)} bytes')
+
+    @staticmethod
+    def drop(session_id: str):
+        """Drop the states of all export scripts over a session."""
+        bucket = _bucket()
+        for file in bucket.find({'metadata.session_id': session_id}):
+            bucket.delete(file._id)
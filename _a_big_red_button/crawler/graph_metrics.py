@@ -0,0 +1,274 @@
+"""
+Implements network metrics of the graphs export scripts build, computed
+with sparse linear algebra over the integer ids the graph engine interns
+names to:
+
+- degree, the number of neighbours of a node
+- weighted degree, the total weight of the edges of a node
+- PageRank, following edge directions in directed graphs
+- connected components, weakly connected in directed graphs, numbered
+  from the largest
+- core number, the largest k such that the node is in the k-core
+- betweenness, counting shortest paths in hops, from a sample of sources
+  on graphs too large for every one of them
+
+Except for PageRank, edges are taken as undirected and self loops are
+left out; PageRank follows self loops like any other edge. Metrics require NumPy and SciPy.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import time
+from typing import *
+
+from _a_big_red_button.crawler.export_graph import WokGraph
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+
+try:
+    import numpy
+    import scipy.sparse
+    import scipy.sparse.csgraph
+except ImportError:
+    numpy, scipy = None, None
+
+# prepare logger
+logger = get_logger('analyser')
+
+# get config
+config = get_config('analyser')
+
+# metrics of every node
+DEGREE = 'degree'
+WEIGHTED_DEGREE = 'weighted_degree'
+PAGERANK = 'pagerank'
+COMPONENT = 'component'
+CORE = 'core'
+BETWEENNESS = 'betweenness'
+METRICS = (DEGREE, WEIGHTED_DEGREE, PAGERANK, COMPONENT, CORE, BETWEENNESS)
+
+
+def _matrix(graph: WokGraph, symmetric: bool = True, loops: bool = False):
+    """
+    Weighted adjacency, with edges other than self loops both ways if
+    symmetric, self loops left out unless asked for.
+    """
+    if scipy is None:
+        raise RuntimeError('cannot compute network metrics: NumPy or SciPy is not available')
+    sources = numpy.frombuffer(graph.sources, dtype=numpy.int32)
+    targets = numpy.frombuffer(graph.targets, dtype=numpy.int32)
+    weights = numpy.frombuffer(graph.weights, dtype=numpy.int64).astype(numpy.float64)
+    if not loops:
+        keep = sources != targets
+        sources, targets, weights = sources[keep], targets[keep], weights[keep]
+    if symmetric:
+        mirror = sources != targets
+        sources, targets = (numpy.concatenate((sources, targets[mirror])),
+                            numpy.concatenate((targets, sources[mirror])))
+        weights = numpy.concatenate((weights, weights[mirror]))
+    # duplicates, i.e. edges both ways of directed graphs, are summed up
+    return scipy.sparse.csr_matrix((weights, (sources, targets)),
+                                   shape=(graph.node_count, graph.node_count))
+
+
+def _binary(matrix):
+    binary = matrix.copy()
+    binary.data[:] = 1.0
+    return binary
+
+
+def degree(matrix) -> 'numpy.ndarray':
+    return numpy.diff(matrix.indptr).astype(numpy.int64)
+
+
+def weighted_degree(matrix) -> 'numpy.ndarray':
+    return numpy.asarray(matrix.sum(axis=1)).ravel()
+
+
+def pagerank(matrix, damping: float = None, tolerance: float = None,
+             max_iterations: int = None) -> 'numpy.ndarray':
+    """
+    PageRank by power iteration over the weighted transitions, the rank of
+    nodes without outgoing edges is spread over every node.
+    """
+    settings = config.metrics.pagerank
+    damping = settings.damping if damping is None else damping
+    tolerance = settings.tolerance if tolerance is None else tolerance
+    max_iterations = settings.max_iterations if max_iterations is None else max_iterations
+
+    count = matrix.shape[0]
+    if count == 0:
+        return numpy.zeros(0)
+    out_weights = weighted_degree(matrix)
+    dangling = out_weights == 0
+    scale = numpy.divide(1.0, out_weights, out=numpy.zeros(count), where=~dangling)
+    transitions = (scipy.sparse.diags(scale) @ matrix).T.tocsr()
+    ranks = numpy.full(count, 1.0 / count)
+    for iteration in range(max_iterations):
+        previous = ranks
+        ranks = damping * (transitions @ ranks + previous[dangling].sum() / count) + (1 - damping) / count
+        if numpy.abs(ranks - previous).sum() < count * tolerance:
+            break
+    else:
+        logger.warning(f'PageRank did not converge in {max_iterations} iterations')
+    return ranks
+
+
+def components(matrix) -> 'numpy.ndarray':
+    """The component of every node, components numbered by size, 0 being the largest."""
+    count, labels = scipy.sparse.csgraph.connected_components(matrix, directed=False)
+    order = numpy.argsort(-numpy.bincount(labels, minlength=count), kind='stable')
+    rank = numpy.empty(count, dtype=numpy.int64)
+    rank[order] = numpy.arange(count)
+    return rank[labels]
+
+
+def core_numbers(binary) -> 'numpy.ndarray':
+    """
+    Core numbers by peeling: nodes of the lowest degree left are removed in
+    waves, each wave taking the degree of the neighbours it leaves behind
+    down with it.
+    """
+    count = binary.shape[0]
+    degrees = degree(binary)
+    cores = numpy.zeros(count, dtype=numpy.int64)
+    alive = numpy.ones(count, dtype=bool)
+    remaining, k = count, 0
+    while remaining:
+        k = max(k, degrees[alive].min())
+        while True:
+            peeled = numpy.flatnonzero(alive & (degrees <= k))
+            if len(peeled) == 0:
+                break
+            cores[peeled] = k
+            alive[peeled] = False
+            remaining -= len(peeled)
+            degrees -= numpy.bincount(binary[peeled].indices, minlength=count)
+    return cores
+
+
+def betweenness(binary, samples: int = None, batch_size: int = None, seed: int = None) \
+        -> Tuple['numpy.ndarray', int]:
+    """
+    Betweenness by Brandes' algorithm, searching from a batch of sources at
+    once with sparse products. Every source is searched from on graphs with
+    fewer nodes than configured, a sample of them otherwise, scaled up.
+    Returns the betweenness and the number of sources searched from.
+    """
+    settings = config.metrics.betweenness
+    count = binary.shape[0]
+    if samples is None:
+        samples = count if count < settings.exact_below else settings.samples
+    batch_size = settings.batch_size if batch_size is None else batch_size
+    seed = settings.seed if seed is None else seed
+
+    if samples >= count:
+        sources = numpy.arange(count)
+    else:
+        sources = numpy.random.default_rng(seed).choice(count, samples, replace=False)
+    centrality = numpy.zeros(count)
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        columns = numpy.arange(len(batch))
+
+        # search forwards level by level, counting shortest paths
+        paths = numpy.zeros((count, len(batch)))
+        paths[batch, columns] = 1.0
+        depths = numpy.full((count, len(batch)), -1, dtype=numpy.int32)
+        depths[batch, columns] = 0
+        frontier, level = paths.copy(), 0
+        while True:
+            reached = binary @ frontier
+            reached[depths >= 0] = 0.0
+            if not reached.any():
+                break
+            level += 1
+            depths[reached > 0] = level
+            paths += reached
+            frontier = reached
+
+        # accumulate dependencies backwards from the deepest level
+        dependencies = numpy.zeros((count, len(batch)))
+        for level in range(level, 0, -1):
+            coefficients = numpy.divide(1.0 + dependencies, paths, out=numpy.zeros_like(paths),
+                                        where=depths == level)
+            dependencies += numpy.where(depths == level - 1, paths * (binary @ coefficients), 0.0)
+        dependencies[batch, columns] = 0.0
+        centrality += dependencies.sum(axis=1)
+
+    # every pair is counted from both ends
+    return centrality * (count / max(len(sources), 1)) / 2, len(sources)
+
+
+class WokGraphMetrics:
+    """The metrics of every node of a graph, with a summary of them."""
+
+    def __init__(self, names: List[str], values: Dict[str, 'numpy.ndarray'], summary: Dict[str, Any]):
+        self.names = names
+        self.values = values
+        self.summary = summary
+
+    def __repr__(self):
+        return f'WokGraphMetrics(nodes={len(self.names)}, edges={self.summary["edges"]})'
+
+    @staticmethod
+    def compute(graph: WokGraph, betweenness_samples: int = None) -> 'WokGraphMetrics':
+        """
+        :param betweenness_samples: sources to search from, as configured if not given
+        """
+        seconds: Dict[str, float] = {}
+
+        def timed(name: str, function: Callable, *arguments):
+            started = time.perf_counter()
+            result = function(*arguments)
+            seconds[name] = round(time.perf_counter() - started, 3)
+            return result
+
+        undirected = _matrix(graph)
+        binary = _binary(undirected)
+        # PageRank walks self loops too
+        transitions = _matrix(graph, symmetric=not graph.directed, loops=True)
+        values = {
+            DEGREE: timed(DEGREE, degree, binary),
+            WEIGHTED_DEGREE: timed(WEIGHTED_DEGREE, weighted_degree, undirected),
+            PAGERANK: timed(PAGERANK, pagerank, transitions),
+            COMPONENT: timed(COMPONENT, components, binary),
+            CORE: timed(CORE, core_numbers, binary)
+        }
+        values[BETWEENNESS], sources = timed(BETWEENNESS, betweenness, binary, betweenness_samples)
+
+        count = graph.node_count
+        component_sizes = numpy.bincount(values[COMPONENT]) if count else numpy.zeros(0, dtype=numpy.int64)
+        metrics = WokGraphMetrics(graph.names, values, {
+            'nodes': count,
+            'edges': len(graph),
+            'directed': graph.directed,
+            'components': len(component_sizes),
+            'largest_component': int(component_sizes[0]) if count else 0,
+            'max_core': int(values[CORE].max()) if count else 0,
+            'betweenness_sources': sources,
+            'betweenness_exact': sources == count,
+            'seconds': seconds
+        })
+        metrics.summary['top'] = {metric: metrics.top(metric) for metric in METRICS if metric != COMPONENT}
+        logger.info(f'computed {metrics} in {sum(seconds.values()):.3f} seconds')
+        return metrics
+
+    def top(self, metric: str, count: int = None) -> List[Dict[str, Any]]:
+        """The nodes of the highest values of a metric, as configured if count is not given."""
+        count = config.metrics.top_nodes if count is None else count
+        values = self.values[metric]
+        count = min(count, len(values))
+        if count <= 0:
+            return []
+        highest = numpy.argpartition(-values, count - 1)[:count]
+        highest = highest[numpy.argsort(-values[highest], kind='stable')]
+        return [{'name': self.names[node_id], 'value': values[node_id].item()} for node_id in highest]
+
+    def node(self, name: str) -> Optional[Dict[str, Any]]:
+        """Every metric of a node, None if there is no such node."""
+        try:
+            node_id = self.names.index(name)
+        except ValueError:
+            return None
+        return {'name': name, **{metric: self.values[metric][node_id].item() for metric in METRICS}}
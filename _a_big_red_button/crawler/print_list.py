@@ -5,11 +5,15 @@ from Web of Science.
 Kevin Ni, kevin.ni@nyu.edu.
 """
 
+import logging
+import time
 from typing import *
 from lxml import etree
 from _a_big_red_button.support.configuration import get_config
-from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.log import get_logger, LogTally
 from _a_big_red_button.crawler.article_attribute_parser import *
+from _a_big_red_button.crawler.author_names import normalise_name, author_document
+from _a_big_red_button.crawler.crawl_metrics import STAGE_SECONDS, DISCARDED, PARSE, VALIDATE
 
 # get logger
 logger = get_logger('crawler')
@@ -19,7 +23,7 @@ config = get_config('crawler')
 
 
 def normalize_name_abbr(name: str):
-    return name.strip().replace(',', '').replace('.', '').upper()
+    return normalise_name(name)
 
 
 class WoKCitation:
@@ -80,9 +84,10 @@ class WoKPrintArticle:
     NAME_MAP: Dict[str, str] = config.name_map.dict.copy()
 
     class PrimitiveAttributePair:
-        def __init__(self, name: str, value: List[str]):
+        def __init__(self, name: str, value: List[str], tally: LogTally = None):
             self.name: str = name
             self.value: Union[WoKCitation, str, List[str], int] = value
+            self.tally = tally
             self.clean_up_name()
             self.clean_up_value()
             self.parse_value()
@@ -124,9 +129,7 @@ class WoKPrintArticle:
                         new_authors = []
                         for raw_author in self.value:
                             abbr, full = raw_author[:-1].split('(')
-                            new_authors.append(
-                                {'abbr': normalize_name_abbr(abbr.strip()),
-                                 'full': full.strip()})
+                            new_authors.append(author_document(abbr, full.strip()))
                         self.value = new_authors
                 elif self.name in ('研究方向', '电子邮件地址', 'KeyWords Plus', 'Web of Science 类别'):
                     self.value = list(map(lambda s: s.strip(), split_by(';')(self.value)))
@@ -147,7 +150,10 @@ class WoKPrintArticle:
                     for i in range(3):
                         setattr(as_doi, fields[i], values[i])
                         if as_doi.first_author.isnumeric():
-                            logger.warning(f'citation [{citation}] has no author, discarded')
+                            if self.tally is None:
+                                logger.warning(f'citation [{citation}] has no author, discarded')
+                            else:
+                                self.tally.count('no author')
                             bad_citation = True
                             break
                     as_doi.first_author = normalize_name_abbr(as_doi.first_author)
@@ -169,8 +175,10 @@ class WoKPrintArticle:
                 pass
                 self.value = self.value  # obviously IntelliJ has a bug here
 
-    def __init__(self, source: etree.ElementBase):
+    def __init__(self, source: etree.ElementBase, tally: LogTally = None):
         self.source = source
+        # discarded citations are counted here if given, instead of logged one by one
+        self.tally = tally
         self.attributes = list(self.find_all_attributes())
 
     def as_export_dict(self):
@@ -199,6 +207,8 @@ class WoKPrintArticle:
             return False
 
     def validate_attributes(self):
+        tally = LogTally(logger, 'citations ignored', logging.WARNING) \
+            if self.tally is None else self.tally
         # validate key attributes and make sure they are valid
         for field in ['name', 'doi', 'journal']:
             if not self.has_attribute(field):
@@ -222,24 +232,22 @@ class WoKPrintArticle:
         new_citation = []
         for citation in citations:
             if not isinstance(citation, WoKCitation):
-                logger.warning(f'ignored invalid citation: '
-                               f'"{citation}"')
+                tally.count('not parsed')
                 continue
             for field in ['first_author', 'doi', 'journal']:
                 value = getattr(citation, field)
                 if not isinstance(value, str) or not value:
-                    logger.warning(f'ignored invalid citation: '
-                                   f'invalid {field}: '
-                                   f'"{value}"')
+                    tally.count(f'invalid {field}')
                     break
             else:
                 year = citation.year
                 if not isinstance(year, int) or \
                         year not in range(1500, 2030):
-                    logger.warning(f'ignored invalid citation: '
-                                   f'invalid year: "{year}"')
+                    tally.count('invalid year')
                     continue
                 new_citation.append(citation)
+        if self.tally is None:
+            tally.flush(f'{self}')
 
         # update citation
         for attribute in self.attributes:
@@ -271,12 +279,12 @@ class WoKPrintArticle:
 
                 value = title.xpath('following-sibling::value[1]/text()')
                 if value:
-                    yield self.PrimitiveAttributePair(title.text, value)
+                    yield self.PrimitiveAttributePair(title.text, value, self.tally)
                     continue
 
                 text = td.xpath('text()')
                 if text:
-                    yield self.PrimitiveAttributePair(title.text, text)
+                    yield self.PrimitiveAttributePair(title.text, text, self.tally)
 
     def __repr__(self):
         return f'Article(title={self.title[:36]}(...), doi={self.doi})'
@@ -289,43 +297,67 @@ class WoKPrintList:
     def __init__(self, source: 'TextIO', start: int, end: int):
         self.source = source
         self.start, self.end = start, end
+        started = time.perf_counter()
         self.root = etree.parse(self.source, etree.HTMLParser(recover=True, encoding='UTF-8'))
+        self.parse_seconds = time.perf_counter() - started
 
     def __repr__(self):
         return f"WokPrintList({self.start} -> {self.end})"
 
+    @property
+    def has_print_form(self) -> bool:
+        """Whether this is a print list at all, its records are tables of the print form."""
+        return bool(self.root.xpath('//form[@id="printForm"]'))
+
     def find_all_articles(self, year_range: Optional[range] = None):
+        # discarded articles and citations are summarised once per print list
+        discarded = LogTally(logger, 'articles discarded')
+        ignored = LogTally(logger, 'citations ignored', logging.WARNING)
+        parse_seconds, validate_seconds = self.parse_seconds, 0.0
         count = 0
-        for table in self.root.xpath('//form[@id="printForm"]/table[not(@cellpadding)]'):
-            count += 1
-            try:
-                article = WoKPrintArticle(table)
-                article.validate_attributes()
-                if not article.has_attribute('doi'):
-                    logger.warning(f'article(name={article.title}) has no DOI, discarded')
-                    continue
-                if year_range is not None:
-                    # try parse the year
-                    year = article.year
-                    if isinstance(year, int):
-                        if year in year_range:
-                            yield article
-                        else:
-                            logger.info(f"{article} discarded, year not match")
-                    else:
-                        year = year.split()[-1]
-                        if year.isdigit():
-                            if float(year) in year_range:
+        try:
+            for table in self.root.xpath('//form[@id="printForm"]/table[not(@cellpadding)]'):
+                count += 1
+                try:
+                    started = time.perf_counter()
+                    article = WoKPrintArticle(table, ignored)
+                    parsed = time.perf_counter()
+                    article.validate_attributes()
+                    parse_seconds += parsed - started
+                    validate_seconds += time.perf_counter() - parsed
+                    if not article.has_attribute('doi'):
+                        discarded.count('no DOI', level=logging.WARNING)
+                        continue
+                    if year_range is not None:
+                        # try parse the year
+                        year = article.year
+                        if isinstance(year, int):
+                            if year in year_range:
                                 yield article
                             else:
-                                logger.info(f"{article} discarded, year not match")
+                                discarded.count('year filter')
                         else:
-                            logger.info(f"{article} discarded, no year provided")
-                else:
-                    yield article
-            except Exception as e:
-                logger.warning(f'cannot parse article {count}, skipped')
-                logger.debug(f"exception says: {e}")
+                            year = year.split()[-1]
+                            if year.isdigit():
+                                if float(year) in year_range:
+                                    yield article
+                                else:
+                                    discarded.count('year filter')
+                            else:
+                                discarded.count('no year provided')
+                    else:
+                        yield article
+                except Exception as e:
+                    discarded.count('cannot parse', level=logging.WARNING)
+                    logger.debug(f"cannot parse article {count} of {self}, exception says: {e}")
+        finally:
+            STAGE_SECONDS.observe(parse_seconds, stage=PARSE)
+            STAGE_SECONDS.observe(validate_seconds, stage=VALIDATE)
+            for kind, tally in (('article', discarded), ('citation', ignored)):
+                for reason, (n, _) in tally.counts.items():
+                    DISCARDED.inc(n, kind=kind, reason=reason)
+            discarded.flush(f'{self}')
+            ignored.flush(f'{self}')
 
         if count == 0:
             logger.warning(f"{self} no articles found, this print list may be broken")
@@ -0,0 +1,314 @@
+"""
+Implements a scheduler that queues crawl jobs and runs them with a
+limited number of concurrent searches and crawls.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import datetime
+import threading
+import uuid
+from collections import OrderedDict
+from queue import Queue
+from typing import *
+
+from _a_big_red_button.crawler.controller import Wok
+from _a_big_red_button.crawler.core import sanitise_term
+from _a_big_red_button.crawler.db import WokPersistentStorage
+from _a_big_red_button.crawler.db_job import WokPersistentJob
+from _a_big_red_button.crawler.distributed import WokDistributedCrawl
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.event_stream import EVENT_CHANNEL
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.singleton import Singleton
+
+# prepare logger
+logger = get_logger('controller')
+
+# get config
+_config = get_config('crawler')
+
+
+class WokCrawlJob:
+    # states of a job
+    QUEUED = 'queued'
+    SEARCHING = 'searching'
+    WAITING = 'waiting'  # searched and waiting for a crawler
+    CRAWLING = 'crawling'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, term: str, start: int = 0, end: int = 0,
+                 year_range: range = None, search_only: bool = False,
+                 searcher: 'Wok.AsyncSearch' = None,
+                 persistent: WokPersistentJob = None,
+                 distributed: bool = None,
+                 profile: bool = None):
+        self.job_id = uuid.uuid4().hex if persistent is None else persistent.job_id
+        self.term = sanitise_term(term)
+        self.start, self.end, self.year_range = start, end, year_range
+        self.search_only = search_only
+        self.distributed = _config.distributed.enabled if distributed is None else distributed
+        # distributed crawls run elsewhere and are never profiled here
+        self.profile = profile
+        self.searcher: Optional[Wok.AsyncSearch] = searcher
+        self.crawler: Optional[Union[Wok.AsyncCrawler, WokDistributedCrawl]] = None
+        self.state = self.QUEUED
+        self.error: Optional[str] = None
+        self.submitted = datetime.datetime.now()
+        self.finished_at: Optional[datetime.datetime] = None
+
+        # search only jobs are cheap to redo and are never persisted
+        self.persistent = persistent
+
+    @staticmethod
+    def from_persistent(persistent: WokPersistentJob) -> 'WokCrawlJob':
+        """Restore a job claimed from the database, resuming from its checkpoint."""
+        parameters = persistent.parameters
+        start = parameters.start
+        if persistent.checkpoint is not None:
+            start = max(start, persistent.checkpoint + 1)
+        year_range = None if parameters.year_range is None else \
+            range(parameters.year_range[0], parameters.year_range[1] + 1)
+        return WokCrawlJob(parameters.term, start, parameters.end, year_range,
+                           persistent=persistent,
+                           distributed=getattr(parameters, 'distributed', False),
+                           profile=getattr(parameters, 'profile', None))
+
+    def persist(self):
+        self.persistent = WokPersistentJob.make_new(self.job_id, WokPersistentJob.CRAWL, {
+            'term': self.term,
+            'start': self.start,
+            'end': self.end,
+            'year_range': None if self.year_range is None else
+            [self.year_range.start, self.year_range.stop - 1],
+            'distributed': self.distributed,
+            'profile': self.profile
+        })
+
+    def publish(self):
+        """Push the status of this job to clients listening to the event stream."""
+        EVENT_CHANNEL.publish('job', **self.dict)
+
+    def transit(self, state: str, error: str = None):
+        self.state = state
+        self.publish()
+        if self.persistent is None:
+            return
+        try:
+            self.persistent.update_state(state, error)
+        except Exception as e:
+            logger.error(f"cannot persist the state of {self}: {e}")
+
+    def record_checkpoint(self, checkpoint: int):
+        if self.persistent is None:
+            return
+        try:
+            self.persistent.update_checkpoint(checkpoint)
+        except Exception as e:
+            logger.error(f"cannot persist the checkpoint of {self}: {e}")
+
+    def __repr__(self):
+        return f'WokCrawlJob(id={self.job_id}, term="{self.term}", state={self.state})'
+
+    @property
+    def finished(self):
+        return self.state in (self.DONE, self.FAILED)
+
+    @property
+    def failed(self):
+        return self.state == self.FAILED
+
+    @property
+    def searched(self):
+        return self.searcher is not None and self.searcher.done \
+               and not self.searcher.in_error
+
+    @property
+    def result_count(self):
+        if not self.searched:
+            return None
+        return self.searcher.result.result_count
+
+    @property
+    def progress(self):
+        if self.crawler is None:
+            return 0
+        return self.crawler.finished_count
+
+    @property
+    def total(self):
+        if self.crawler is None:
+            return None
+        return self.crawler.end - self.crawler.start_ + 1
+
+    @property
+    def profile_directory(self):
+        return getattr(self.crawler, 'profile_directory', None)
+
+    @property
+    def articles_per_second(self):
+        if self.crawler is None:
+            return 0.0
+        return self.crawler.articles_per_second
+
+    def finish(self, error: str = None):
+        self.error = error
+        self.finished_at = datetime.datetime.now()
+        self.transit(self.DONE if error is None else self.FAILED, error)
+
+    @property
+    def dict(self):
+        return {
+            'job_id': self.job_id,
+            'term': self.term,
+            'start': self.start,
+            'end': self.end,
+            'year_range': None if self.year_range is None else
+            [self.year_range.start, self.year_range.stop - 1],
+            'search_only': self.search_only,
+            'distributed': self.distributed,
+            'state': self.state,
+            'error': self.error,
+            'result_count': self.result_count,
+            'finished': self.progress,
+            'total': self.total,
+            'articles_per_second': round(self.articles_per_second, 2),
+            'profile_directory': None if self.profile_directory is None else
+            str(self.profile_directory),
+            'submitted': self.submitted.isoformat(),
+            'finished_at': None if self.finished_at is None else self.finished_at.isoformat()
+        }
+
+
+class WokCrawlScheduler(metaclass=Singleton):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__jobs: 'OrderedDict[str, WokCrawlJob]' = OrderedDict()
+        self.search_queue = Queue()
+        self.crawl_queue = Queue()
+
+        # searches and crawls are served by separate pools of workers so that
+        # a long crawl never stops other terms from being searched
+        self.workers = []
+        for i in range(_config.scheduler.max_concurrent_searches):
+            self.workers.append(self.Worker(self.search_queue, self.run_search, f'searcher-{i}'))
+        for i in range(_config.scheduler.max_concurrent_crawls):
+            self.workers.append(self.Worker(self.crawl_queue, self.run_crawl, f'crawler-{i}'))
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"crawl scheduler started with "
+                    f"{_config.scheduler.max_concurrent_searches} searchers and "
+                    f"{_config.scheduler.max_concurrent_crawls} crawlers")
+
+    class Worker(threading.Thread):
+        def __init__(self, queue: Queue, handler: Callable[[WokCrawlJob], None], name: str):
+            super().__init__(name=name)
+            self.daemon = True
+            self.queue, self.handler = queue, handler
+
+        def run(self) -> None:
+            while True:
+                job = self.queue.get()
+                try:
+                    self.handler(job)
+                except Exception as e:
+                    logger.error(f"{job} failed unexpectedly: {e}")
+                    job.finish(f'{e}')
+                finally:
+                    self.queue.task_done()
+
+    def submit(self, job: WokCrawlJob) -> WokCrawlJob:
+        if not job.search_only and job.persistent is None:
+            try:
+                job.persist()
+            except Exception as e:
+                logger.error(f"cannot persist {job}, it will not survive a restart: {e}")
+
+        with self.__lock:
+            self.__jobs[job.job_id] = job
+            self.forget_finished_jobs()
+
+        if job.searched:
+            job.transit(WokCrawlJob.WAITING)
+            self.crawl_queue.put(job)
+        else:
+            self.search_queue.put(job)
+        logger.info(f"submitted {job}")
+        return job
+
+    def forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.__jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - _config.scheduler.finished_job_retention, 0)]:
+            del self.__jobs[job_id]
+
+    def resume_unfinished_jobs(self):
+        """Claim crawl jobs left unfinished by previous processes and queue them again."""
+        count = 0
+        while True:
+            persistent = WokPersistentJob.claim_unfinished(WokPersistentJob.CRAWL)
+            if persistent is None:
+                break
+            job = WokCrawlJob.from_persistent(persistent)
+            if 0 < job.end < job.start:
+                # everything had been written before the process went down
+                job.finish()
+                continue
+            self.submit(job)
+            count += 1
+        if count:
+            logger.info(f"resumed {count} unfinished crawl jobs")
+
+    def job(self, job_id: str) -> Optional[WokCrawlJob]:
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    @property
+    def jobs(self) -> List[WokCrawlJob]:
+        with self.__lock:
+            return list(self.__jobs.values())
+
+    def run_search(self, job: WokCrawlJob):
+        job.transit(WokCrawlJob.SEARCHING)
+        job.searcher = Wok.AsyncSearch(job.term)
+        job.searcher.start()
+        job.searcher.join()
+
+        if job.searcher.in_error:
+            job.finish(job.searcher.error_explanation or 'search failed on unknown error')
+        elif job.search_only:
+            job.finish()
+        else:
+            job.transit(WokCrawlJob.WAITING)
+            self.crawl_queue.put(job)
+
+    def run_crawl(self, job: WokCrawlJob):
+        job.transit(WokCrawlJob.CRAWLING)
+        # crawls of the same search run at once, each takes print lists from queues of its own
+        result = job.searcher.result.copy()
+        if job.distributed:
+            # tasks are recorded in the database and survive restarts themselves
+            job.crawler = WokDistributedCrawl(job.job_id, result,
+                                              job.start, job.end, job.year_range,
+                                              WokPersistentStorage()[job.term])
+        else:
+            job.crawler = Wok.AsyncCrawler(result,
+                                           job.start, job.end, job.year_range,
+                                           WokPersistentStorage()[job.term],
+                                           on_checkpoint=job.record_checkpoint,
+                                           profile=job.profile)
+        job.crawler.start()
+
+        # push progress whenever it changes while waiting for the crawler
+        progress = None
+        while job.crawler.is_alive():
+            job.crawler.join(_config.scheduler.progress_interval)
+            if job.progress != progress:
+                progress = job.progress
+                job.publish()
+
+        if job.crawler.in_error:
+            job.finish('crawling failed, consider crawling again')
+        else:
+            job.finish()
+        logger.info(f"finished {job}")
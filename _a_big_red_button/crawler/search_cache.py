@@ -0,0 +1,119 @@
+"""
+Implements a cache of searches keyed by their normalised terms, so that
+re-crawls of a term, and range crawls of the same term split across jobs,
+reuse a search whose SID is still alive instead of opening a new one.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import threading
+import time
+from typing import *
+
+import requests
+
+from _a_big_red_button.crawler.core import WokSearch, WokSearchResult, sanitise_term
+from _a_big_red_button.crawler.crawl_metrics import SEARCH_CACHE
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.lru_cache import LRUCache
+from _a_big_red_button.support.singleton import Singleton
+
+# prepare logger
+logger = get_logger('crawler')
+
+# get config
+_config = get_config('crawler')
+
+
+def normalise_term(term: str) -> str:
+    """Sanitise a term and collapse its white spaces, so that equal searches share a key."""
+    return ' '.join(sanitise_term(term).split())
+
+
+class WokCachedSearch:
+    def __init__(self, result: WokSearchResult):
+        self.search_id = result.search_id
+        self.result_url = result.result_url
+        self.result_count = result.result_count
+        self.search_term = result.search_term
+        self.session: requests.Session = result.session
+        self.headers = result.headers
+        self.searched_at = result.searched_at
+
+    def __repr__(self):
+        return f'WokCachedSearch(term="{self.search_term}", sid={self.search_id})'
+
+    @property
+    def age(self):
+        return time.monotonic() - self.searched_at
+
+    def as_result(self) -> WokSearchResult:
+        # every user gets its own result, results carry the queues of their crawl
+        return WokSearchResult(self.result_url, self.result_count,
+                               self.search_id, self.search_term,
+                               self.session, self.headers, self.searched_at)
+
+
+class WokSearchCache(metaclass=Singleton):
+    def __init__(self):
+        self.ttl = _config.search_cache.ttl
+        self.__entries = LRUCache(_config.search_cache.capacity)
+        self.__lock = threading.Lock()
+        self.__term_locks: Dict[str, threading.Lock] = {}
+
+    def __term_lock(self, key: str) -> threading.Lock:
+        with self.__lock:
+            if key not in self.__term_locks:
+                self.__term_locks[key] = threading.Lock()
+            return self.__term_locks[key]
+
+    def lookup(self, term: str) -> Optional[WokSearchResult]:
+        """Find a valid cached search of the term, counting hits, misses and expiries."""
+        entry: Optional[WokCachedSearch] = self.__entries.get(normalise_term(term))
+        if entry is None:
+            SEARCH_CACHE.inc(outcome='miss')
+            return None
+        if entry.age > self.ttl:
+            SEARCH_CACHE.inc(outcome='expired')
+            self.__entries.pop(normalise_term(term))
+            return None
+        SEARCH_CACHE.inc(outcome='hit')
+        logger.info(f'reusing {entry}, searched {entry.age:.0f} seconds ago')
+        return entry.as_result()
+
+    def search(self, term: str, refresh: bool = False) -> WokSearchResult:
+        """
+        Search for a term, reusing a cached search of it if still valid.
+
+        :param term: the search term
+        :param refresh: whether to search again regardless of the cache
+        """
+        key = normalise_term(term)
+        # concurrent searches of the same term wait for the first one
+        with self.__term_lock(key):
+            if not refresh:
+                result = self.lookup(key)
+                if result is not None:
+                    return result
+            # the key only tells equal searches apart, the term is searched as given
+            result = WokSearch.make_new_search().search(sanitise_term(term))
+            self.__entries.put(key, WokCachedSearch(result))
+            return result
+
+    def invalidate(self, term: str):
+        """Forget the search of a term, e.g. when its SID turned out to have expired."""
+        if self.__entries.pop(normalise_term(term)) is not None:
+            SEARCH_CACHE.inc(outcome='invalidated')
+            logger.info(f'forgot cached search of [{term}]')
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self.__entries),
+            'ttl': self.ttl,
+            'hits': SEARCH_CACHE.value(outcome='hit'),
+            'misses': SEARCH_CACHE.value(outcome='miss'),
+            'expired': SEARCH_CACHE.value(outcome='expired'),
+            'invalidated': SEARCH_CACHE.value(outcome='invalidated')
+        }
@@ -0,0 +1,160 @@
+"""
+Implements network metrics of sessions. The graph an export script builds
+of a session is analysed in the background, and its metrics written to a
+GridFS bucket, the summary as metadata and the metrics of every node as
+the file. They are served from there until the session or the script
+changes.
+
+Graphs are built on the saved state of incremental exports where there
+is one, so that only documents inserted since the last export are read.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import pickle
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+from gridfs import GridFSBucket
+from pymongo import DESCENDING
+
+from _a_big_red_button.crawler.db import WokPersistentStorage, WokPersistentSession, config as db_config
+from _a_big_red_button.crawler.export_graph import WokGraph, WokGraphBuilder
+from _a_big_red_button.crawler.export_helper import WokPersistentSessionExportShard
+from _a_big_red_button.crawler.export_script_helper import WokPersistentSessionExportScript
+from _a_big_red_button.crawler.export_state import WokExportState, script_digest
+from _a_big_red_button.crawler.graph_metrics import WokGraphMetrics
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.singleton import Singleton
+
+# prepare logger
+logger = get_logger('analyser')
+
+# get config
+config = get_config('analyser')
+
+
+def _bucket() -> GridFSBucket:
+    return GridFSBucket(WokPersistentStorage().database, bucket_name=db_config.collections.graph_metrics)
+
+
+def build_session_graph(session: WokPersistentSession, script: WokPersistentSessionExportScript) -> WokGraph:
+    """The graph an export script exports of a session, built in this process."""
+    module = script.script
+    if not hasattr(module, 'build'):
+        raise RuntimeError(f'cannot analyse {session} with {script}: the script builds no graph')
+    state = WokExportState.load(session, script)
+    if state is None:
+        graph, lower = WokGraphBuilder(getattr(module, 'DIRECTED', False)), None
+    else:
+        graph, lower = state.builder, state.checkpoint
+        logger.info(f'building graph of {session} on {state}')
+    module.build(WokPersistentSessionExportShard(session, lower), graph)
+    finalise = getattr(module, 'finalise', None)
+    return graph.finalise() if finalise is None else finalise(graph)
+
+
+class WokSessionMetrics(metaclass=Singleton):
+    def __init__(self):
+        self.analysers = ThreadPoolExecutor(config.metrics.concurrent_analyses,
+                                            thread_name_prefix='analyse')
+        self.__lock = threading.Lock()
+        # the last analysis of every session and script, running or not
+        self.__analyses: Dict[Tuple[str, str], Future] = {}
+
+    @staticmethod
+    def file_name(session_id: str, script_name: str) -> str:
+        return f'{session_id}/{script_name}'
+
+    @staticmethod
+    def __latest(session: WokPersistentSession, script: WokPersistentSessionExportScript):
+        """The file of the metrics of a session, None if there is none still valid."""
+        name = WokSessionMetrics.file_name(session.session_id, script.name)
+        files = list(_bucket().find({'filename': name}).sort('uploadDate', DESCENDING).limit(1))
+        if not files:
+            return None
+        metadata = files[0].metadata
+        if metadata['digest'] != script_digest(script) or \
+                metadata['signature'] != session.signature:
+            return None
+        return files[0]
+
+    def summary(self, session: WokPersistentSession,
+                script: WokPersistentSessionExportScript) -> Optional[Dict[str, Any]]:
+        """The summary of the metrics of a session, None if it has not been analysed since it changed."""
+        file = self.__latest(session, script)
+        return None if file is None else file.metadata['summary']
+
+    def cached(self, session: WokPersistentSession,
+               script: WokPersistentSessionExportScript) -> Optional[WokGraphMetrics]:
+        file = self.__latest(session, script)
+        if file is None:
+            return None
+        return pickle.loads(_bucket().open_download_stream(file._id).read())
+
+    def analyse(self, session: WokPersistentSession, script: WokPersistentSessionExportScript,
+                refresh: bool = False) -> WokGraphMetrics:
+        """
+        The metrics of a session, computed and saved unless they are already.
+
+        :param refresh: whether to compute them even if they are
+        """
+        if not refresh:
+            metrics = self.cached(session, script)
+            if metrics is not None:
+                return metrics
+        # taken before building, documents inserted meanwhile make the metrics outdated
+        signature = session.signature
+        metrics = WokGraphMetrics.compute(build_session_graph(session, script))
+        self.save(session.session_id, script, signature, metrics)
+        return metrics
+
+    @staticmethod
+    def save(session_id: str, script: WokPersistentSessionExportScript,
+             signature: Dict[str, Any], metrics: WokGraphMetrics):
+        bucket = _bucket()
+        name = WokSessionMetrics.file_name(session_id, script.name)
+        previous = [file._id for file in bucket.find({'filename': name})]
+        bucket.upload_from_stream(name, pickle.dumps(metrics, protocol=pickle.HIGHEST_PROTOCOL), metadata={
+            'session_id': session_id,
+            'script': script.name,
+            'digest': script_digest(script),
+            'signature': signature,
+            'summary': metrics.summary
+        })
+        for file_id in previous:
+            bucket.delete(file_id)
+        logger.info(f'saved {metrics} of session(id={session_id}) with {script}')
+
+    @staticmethod
+    def drop(session_id: str):
+        """Drop the metrics of a session with every script."""
+        bucket = _bucket()
+        for file in bucket.find({'metadata.session_id': session_id}):
+            bucket.delete(file._id)
+
+    def submit(self, session: WokPersistentSession, script: WokPersistentSessionExportScript,
+               refresh: bool = False) -> Future:
+        """Analyse a session in the background, unless it is being analysed already."""
+        key = (session.session_id, script.name)
+        with self.__lock:
+            running = self.__analyses.get(key)
+            if running is not None and not running.done():
+                return running
+            future = self.__analyses[key] = self.analysers.submit(self.__analyse, session, script, refresh)
+        return future
+
+    def __analyse(self, session: WokPersistentSession, script: WokPersistentSessionExportScript,
+                  refresh: bool) -> WokGraphMetrics:
+        try:
+            return self.analyse(session, script, refresh)
+        except Exception as e:
+            logger.error(f'cannot analyse {session} with {script}: {e}')
+            raise
+
+    def analysis(self, session_id: str, script_name: str) -> Optional[Future]:
+        """The last analysis of a session and script submitted by this process."""
+        with self.__lock:
+            return self.__analyses.get((session_id, script_name))
@@ -0,0 +1,221 @@
+"""
+Implements a pool of sessions of Web of Science, each with a SID and
+connections of its own. Print lists are requested through the sessions
+in turn, so that crawling parallelises beyond the limits of a single SID.
+Every session searches a term once for as long as searches are cached,
+but for one of them, which takes over the search the crawl was planned
+from while it is still valid. Sessions are checked when idle for a while, and is refreshed with a new SID when Web of Science answers with
+a login or session expired page, or when its requests keep failing.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import threading
+import time
+from typing import *
+
+import requests
+
+from _a_big_red_button.crawler.core import WokSearch, WokSearchResult, WokSessionExpired, \
+    is_session_expired, send_request, wok_url
+from _a_big_red_button.crawler.crawl_metrics import SESSION_REFRESHES
+from _a_big_red_button.crawler.print_list import WoKPrintList
+from _a_big_red_button.crawler.search_cache import WokCachedSearch
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.lru_cache import LRUCache
+from _a_big_red_button.support.singleton import Singleton
+
+# prepare logger
+logger = get_logger('crawler')
+
+# get config
+_config = get_config('crawler')
+
+
+class WokPooledSession:
+    def __init__(self, number: int):
+        self.number = number
+        self.search: Optional[WokSearch] = None
+        # term -> search made with this SID, as long and as many as the search cache keeps
+        self.results = LRUCache(_config.search_cache.capacity)
+        self.generation = 0  # incremented every time the SID is replaced
+        self.requests = 0
+        self.failures = 0  # consecutive failed requests
+        self.last_used = 0.0
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return f'WokPooledSession(number={self.number}, ' \
+               f'sid={None if self.search is None else self.search.search_id})'
+
+    @property
+    def search_id(self) -> Optional[str]:
+        return None if self.search is None else self.search.search_id
+
+    def __open(self):
+        self.search = WokSearch.make_new_search(_config.session_pool.connections)
+        self.results.clear()
+        self.generation += 1
+        self.failures = 0
+        self.last_used = time.monotonic()
+
+    def __check(self) -> bool:
+        url = wok_url(_config.url.search_input.format(search_id=self.search.search_id))
+        try:
+            response = send_request('health_check', lambda: self.search.session.get(
+                url, headers=_config.headers.base.dict))
+        except requests.RequestException as e:
+            logger.warning(f'{self} failed health check: {e}')
+            return False
+        # an expired SID is redirected to a login page or to a url with another SID
+        return response.status_code == 200 and not is_session_expired(response) and \
+            self.search.search_id in response.url
+
+    def ensure_healthy(self):
+        """Open the session if not yet, or check it if it has been idle for too long."""
+        with self.__lock:
+            if self.search is None:
+                self.__open()
+            elif time.monotonic() - self.last_used > _config.session_pool.health_check_interval:
+                if self.__check():
+                    self.last_used = time.monotonic()
+                else:
+                    logger.warning(f'{self} is no longer healthy, refreshing')
+                    SESSION_REFRESHES.inc(reason='health check')
+                    self.__open()
+
+    def refresh(self, generation: int, reason: str):
+        """
+        Replace the SID, unless another user of the session did since the
+        given generation of it.
+        """
+        with self.__lock:
+            if generation != self.generation:
+                return
+            logger.warning(f'{self} refreshing: {reason}')
+            SESSION_REFRESHES.inc(reason=reason)
+            self.__open()
+
+    def result_of(self, term: str) -> WokSearchResult:
+        """
+        The search of a term made with this SID, searching for it if not yet or
+        if it has been searched for too long ago, as results change over time.
+        """
+        with self.__lock:
+            if self.search is None:
+                self.__open()
+            entry: Optional[WokCachedSearch] = self.results.get(term)
+            if entry is None or entry.age > _config.search_cache.ttl:
+                entry = WokCachedSearch(self.search.search(term))
+                self.results.put(term, entry)
+            return entry.as_result()
+
+    def holds(self, search_id: str) -> bool:
+        """Whether this session requests print lists of a search of the given SID."""
+        return any(entry.search_id == search_id for entry in self.results.values())
+
+    def adopt(self, term: str, result: WokSearchResult):
+        """Take over a search of a term made elsewhere, unless this session has a valid one."""
+        with self.__lock:
+            entry: Optional[WokCachedSearch] = self.results.get(term)
+            if entry is None or entry.age > _config.search_cache.ttl:
+                self.results.put(term, WokCachedSearch(result))
+                logger.info(f'{self} took over search [{result.search_id}] of [{term}]')
+
+    def report(self, generation: int, succeeded: bool):
+        with self.__lock:
+            self.requests += 1
+            if succeeded:
+                self.failures = 0
+                self.last_used = time.monotonic()
+                return
+            self.failures += 1
+            failures = self.failures
+        if failures >= _config.session_pool.max_failures:
+            self.refresh(generation, f'{failures} consecutive failures')
+
+    @property
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'number': self.number,
+            'search_id': self.search_id,
+            'generation': self.generation,
+            'requests': self.requests,
+            'failures': self.failures,
+            'terms': self.results.keys(),
+            'idle_seconds': round(time.monotonic() - self.last_used, 3) if self.last_used else None
+        }
+
+
+class WokSessionPool(metaclass=Singleton):
+    def __init__(self):
+        self.sessions = [WokPooledSession(number) for number in range(_config.session_pool.size)]
+        self.__next = 0
+        self.__lock = threading.Lock()
+        self.__expired_seeds = LRUCache(_config.search_cache.capacity)  # SIDs not to take over again
+
+    def __repr__(self):
+        return f'WokSessionPool(size={len(self.sessions)})'
+
+    def acquire(self) -> WokPooledSession:
+        """Take the next session in turn, opened and checked."""
+        with self.__lock:
+            session = self.sessions[self.__next]
+            self.__next = (self.__next + 1) % len(self.sessions)
+        session.ensure_healthy()
+        return session
+
+    def seed(self, session: WokPooledSession, term: str, result: WokSearchResult):
+        """
+        Let a session take over the search of a term the caller has made,
+        while it is still valid and no other session has taken it over.
+        """
+        if result.age > _config.search_cache.ttl or result.search_id in self.__expired_seeds:
+            return
+        with self.__lock:
+            if not any(other.holds(result.search_id) for other in self.sessions):
+                session.adopt(term, result)
+
+    def request_print_list(self, term: str, start: int, end: int,
+                           seed: WokSearchResult = None) -> Optional[WoKPrintList]:
+        """
+        Request one print list of a term through the next session, refreshing
+        it if it has expired. Returns None if it could not be requested.
+
+        :param seed: the search the request was planned from, taken over by
+            one of the sessions rather than searched again
+        """
+        session = self.acquire()
+        if seed is not None:
+            self.seed(session, term, seed)
+        for _ in range(_config.session_pool.max_refreshes + 1):
+            generation, result = session.generation, None
+            try:
+                result = session.result_of(term)
+                print_list = WokSearchResult.request_print_list(
+                    result.session, WokSearchResult.PrintListRequestWorker.assemble_headers(
+                        result.search_id),
+                    start, end, result.search_id, result.search_term, raise_expired=True)
+            except WokSessionExpired:
+                if seed is not None and result is not None and result.search_id == seed.search_id:
+                    self.__expired_seeds.put(seed.search_id, True)
+                session.refresh(generation, 'session expired')
+                continue
+            except (requests.RequestException, RuntimeError) as e:
+                logger.error(f'{session} cannot request print list [{start} -> {end}]: {e}')
+                print_list = None
+            session.report(generation, print_list is not None)
+            return print_list
+
+        logger.critical(f'PRINT LIST [{start} -> {end}] HAS BEEN SKIPPED: '
+                        f'session kept expiring')
+        return None
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self.sessions),
+            'sessions': [session.dict for session in self.sessions],
+            'refreshes': {reason: count for (reason,), count in SESSION_REFRESHES.values.items()}
+        }
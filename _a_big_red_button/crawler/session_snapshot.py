@@ -0,0 +1,347 @@
+"""
+Implements columnar snapshots of sessions. A session is written in order
+of _id into an Arrow IPC file, with list columns of authors, keywords and
+citations, which is memory mapped when read, so that repeated passes over
+a session that no longer changes read neither the database nor copies of
+the file. Exports read a session from its snapshot for as long as the
+session has not changed since it was taken.
+
+Fields of documents other than those crawled are not kept in snapshots.
+Fields the parser stores as integers when they read as one are integer
+columns, the text of those that do not is kept beside them and put back
+when read, as are addresses stored as a list rather than a string.
+Snapshots require PyArrow.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import datetime
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from _a_big_red_button.crawler.author_names import normalise_authors
+from _a_big_red_button.crawler.db import WokPersistentSession, config
+from _a_big_red_button.support.directory import DEPLOYMENT_ROOT
+from _a_big_red_button.support.log import get_logger
+from _a_big_red_button.support.singleton import Singleton
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# prepare logger
+logger = get_logger('db')
+
+# version of the layout of snapshots, older ones are taken again
+SNAPSHOT_VERSION = 3
+
+# fields of articles by the type of their columns
+_STRING_FIELDS = ('title', 'abstract', 'wosno', 'lang', 'type', 'cauthor', 'pub', 'pubaddr', 'ids',
+                  'issn', 'eissn', 'pubabbr', 'pubisoabbr', 'doi', 'journal')
+_INTEGER_FIELDS = ('quote', 'quotewoscore', 'quote180', 'quote2013', 'citecount')
+_NUMBER_FIELDS = ('year', 'v', 'i', 'p')
+_STRING_OR_LIST_FIELDS = ('addr',)
+_LIST_FIELDS = ('email', 'wostype', 'direction', 'keyword', 'keywordplus')
+_AUTHOR_FIELDS = ('abbr', 'full', 'norm')
+_CITATION_STRING_FIELDS = ('first_author', 'journal', 'volume', 'doi')
+_CITATION_NUMBER_FIELDS = ('year', 'issue', 'page')
+
+# suffixes of the columns of values that do not fit the column of their field
+_TEXT = '_text'
+_LIST = '_list'
+
+if pyarrow is not None:
+    AUTHOR_TYPE = pyarrow.struct([*((name, pyarrow.string()) for name in _AUTHOR_FIELDS),
+                                  ('id', pyarrow.int64())])
+    CITATION_TYPE = pyarrow.struct([*((name, pyarrow.string()) for name in _CITATION_STRING_FIELDS),
+                                    *((name, pyarrow.int64()) for name in _CITATION_NUMBER_FIELDS),
+                                    *((name + _TEXT, pyarrow.string()) for name in _CITATION_NUMBER_FIELDS)])
+    SCHEMA = pyarrow.schema([
+        ('_id', pyarrow.string()),
+        *((name, pyarrow.string()) for name in _STRING_FIELDS),
+        *((name, pyarrow.int64()) for name in _INTEGER_FIELDS),
+        *((name, pyarrow.int64()) for name in _NUMBER_FIELDS),
+        *((name + _TEXT, pyarrow.string()) for name in _NUMBER_FIELDS),
+        *((name, pyarrow.string()) for name in _STRING_OR_LIST_FIELDS),
+        *((name + _LIST, pyarrow.list_(pyarrow.string())) for name in _STRING_OR_LIST_FIELDS),
+        *((name, pyarrow.list_(pyarrow.string())) for name in _LIST_FIELDS),
+        ('author', pyarrow.list_(AUTHOR_TYPE)),
+        ('citation', pyarrow.list_(CITATION_TYPE))
+    ])
+
+
+def _string(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _integer(value: Any) -> Optional[int]:
+    try:
+        return None if value is None else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _number(value: Any) -> Tuple[Optional[int], Optional[str]]:
+    """An integer as is, anything else as its text."""
+    if value is None:
+        return None, None
+    if isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63:
+        return value, None
+    return None, str(value)
+
+
+def _string_or_list(value: Any) -> Tuple[Optional[str], Optional[List[str]]]:
+    """A list as a list of strings, anything else as a string."""
+    if isinstance(value, (list, tuple)):
+        return None, [str(item) for item in value]
+    return _string(value), None
+
+
+def _numbers(source: dict, names: Iterable[str]) -> Iterator[Tuple[str, Any]]:
+    for name in names:
+        number, text = _number(source.get(name))
+        yield name, number
+        yield name + _TEXT, text
+
+
+def _restore(row: dict, names: Iterable[str], suffix: str) -> dict:
+    """Put back the values kept beside the columns of their fields."""
+    for name in names:
+        value = row.pop(name + suffix)
+        if value is not None:
+            row[name] = value
+    return row
+
+
+def _strings(value: Any) -> Optional[List[str]]:
+    # fields of a single value are stored as is rather than as a list
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [value]
+    return [str(item) for item in value]
+
+
+def _row(document: dict) -> dict:
+    """Fit a document into the schema of snapshots, values of unexpected types become null."""
+    row = {'_id': str(document['_id'])}
+    row.update((name, _string(document.get(name))) for name in _STRING_FIELDS)
+    row.update((name, _integer(document.get(name))) for name in _INTEGER_FIELDS)
+    row.update(_numbers(document, _NUMBER_FIELDS))
+    for name in _STRING_OR_LIST_FIELDS:
+        row[name], row[name + _LIST] = _string_or_list(document.get(name))
+    row.update((name, _strings(document.get(name))) for name in _LIST_FIELDS)
+    authors, citations = document.get('author'), document.get('citation')
+    row['author'] = None if authors is None else [
+        dict(((name, _string(author.get(name))) for name in _AUTHOR_FIELDS), id=_integer(author.get('id')))
+        for author in normalise_authors(authors) if isinstance(author, dict)]
+    row['citation'] = None if citations is None else [
+        dict(((name, _string(citation.get(name))) for name in _CITATION_STRING_FIELDS),
+             **dict(_numbers(citation, _CITATION_NUMBER_FIELDS)))
+        for citation in citations if isinstance(citation, dict)]
+    return row
+
+
+def snapshot_path(session_id: str) -> Path:
+    return DEPLOYMENT_ROOT.joinpath(config.snapshot.directory, f'{session_id}.arrow')
+
+
+def write_snapshot(session: WokPersistentSession) -> 'WokSessionSnapshot':
+    """Take a snapshot of a session, replacing the last one once written in full."""
+    if pyarrow is None:
+        raise RuntimeError(f'cannot take snapshot of {session}: PyArrow is not available')
+    # documents inserted meanwhile are left out, and make the snapshot outdated right away
+    signature = session.signature
+    path = snapshot_path(session.session_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix('.partial')
+    schema = SCHEMA.with_metadata({
+        'version': str(SNAPSHOT_VERSION),
+        'session_id': session.session_id,
+        'term': session.term,
+        'documents': str(signature['documents']),
+        'last_id': str(signature['last_id']),
+        'taken_at': datetime.datetime.now().isoformat()
+    })
+
+    query = {} if signature['last_id'] is None else {'_id': {'$lte': signature['last_id']}}
+    rows_written = 0
+    with pyarrow.OSFile(str(partial), 'wb') as file, pyarrow.ipc.new_file(file, schema) as writer:
+        rows = []
+        for document in session.collection.find(query).sort('_id', ASCENDING):
+            rows.append(_row(document))
+            if len(rows) >= config.snapshot.batch_size:
+                writer.write_batch(pyarrow.RecordBatch.from_pylist(rows, schema=schema))
+                rows_written += len(rows)
+                rows = []
+        if rows:
+            writer.write_batch(pyarrow.RecordBatch.from_pylist(rows, schema=schema))
+            rows_written += len(rows)
+    os.replace(str(partial), str(path))
+    logger.info(f'took snapshot of {session} into {path}: {rows_written} documents')
+    return WokSessionSnapshot(path)
+
+
+class WokSessionSnapshot:
+    """A snapshot of a session, memory mapped. Closed explicitly or as a context manager."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.source = pyarrow.memory_map(str(path))
+        self.reader = pyarrow.ipc.open_file(self.source)
+        self.metadata: Dict[str, str] = {key.decode(): value.decode() for key, value
+                                         in (self.reader.schema.metadata or {}).items()}
+
+    def __repr__(self):
+        return f'WokSessionSnapshot(path={self.path}, documents={self.documents})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.source.close()
+
+    @staticmethod
+    def find(session: WokPersistentSession) -> Optional['WokSessionSnapshot']:
+        """The snapshot of a session, None if there is none or the session has changed since."""
+        path = snapshot_path(session.session_id)
+        if pyarrow is None or not path.exists():
+            return None
+        try:
+            snapshot = WokSessionSnapshot(path)
+        except Exception as e:
+            logger.error(f'cannot read snapshot of {session} at {path}: {e}')
+            return None
+        if not snapshot.is_fresh(session):
+            snapshot.close()
+            return None
+        return snapshot
+
+    @staticmethod
+    def drop(session_id: str):
+        snapshot_path(session_id).unlink(missing_ok=True)
+
+    @property
+    def documents(self) -> int:
+        return int(self.metadata.get('documents', 0))
+
+    def is_fresh(self, session: WokPersistentSession) -> bool:
+        """Whether the session has not changed since the snapshot was taken."""
+        signature = session.signature
+        return self.metadata.get('version') == str(SNAPSHOT_VERSION) and \
+            self.metadata.get('documents') == str(signature['documents']) and \
+            self.metadata.get('last_id') == str(signature['last_id'])
+
+    @property
+    def table(self) -> 'pyarrow.Table':
+        """The whole snapshot, backed by the mapped file rather than copied."""
+        return self.reader.read_all()
+
+    def column(self, name: str) -> 'pyarrow.ChunkedArray':
+        return self.table.column(name)
+
+    def batches(self, lower: ObjectId = None, upper: ObjectId = None) -> Iterator['pyarrow.RecordBatch']:
+        """
+        Record batches of a range of _id, batches entirely out of the range are skipped.
+
+        :param lower: the lowest _id of the range, None for unbounded
+        :param upper: the _id right after the range, None for unbounded
+        """
+        # hexadecimal strings of object ids sort the same way the object ids do
+        lower = None if lower is None else str(lower)
+        upper = None if upper is None else str(upper)
+        for index in range(self.reader.num_record_batches):
+            batch = self.reader.get_batch(index)
+            if batch.num_rows == 0:
+                continue
+            ids = batch.column('_id')
+            if (lower is not None and ids[-1].as_py() < lower) or \
+                    (upper is not None and ids[0].as_py() >= upper):
+                continue
+            mask = None
+            if lower is not None and ids[0].as_py() < lower:
+                mask = pyarrow.compute.greater_equal(ids, lower)
+            if upper is not None and ids[-1].as_py() >= upper:
+                below = pyarrow.compute.less(ids, upper)
+                mask = below if mask is None else pyarrow.compute.and_(mask, below)
+            yield batch if mask is None else batch.filter(mask)
+
+    def rows(self, lower: ObjectId = None, upper: ObjectId = None) -> Iterator[dict]:
+        """Documents of a range of _id as they were in the session, but for fields not kept."""
+        for batch in self.batches(lower, upper):
+            for row in batch.to_pylist():
+                row['_id'] = ObjectId(row['_id'])
+                _restore(row, _NUMBER_FIELDS, _TEXT)
+                _restore(row, _STRING_OR_LIST_FIELDS, _LIST)
+                for citation in row['citation'] or ():
+                    _restore(citation, _CITATION_NUMBER_FIELDS, _TEXT)
+                yield row
+
+
+def session_documents(session: WokPersistentSession, query: dict,
+                      lower: ObjectId = None, upper: ObjectId = None) -> Iterator[dict]:
+    """
+    Documents of a range of _id of a session, read from its snapshot if it is
+    up to date and from the database otherwise.
+
+    :param query: the range as a query of the database
+    """
+    snapshot = WokSessionSnapshot.find(session) if config.snapshot.use_for_exports else None
+    if snapshot is None:
+        yield from session.collection.find(query)
+        return
+    with snapshot:
+        yield from snapshot.rows(lower, upper)
+
+
+class WokSessionSnapshotter(metaclass=Singleton):
+    """Takes snapshots in the background, one at a time."""
+
+    def __init__(self):
+        self.writers = ThreadPoolExecutor(1, thread_name_prefix='snapshot')
+        self.__lock = threading.Lock()
+        self.__snapshots: Dict[str, Future] = {}
+
+    def submit(self, session: WokPersistentSession) -> Future:
+        """Take a snapshot of a session, unless one is being taken already."""
+        with self.__lock:
+            running = self.__snapshots.get(session.session_id)
+            if running is not None and not running.done():
+                return running
+            future = self.__snapshots[session.session_id] = self.writers.submit(self.__take, session)
+        return future
+
+    @staticmethod
+    def __take(session: WokPersistentSession) -> Dict[str, str]:
+        try:
+            with write_snapshot(session) as snapshot:
+                return snapshot.metadata
+        except Exception as e:
+            logger.error(f'cannot take snapshot of {session}: {e}')
+            raise
+
+    def status(self, session: WokPersistentSession) -> Dict[str, Any]:
+        with self.__lock:
+            last = self.__snapshots.get(session.session_id)
+        status = {'session_id': session.session_id, 'taking': last is not None and not last.done(),
+                  'error': None if last is None or not last.done() or last.exception() is None
+                  else f'{last.exception()}'}
+        path = snapshot_path(session.session_id)
+        if pyarrow is None or not path.exists() or status['taking']:
+            return dict(status, exists=path.exists(), fresh=False)
+        with WokSessionSnapshot(path) as snapshot:
+            return dict(status, exists=True, fresh=snapshot.is_fresh(session), path=str(path),
+                        size=path.stat().st_size, **snapshot.metadata)
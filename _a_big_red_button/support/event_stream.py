@@ -0,0 +1,106 @@
+"""
+Implements a simple publish-subscribe channel whose events are pushed to
+clients as Server-Sent Events, so that clients no longer need to poll
+for progress and logs.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import json
+from queue import Queue, Empty, Full
+from threading import Lock
+from typing import Any, Dict, Iterable, Iterator, Optional, Set
+
+
+class Event:
+    def __init__(self, name: str, data: Dict[str, Any], event_id: Optional[int] = None):
+        self.name, self.data, self.event_id = name, data, event_id
+
+    def as_sse(self):
+        lines = []
+        if self.event_id is not None:
+            lines.append(f'id: {self.event_id}')
+        lines.append(f'event: {self.name}')
+        lines.append(f'data: {json.dumps(self.data, default=str)}')
+        return '\n'.join(lines) + '\n\n'
+
+
+class EventChannel:
+    """
+    Delivers every published event to every subscriber. Each subscriber
+    has a bounded queue, a subscriber that falls behind loses its oldest
+    events rather than holding back the publisher.
+    """
+
+    def __init__(self, subscriber_capacity: int = 1000):
+        self.subscriber_capacity = subscriber_capacity
+        self.__subscribers: Set[Queue] = set()
+        self.__lock = Lock()
+
+    def subscribe(self) -> Queue:
+        subscriber = Queue(maxsize=self.subscriber_capacity)
+        with self.__lock:
+            self.__subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Queue):
+        with self.__lock:
+            self.__subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        with self.__lock:
+            return len(self.__subscribers)
+
+    def publish(self, name: str, event_id: Optional[int] = None, **data):
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+        if not subscribers:
+            return
+
+        event = Event(name, data, event_id)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(event)
+                    break
+                except Full:
+                    try:
+                        subscriber.get_nowait()
+                    except Empty:
+                        pass
+
+    def stream(self, keep_alive: float = 15, replay: Iterable[Event] = ()) -> Iterator[str]:
+        """
+        Subscribe to this channel and yield events formatted as Server-Sent
+        Events until the client goes away.
+
+        :param keep_alive: seconds after which a comment is sent to keep the connection open
+        :param replay: events missed by the client, sent before any new event
+        """
+        # subscribe before replaying so that nothing falls in between,
+        # numbered events that have already been replayed are skipped
+        subscriber = self.subscribe()
+        try:
+            yield 'retry: 3000\n\n'
+            replayed = {}
+            for event in replay:
+                if event.event_id is not None:
+                    replayed[event.name] = event.event_id
+                yield event.as_sse()
+            while True:
+                try:
+                    event = subscriber.get(timeout=keep_alive)
+                except Empty:
+                    yield ': keep-alive\n\n'
+                else:
+                    if event.event_id is not None and \
+                            event.event_id <= replayed.get(event.name, 0):
+                        continue
+                    yield event.as_sse()
+        finally:
+            self.unsubscribe(subscriber)
+
+
+# the channel shared by the whole application
+EVENT_CHANNEL = EventChannel()
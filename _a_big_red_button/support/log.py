@@ -5,13 +5,16 @@ offers it to various other components.
 Bin Ni. bn628@nyu.edu.
 """
 
+import atexit
 import logging
 import logging.handlers
-from logging.handlers import BufferingHandler
 import os
 import sys
-from queue import Full
+from collections import deque, OrderedDict
+from itertools import islice
+from queue import Queue, Full
 from threading import RLock, Lock
+from typing import Deque, Dict, List, Tuple
 from _a_big_red_button.support.configuration import BOOT_CFG, get_logger_config
 from _a_big_red_button.support.synchronisation import thread_safe
 from _a_big_red_button.support.directory import DEPLOYMENT_ROOT
@@ -34,6 +37,36 @@ __IGNORE_NON_STD_ERR_HANDLER = BOOT_CFG.flask.debug and __BASE_CFG.ignore_non_st
 # mutex protecting the known logger lists
 __mutex = RLock()
 
+# queue listeners doing the actual writing of queued loggers
+__KNOWN_LISTENERS: Dict[str, logging.handlers.QueueListener] = {}
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to a queue listener. If the listener falls behind and
+    the queue is full, records are dropped instead of blocking the thread that
+    logs, and the number of dropped records is kept.
+    """
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def __stop_listeners():
+    # flush whatever is still queued before the interpreter goes away
+    for listener in __KNOWN_LISTENERS.values():
+        listener.stop()
+
+
+atexit.register(__stop_listeners)
+
 
 @thread_safe(__mutex)
 def get_logger(identifier: str, *addition_handlers, force_add_additional: bool = False) -> logging.Logger:
@@ -65,6 +98,9 @@ def get_logger(identifier: str, *addition_handlers, force_add_additional: bool =
     old_working_dir = os.getcwd()
     os.chdir(str(DEPLOYMENT_ROOT.joinpath(__BASE_CFG.directory)))
 
+    # loggers are queued unless their own configuration says otherwise
+    queued = config.queued if hasattr(config, 'queued') else __BASE_CFG.queue.enabled
+    handlers = []
     for handler_config in config.handlers:
         if __IGNORE_NON_STD_ERR_HANDLER:
             if handler_config.type != 'StreamHandler' or handler_config.arguments.stream is not None:
@@ -80,9 +116,21 @@ def get_logger(identifier: str, *addition_handlers, force_add_additional: bool =
 
         handler.setFormatter(__FORMATTER if not hasattr(handler_config, 'formatter') else
                              logging.Formatter(getattr(handler_config, 'formatter')))
-        logger.setLevel(__LOGGING_LEVEL)
-        logger.addHandler(handler)
-
+        handlers.append(handler)
+
+    logger.setLevel(__LOGGING_LEVEL)
+    if queued and handlers:
+        # file and console output is done by the listener thread
+        queue = Queue(maxsize=__BASE_CFG.queue.capacity)
+        listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+        listener.start()
+        __KNOWN_LISTENERS[identifier] = listener
+        logger.addHandler(NonBlockingQueueHandler(queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+    # additional handlers are in-memory ones and are attached directly
     for handler in addition_handlers:
         # we assume here that all additional loggers have been properly initialise
         handler.setFormatter(__FORMATTER)
@@ -110,32 +158,96 @@ def __test_log(logger: logging.Logger):
     logger.debug('Logger up and ready')
 
 
-class BufferedHandler(BufferingHandler):
+class LogTally:
+    """
+    Counts messages that would otherwise be logged once per article or per
+    citation, and logs a single line per reason when flushed, e.g.
+    "WokPrintList(1 -> 500): 412 articles discarded: year filter".
+    """
+
+    def __init__(self, logger: logging.Logger, subject: str, level: int = logging.INFO):
+        self.logger = logger
+        self.subject = subject
+        self.level = level
+        self.counts: 'OrderedDict[str, List[int]]' = OrderedDict()
+
+    def count(self, reason: str, n: int = 1, level: int = None):
+        """
+        Count occurrences of a reason, logged at the highest level it is counted with.
+        """
+        level = self.level if level is None else level
+        if reason in self.counts:
+            entry = self.counts[reason]
+            entry[0] += n
+            entry[1] = max(entry[1], level)
+        else:
+            self.counts[reason] = [n, level]
+
+    @property
+    def total(self):
+        return sum(count for count, _ in self.counts.values())
+
+    def flush(self, context: str = None):
+        """Log the counts gathered so far and start over."""
+        prefix = '' if context is None else f'{context}: '
+        for reason, (count, level) in self.counts.items():
+            self.logger.log(level, f'{prefix}{count} {self.subject}: {reason}')
+        self.counts.clear()
+
+
+class _BufferedRecord:
+    """A record in the ring buffer, its message is formatted once and cached."""
+    __slots__ = ('seq', 'record', '_message')
+
+    def __init__(self, seq: int, record: logging.LogRecord):
+        self.seq, self.record, self._message = seq, record, None
+
+    @property
+    def message(self) -> str:
+        if self._message is None:
+            self._message = self.record.getMessage()
+        return self._message
+
+
+class RingBufferHandler(logging.Handler):
     """
-    NEW July 10 2019
+    NEW, replaces the BufferedHandler of July 10 2019
 
-    This class implements a very simple buffered log handler.
-    Use `extract_all` to extract all records and clear the buffer.
+    Keeps the latest records in a fixed-size ring buffer and numbers them
+    with monotonically increasing sequence numbers. Reading does not consume
+    the records, so any number of clients may read incrementally with
+    `read_since`. If an event channel is given, every record is also
+    published to it as a "log" event, with its sequence number as event id.
     """
 
-    def __init__(self, capacity):
-        super().__init__(capacity)
+    def __init__(self, capacity: int, channel=None):
+        super().__init__()
+        self.capacity = capacity
+        self.channel = channel
+        self.buffer: Deque[_BufferedRecord] = deque(maxlen=capacity)
         self.mutex = Lock()
+        self.seq = 0
 
     def emit(self, record):
-        self.mutex.acquire()
-        self.buffer.append(record)
-        if self.capacity and len(self.buffer) > self.capacity:
-            self.flush()
-        self.mutex.release()
-
-    def shouldFlush(self, record):
-        return False
-
-    def extract_all(self):
-        """Extract all the logs in the buffer and clear the buffer."""
-        self.mutex.acquire()
-        records = self.buffer
-        self.buffer = list()
-        self.mutex.release()
-        return records
+        with self.mutex:
+            self.seq += 1
+            entry = _BufferedRecord(self.seq, record)
+            self.buffer.append(entry)
+        if self.channel is not None:
+            self.channel.publish('log', event_id=entry.seq, message=entry.message)
+
+    def read_since(self, since: int = 0) -> Tuple[List[_BufferedRecord], int]:
+        """
+        Read all records newer than the given sequence number.
+
+        :param since: the last sequence number the client has seen
+        :return: the records in order, and the sequence number to read from next time
+        """
+        with self.mutex:
+            last = self.seq
+            if since >= last:
+                return [], last
+            # records are numbered consecutively so we can skip right to the new ones
+            new_count = min(last - since, len(self.buffer))
+            records = list(islice(self.buffer, len(self.buffer) - new_count, None))
+        return records, last
@@ -0,0 +1,68 @@
+"""
+Implements a small, thread safe LRU cache for objects that are expensive
+to construct, such as handles bound to database collections.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+from typing import Any, Hashable, List, Optional
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry once
+    its capacity is exceeded. All operations are guarded by a lock so
+    that it can be shared among the crawler and the Flask threads.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f'invalid LRU cache capacity: {capacity}')
+        self.capacity = capacity
+        self.__entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.__lock = RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        with self.__lock:
+            if key not in self.__entries:
+                return default
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        with self.__lock:
+            return self.__entries.pop(key, default)
+
+    def keys(self) -> List[Hashable]:
+        """The keys, from the least to the most recently used."""
+        with self.__lock:
+            return list(self.__entries.keys())
+
+    def values(self) -> List[Any]:
+        """The values, from the least to the most recently used."""
+        with self.__lock:
+            return list(self.__entries.values())
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __contains__(self, key: Hashable):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def __repr__(self):
+        return f'LRUCache(size={len(self)}, capacity={self.capacity})'
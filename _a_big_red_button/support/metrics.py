@@ -0,0 +1,229 @@
+"""
+Implements simple counters, gauges and histograms that are cheap enough
+to be updated on hot paths, and renders them in the Prometheus text
+exposition format so that they can be scraped or simply looked at.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import *
+
+# label values of a metric, in the order of its label names
+_LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 registry: 'MetricsRegistry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(name={self.name})'
+
+    def _label_values(self, labels: Dict[str, Any]) -> _LabelValues:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f'{self} expects labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, values: _LabelValues, extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.label_names, values))
+        if extra:
+            pairs.extend(extra.items())
+        if not pairs:
+            return ''
+        escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yield (name, formatted labels, value) of every sample."""
+        raise NotImplementedError
+
+    def exposition(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type_name}']
+        lines.extend(f'{name}{labels} {_format_value(value)}'
+                     for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 registry: 'MetricsRegistry' = None):
+        super().__init__(name, documentation, labels, registry)
+        self.__values: Dict[_LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self.__values.get(self._label_values(labels), 0)
+
+    @property
+    def values(self) -> Dict[_LabelValues, float]:
+        with self._lock:
+            return dict(self.__values)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, self._format_labels(key), value
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 registry: 'MetricsRegistry' = None):
+        super().__init__(name, documentation, labels, registry)
+        self.__values: Dict[_LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self.__values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self.__values.get(self._label_values(labels), 0)
+
+    @property
+    def values(self) -> Dict[_LabelValues, float]:
+        with self._lock:
+            return dict(self.__values)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, self._format_labels(key), value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    # seconds, suitable for anything from a parse to a slow request
+    DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    class _Series:
+        __slots__ = ('buckets', 'count', 'sum')
+
+        def __init__(self, size: int):
+            self.buckets = [0] * size
+            self.count = 0
+            self.sum = 0.0
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 registry: 'MetricsRegistry' = None):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+        self.__series: Dict[_LabelValues, Histogram._Series] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.__series.get(key)
+            if series is None:
+                series = self.__series[key] = self._Series(len(self.buckets))
+            if index < len(self.buckets):
+                series.buckets[index] += 1
+            series.count += 1
+            series.sum += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the body of a with statement."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def summary(self, **labels) -> Dict[str, float]:
+        """Count, sum and mean of the observations with the given labels."""
+        with self._lock:
+            series = self.__series.get(self._label_values(labels))
+            count, total = (0, 0.0) if series is None else (series.count, series.sum)
+        return {'count': count, 'sum': total, 'mean': total / count if count else 0.0}
+
+    @property
+    def label_values(self) -> List[_LabelValues]:
+        with self._lock:
+            return sorted(self.__series)
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(value.buckets), value.count, value.sum)
+                      for key, value in self.__series.items()}
+        for key, (buckets, count, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                yield (f'{self.name}_bucket',
+                       self._format_labels(key, {'le': _format_value(bound)}), cumulative)
+            yield f'{self.name}_bucket', self._format_labels(key, {'le': '+Inf'}), count
+            yield f'{self.name}_sum', self._format_labels(key), total
+            yield f'{self.name}_count', self._format_labels(key), count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f'metric [{metric.name}] has already been registered')
+            self.__metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        with self.__lock:
+            return self.__metrics.get(name)
+
+    @property
+    def metrics(self) -> List[Metric]:
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def exposition(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        return '\n'.join(metric.exposition() for metric in self.metrics) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# the registry shared by the whole application
+REGISTRY = MetricsRegistry()
@@ -9,10 +9,12 @@ from _a_big_red_button.support.configuration import get_config, BOOT_CFG, RUNNIN
 from _a_big_red_button.support.log import get_logger
 from _a_big_red_button.support.python_object_bridge import PyObjectLike, json_object_to_py_object, \
     py_object_to_json_object
+import importlib.util
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from bson.objectid import ObjectId
 from .filters import filter_by_object_id, update
+from .pool_monitor import MongoPoolMonitor
 
 # prepare the logger
 __logger = get_logger('db')
@@ -25,14 +27,66 @@ __CONNECTION_PARAMETERS = CONFIG.connection.debug if BOOT_CFG.flask.debug else C
 HOST = __CONNECTION_PARAMETERS.host
 PORT = __CONNECTION_PARAMETERS.port
 
+# python packages required by each wire protocol compressor
+__COMPRESSOR_PACKAGES = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': 'zlib'}
+
+# monitors the connection pools of the client
+POOL_MONITOR = MongoPoolMonitor()
+
+
+def _assemble_client_options(client_config) -> dict:
+    """
+    Translate the client section of the db configuration into keyword
+    arguments of the mongo client. Options left as null are not passed
+    so that the defaults of pymongo apply.
+
+    :param client_config: the client section of the db configuration
+    :return: keyword arguments for the mongo client
+    """
+    options = {
+        'maxPoolSize': client_config.max_pool_size,
+        'minPoolSize': client_config.min_pool_size,
+        'maxIdleTimeMS': client_config.max_idle_time_ms,
+        'waitQueueTimeoutMS': client_config.wait_queue_timeout_ms,
+        'connectTimeoutMS': client_config.connect_timeout_ms,
+        'socketTimeoutMS': client_config.socket_timeout_ms,
+        'serverSelectionTimeoutMS': client_config.server_selection_timeout_ms,
+        'w': client_config.write_concern.w,
+        'journal': client_config.write_concern.journal,
+        'readPreference': client_config.read_preference
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+
+    # compressors are only negotiated if their packages are available
+    compressors = []
+    for compressor in client_config.compressors or []:
+        package = __COMPRESSOR_PACKAGES.get(compressor)
+        if package is None:
+            __logger.warning(f'unknown mongodb compressor [{compressor}], ignored')
+        elif importlib.util.find_spec(package) is None:
+            __logger.warning(f'mongodb compressor [{compressor}] requires '
+                             f'package [{package}] which is not installed, ignored')
+        else:
+            compressors.append(compressor)
+    if compressors:
+        options['compressors'] = ','.join(compressors)
+    return options
+
+
+# options of the mongo client
+CLIENT_OPTIONS = _assemble_client_options(CONFIG.client)
+
 # mongo client
 if not RUNNING_IN_DEV_ENV:
-    mongo_connection = MongoClient(host=HOST, port=PORT)
+    mongo_connection = MongoClient(host=HOST, port=PORT,
+                                   event_listeners=[POOL_MONITOR], **CLIENT_OPTIONS)
     __logger.info('Running in deployment environment, connected to mongodb')
 else:
-    mongo_connection = MongoClient(host=HOST, port=PORT)
+    mongo_connection = MongoClient(host=HOST, port=PORT,
+                                   event_listeners=[POOL_MONITOR], **CLIENT_OPTIONS)
     __logger.info('Running in development environment, connected to mongodb as guest')
 __logger.info('Connected to database at %s:%s' % (HOST, PORT))
+__logger.debug(f'mongo client options: {CLIENT_OPTIONS}')
 
 
 class MongoDocumentAsPyObject(PyObjectLike):
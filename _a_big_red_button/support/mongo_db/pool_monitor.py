@@ -0,0 +1,113 @@
+"""
+Monitors the connection pools of the mongo client so that contention
+among crawlers, exports and searches can be observed.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import time
+import threading
+from typing import Dict, Any
+from pymongo import monitoring
+
+
+class _PoolStatistics:
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.failed_checkouts: Dict[str, int] = {}
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.cleared = 0
+
+    @property
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'open_connections': self.open,
+            'checked_out': self.checked_out,
+            'max_checked_out': self.max_checked_out,
+            'checkouts': self.checkouts,
+            'failed_checkouts': dict(self.failed_checkouts),
+            'total_wait_ms': round(self.total_wait * 1000, 3),
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'average_wait_ms': round(self.total_wait / self.checkouts * 1000, 3)
+            if self.checkouts else 0.0,
+            'cleared': self.cleared
+        }
+
+
+class MongoPoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Collects statistics of every connection pool, one per server address.
+    Checking out a connection happens on the thread that needs it, so the
+    time it waits for the pool is measured with a thread local clock.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pools: Dict[str, _PoolStatistics] = {}
+        self.__checkout_started = threading.local()
+
+    def __pool(self, address) -> _PoolStatistics:
+        key = '%s:%s' % address if isinstance(address, tuple) else str(address)
+        if key not in self.__pools:
+            self.__pools[key] = _PoolStatistics()
+        return self.__pools[key]
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.__lock:
+            return {address: pool.dict for address, pool in self.__pools.items()}
+
+    def pool_created(self, event):
+        with self.__lock:
+            self.__pool(event.address)
+
+    def pool_cleared(self, event):
+        with self.__lock:
+            self.__pool(event.address).cleared += 1
+
+    def pool_closed(self, event):
+        with self.__lock:
+            self.__pools.pop('%s:%s' % event.address, None)
+
+    def connection_created(self, event):
+        with self.__lock:
+            self.__pool(event.address).open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.__lock:
+            pool = self.__pool(event.address)
+            pool.open = max(pool.open - 1, 0)
+
+    def connection_check_out_started(self, event):
+        self.__checkout_started.value = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self.__checkout_started.value = None
+        with self.__lock:
+            pool = self.__pool(event.address)
+            reason = str(event.reason)
+            pool.failed_checkouts[reason] = pool.failed_checkouts.get(reason, 0) + 1
+
+    def connection_checked_out(self, event):
+        started = getattr(self.__checkout_started, 'value', None)
+        waited = time.perf_counter() - started if started is not None else 0.0
+        self.__checkout_started.value = None
+        with self.__lock:
+            pool = self.__pool(event.address)
+            pool.checkouts += 1
+            pool.checked_out += 1
+            pool.max_checked_out = max(pool.max_checked_out, pool.checked_out)
+            pool.total_wait += waited
+            pool.max_wait = max(pool.max_wait, waited)
+
+    def connection_checked_in(self, event):
+        with self.__lock:
+            pool = self.__pool(event.address)
+            pool.checked_out = max(pool.checked_out - 1, 0)
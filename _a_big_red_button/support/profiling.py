@@ -0,0 +1,219 @@
+"""
+Implements a profiling mode for long running work such as crawls and
+exports. A profiled block is run under cProfile, while a sampler thread
+records the stacks of every thread in folded form, which flamegraph.pl
+and speedscope read, and tracemalloc records the top allocation sites.
+Everything is written into a directory of its own per profiled block.
+
+Kevin Ni, kevin.ni@nyu.edu.
+"""
+
+import cProfile
+import datetime
+import hashlib
+import io
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+
+from _a_big_red_button.support.configuration import get_config
+from _a_big_red_button.support.directory import DEPLOYMENT_ROOT
+from _a_big_red_button.support.log import get_logger
+
+# prepare logger
+logger = get_logger('controller')
+
+# get config
+config = get_config('profiling')
+
+# tracemalloc is process wide, it is started by the first profiler and stopped by the last
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of all other threads at a fixed interval and counts them."""
+
+    def __init__(self, interval: float):
+        super().__init__(name='stack-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.__stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.__stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                self.stacks[self.fold(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def fold(thread_name: str, frame) -> str:
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f'{Path(code.co_filename).stem}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        functions.append(thread_name)
+        return ';'.join(reversed(functions)).replace(' ', '_')
+
+    def stop(self):
+        self.__stopped.set()
+        self.join()
+
+    def write_folded(self, path: Path):
+        with path.open(mode='w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+# characters of the name of a profiled block kept in the name of its directory
+NAME_LENGTH = 48
+
+
+def directory_name(name: str) -> str:
+    """
+    A name of a directory of its own for a profiled block: the name of the
+    block, shortened and told apart by its hash if too long, the time and a
+    random suffix, as blocks of the same name may start in the same second.
+    """
+    sanitised = re.sub(r'[^\w.-]+', '_', name)
+    if len(sanitised) > NAME_LENGTH:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        sanitised = f'{sanitised[:NAME_LENGTH]}_{digest}'
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return f'{sanitised}-{timestamp}-{uuid.uuid4().hex[:6]}'
+
+
+class Profiler:
+    """
+    Profiles the body of a with statement, writing into a directory of its
+    own named after the profiled block and the time it started:
+
+    - profile.pstats, the cProfile statistics of the profiling thread
+    - profile.txt, the same sorted by cumulative time
+    - stacks.folded, stacks of all threads sampled, for flamegraphs
+    - allocations.txt, the top allocation sites while profiling
+    """
+
+    def __init__(self, name: str, directory: Path = None):
+        self.name = name
+        self.directory = (directory or DEPLOYMENT_ROOT.joinpath(config.directory)) \
+            .joinpath(directory_name(name))
+        self.profile: Optional[cProfile.Profile] = None
+        self.sampler: Optional[StackSampler] = None
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+
+    def __repr__(self):
+        name = self.name if len(self.name) <= NAME_LENGTH else f'{self.name[:NAME_LENGTH]}...'
+        return f'Profiler(name={name})'
+
+    def __enter__(self):
+        global _tracemalloc_users, _tracemalloc_started
+        self.directory.mkdir(parents=True)
+        try:
+            if config.tracemalloc.enabled:
+                with _tracemalloc_lock:
+                    if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                        tracemalloc.start(config.tracemalloc.frames)
+                        _tracemalloc_started = True
+                    _tracemalloc_users += 1
+                self.baseline = tracemalloc.take_snapshot()
+            if config.sampling.enabled:
+                self.sampler = StackSampler(config.sampling.interval)
+                self.sampler.start()
+            if config.cprofile:
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+        except Exception:
+            self.release()
+            raise
+        logger.info(f'{self} writing into {self.directory}')
+        return self
+
+    def release(self):
+        """Stop whatever has been started, without writing anything."""
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None and self.sampler.is_alive():
+            self.sampler.stop()
+        self.release_tracemalloc()
+
+    def release_tracemalloc(self):
+        global _tracemalloc_users, _tracemalloc_started
+        if self.baseline is None:
+            return
+        with _tracemalloc_lock:
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_started:
+                tracemalloc.stop()
+                _tracemalloc_started = False
+        self.baseline = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.profile is not None:
+                self.profile.disable()
+                self.profile.dump_stats(str(self.directory.joinpath('profile.pstats')))
+                text = io.StringIO()
+                pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(100)
+                self.directory.joinpath('profile.txt').write_text(text.getvalue(), encoding='utf-8')
+            if self.sampler is not None:
+                self.sampler.stop()
+                self.sampler.write_folded(self.directory.joinpath('stacks.folded'))
+            if self.baseline is not None:
+                self.write_allocations(tracemalloc.take_snapshot())
+        except Exception as e:
+            logger.error(f'{self} cannot write profile: {e}')
+        finally:
+            self.release_tracemalloc()
+        logger.info(f'{self} written into {self.directory}')
+        return False
+
+    def write_allocations(self, snapshot: tracemalloc.Snapshot):
+        # allocations made while profiling, other threads included
+        top = snapshot.compare_to(self.baseline, 'lineno')[:config.tracemalloc.top]
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'traced memory: current {current / 1024 / 1024:.1f} MiB, '
+                 f'peak {peak / 1024 / 1024:.1f} MiB', '']
+        lines.extend(str(statistic) for statistic in top)
+        self.directory.joinpath('allocations.txt').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+
+@contextmanager
+def profiled(name: str, enabled: Optional[bool] = None):
+    """
+    Profile the body of a with statement if enabled, yielding the profiler,
+    or None if not profiling.
+
+    :param name: name of the profiled block, used to name its directory
+    :param enabled: whether to profile, None to follow the configuration
+    """
+    if enabled is None:
+        enabled = config.enabled
+    if not enabled:
+        yield None
+        return
+    # profiling must never stop the profiled work from running
+    try:
+        profiler = Profiler(name).__enter__()
+    except Exception as e:
+        logger.error(f'cannot profile {name}, running without profiling: {e}')
+        yield None
+        return
+    try:
+        yield profiler
+    finally:
+        profiler.__exit__(*sys.exc_info())
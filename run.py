@@ -6,10 +6,12 @@ about to do.
 
 Kevin Ni, kevin.ni@nyu.edu.
 """
+import os
 import sys
 import time
 import webbrowser
 from _flask_app import app
+from _a_big_red_button.crawler import resume_persistent_jobs
 from _a_big_red_button.support.configuration import BOOT_CFG, RUNNING_IN_DEV_ENV
 import threading
 
@@ -37,9 +39,15 @@ if __name__ == '__main__':
         gui_launcher.daemon = True
         gui_launcher.start()
 
+    # pick up jobs left unfinished by a previous run, with the debug
+    # reloader only the child process actually serves and runs jobs
+    debugging = RUNNING_IN_DEV_ENV and 'NO_DEBUG' not in sys.argv
+    if not debugging or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        resume_persistent_jobs()
+
     # launch the backend
     print("starting backend, press Ctrl-C (Control-C on Mac) to stop...")
-    if RUNNING_IN_DEV_ENV and 'NO_DEBUG' not in sys.argv:
+    if debugging:
         app.run(BOOT_CFG.flask.address.host, BOOT_CFG.flask.address.port, debug=True)
     else:
         app.run(BOOT_CFG.flask.address.host, BOOT_CFG.flask.address.port, debug=False)
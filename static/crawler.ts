@@ -16,6 +16,10 @@ class ASD {
     progressBar: ProgressBarController;
     searchFields: Array<object>;
     termAssemblerBox: HTMLTextAreaElement;
+    events: EventSource = null;
+    searchJobId: string = null;
+    crawlJobId: string = null;
+    logSeq: number = 0;
 
     static usingProgressBar() {
         return _asdConfig.useProgressBar;
@@ -25,6 +29,10 @@ class ASD {
         return _asdConfig.hasOwnProperty("parseFields");
     }
 
+    static streamingEvents() {
+        return typeof EventSource !== "undefined";
+    }
+
     static preventingLeave() {
         return !_asdConfig.hasOwnProperty("preventLeave") ||
             _asdConfig.preventLeave === true;
@@ -130,7 +138,15 @@ class ASD {
         let termBox = document.querySelector('#term-box');
         let term = (termBox as HTMLTextAreaElement).value;
         this.fileRequest("/command/search/", "POST",
-            () => this.addConsoleLine("searching now..."),
+            (response) => {
+                this.searchJobId = response.job_id;
+                this.addConsoleLine("searching now...");
+                // without the event stream we have to poll for the result
+                if (this.events === null)
+                    setTimeout(this.pollSearchStatus, 3000);
+                else
+                    this.catchUpWithJob(this.searchJobId);
+            },
             (error) => {
                 this.addConsoleLine("searched failed: " + error);
                 this.progressBar.makeStatic();
@@ -139,27 +155,35 @@ class ASD {
             },
             {term: term}
         );
-        // give the program more time to initiate
-        setTimeout(this.pollSearchStatus, 3000);
+    };
+
+    finishSearch = (resultCount) => {
+        this.searchJobId = null;
+        this.updateTotalArticleNumber(resultCount);
+        this.addConsoleLine(
+            "search finished, found " + resultCount + " results");
+        this.progressBar.makeStatic();
+        this.progressBar.updateLabel("search finished");
+        ASD.enableButton();
+    };
+
+    failSearch = (error) => {
+        this.searchJobId = null;
+        this.addConsoleLine(`search failed: ${error}`);
+        this.progressBar.makeStatic();
+        this.progressBar.updateLabel("SEARCH FAILED");
+        ASD.enableButton();
     };
 
     pollSearchStatus = () => {
         this.fileRequest("/poll/search/", "GET",
             (response) => {
-                if (response.finished) {
-                    this.updateTotalArticleNumber(response.result_count);
-                    this.addConsoleLine(
-                        "search finished, found " + response.result_count + " results");
-                    this.progressBar.makeStatic();
-                    this.progressBar.updateLabel("search finished");
-                    ASD.enableButton();
-                } else setTimeout(this.pollSearchStatus, 1000);
+                if (response.finished)
+                    this.finishSearch(response.result_count);
+                else setTimeout(this.pollSearchStatus, 1000);
             },
             (error) => {
-                this.addConsoleLine(`search failed: ${error}`);
-                this.progressBar.makeStatic();
-                this.progressBar.updateLabel("SEARCH FAILED");
-                ASD.enableButton();
+                this.failSearch(error);
                 // asd.addConsoleLine("no search status available: " + error);
                 // setTimeout(this.pollSearchStatus, 1000);
             }
@@ -212,7 +236,15 @@ class ASD {
 
     crawl = (start, end, year_start = 0, year_end = 0) => {
         this.fileRequest("/command/crawl/", "POST",
-            () => this.addConsoleLine("crawling now..."),
+            (response) => {
+                this.crawlJobId = response.job_id;
+                this.addConsoleLine("crawling now...");
+                // without the event stream we have to poll for the progress
+                if (this.events === null)
+                    setTimeout(this.pollCrawlStatus, 3000);
+                else
+                    this.catchUpWithJob(this.crawlJobId);
+            },
             (error) => {
                 this.addConsoleLine("cannot start crawling: " + error);
                 ASD.enableButton();
@@ -224,7 +256,28 @@ class ASD {
         this.progressBar.makeInfinite();
         this.progressBar.updateLabel("crawling...");
         ASD.disableButton();
-        setTimeout(this.pollCrawlStatus, 3000);
+    };
+
+    updateCrawlProgress = (finished, total) => {
+        this.updateCrawledArticleNumber(finished);
+        if (total)
+            this.progressBar.makeFinite(finished / total * 100);
+    };
+
+    finishCrawl = () => {
+        this.crawlJobId = null;
+        this.progressBar.makeFinite(100);
+        this.progressBar.updateLabel("CRAWLING FINISHED");
+        ASD.enableButton();
+        this.addConsoleLine("crawling finished");
+    };
+
+    failCrawl = (error) => {
+        this.crawlJobId = null;
+        this.addConsoleLine(`cannot poll crawl status: ${error}`);
+        this.progressBar.makeStatic();
+        this.progressBar.updateLabel("CRAWL FAILED");
+        ASD.enableButton();
     };
 
     copyTermToClipboard = (term: string) => {
@@ -279,26 +332,80 @@ class ASD {
             (response) => {
                 if (response.finished !== -1) {  // not done yet
                     // this.addConsoleLine("finished " + response.finished + " entries");
-                    this.updateCrawledArticleNumber(response.finished);
-                    this.progressBar.makeFinite(response.finished / response.total * 100);
+                    this.updateCrawlProgress(response.finished, response.total);
                     setTimeout(this.pollCrawlStatus, 1000);
-                } else {
-                    this.progressBar.makeFinite(100);
-                    this.progressBar.updateLabel("CRAWLING FINISHED");
-                    ASD.enableButton();
-                    this.addConsoleLine("crawling finished");
-                }
+                } else this.finishCrawl();
             },
             (error) => {
-                asd.addConsoleLine(`cannot poll crawl status: ${error}`);
-                asd.progressBar.makeStatic();
-                asd.progressBar.updateLabel("CRAWL FAILED");
-                ASD.enableButton();
+                this.failCrawl(error);
                 // setTimeout(this.pollCrawlStatus, 1000);
             }
         );
     };
 
+    listenToEvents = () => {
+        this.events = new EventSource("/stream/events/");
+        this.events.addEventListener("log", (event: MessageEvent) => {
+            let log = JSON.parse(event.data);
+            this.logSeq = Number(event.lastEventId) || this.logSeq;
+            console.log(log.message);
+            this.addConsoleLine(log.message);
+        });
+        this.events.addEventListener("job", (event: MessageEvent) => {
+            this.handleJobEvent(JSON.parse(event.data));
+        });
+        this.events.onerror = () => {
+            // the browser reconnects by itself unless the stream is closed for good
+            if (this.events.readyState === EventSource.CLOSED) {
+                this.addConsoleLine("event stream closed, polling for updates instead");
+                this.events = null;
+                this.pollLogs();
+                // jobs still running are no longer pushed to us either
+                if (this.searchJobId !== null)
+                    setTimeout(this.pollSearchStatus, 1000);
+                if (this.crawlJobId !== null)
+                    setTimeout(this.pollCrawlStatus, 1000);
+            }
+        };
+    };
+
+    catchUpWithJob = (jobId: string) => {
+        // events of the job may have been pushed before we knew its id
+        this.fileRequest(`/poll/job/${jobId}/`, "GET", this.handleJobEvent,
+            (error) => this.addConsoleLine(`cannot poll job status: ${error}`));
+    };
+
+    handleJobEvent = (job) => {
+        if (job.job_id === this.searchJobId) {
+            if (job.state === "done")
+                this.finishSearch(job.result_count);
+            else if (job.state === "failed")
+                this.failSearch(job.error);
+        } else if (job.job_id === this.crawlJobId) {
+            if (job.state === "crawling")
+                this.updateCrawlProgress(job.finished, job.total);
+            else if (job.state === "done") {
+                this.updateCrawlProgress(job.finished, job.total);
+                this.finishCrawl();
+            } else if (job.state === "failed")
+                this.failCrawl(job.error);
+        }
+    };
+
+    pollLogs = () => {
+        window.setInterval(() => {
+            // pull new logs
+            // only ask for the lines we have not seen, other clients read the same logs
+            this.fileRequest(`/poll/log/?since=${this.logSeq}`, "GET", (response) => {
+                this.logSeq = response.seq;
+                response.new_logs.forEach((log) => {
+                    console.log(log);
+                    this.addConsoleLine(log);
+                })
+            });
+        }, 1000);
+    };
+
     getFilenameIndicator = () => {
         return document.querySelector("#crawler-output-file");
     };
@@ -493,15 +600,11 @@ window.addEventListener("load", function () {
     // if (ASD.parsingFields()) return;
     asd = new ASD();
 
-    window.setInterval(function () {
-        // pull new logs
-        asd.fileRequest("/poll/log/", "GET", (response) => {
-            response.new_logs.forEach((log) => {
-                console.log(log);
-                asd.addConsoleLine(log);
-            })
-        });
-    }, 1000);
+    // logs and progress are pushed through the event stream where possible
+    if (ASD.streamingEvents())
+        asd.listenToEvents();
+    else
+        asd.pollLogs();
 
     // bind export buttons
     document.querySelectorAll("button.session-export-button").forEach(